@@ -1,9 +1,13 @@
 import os, sys
-import xml.etree.ElementTree as ET
+import argparse
 
 from models import environment
 from models import agent
 from models import dijkstra
+from models import batch
+from models import server
+from models import benchmark
+from models import generator
 
 def sumo_config():
     # os.environ["SUMO_HOME"] = '$SUMO_HOME' # -- change to your path to $SUMO_HOME if necessary
@@ -21,7 +25,7 @@ def tls_from_tllxml(file_name):
     Make tls data from tll.xml
 
     Args:
-    - file_name: tll.xml file name
+    - file_name: tll.xml file name, or a .net.xml / .net.xml.gz with the programs embedded
         <additionals>
             <tlLogic id="10726190730" type="static" programID="0" offset="0">
                 <phase duration="42" state="GGgrrrGGgrrr"/>
@@ -37,58 +41,150 @@ def tls_from_tllxml(file_name):
 
     Returns:
     - tls_data: dictionary of tls data
-        tls_data[tl_id][link_index] = [90]
+        tls_data[tl_id] = {'offset': float, 'phases': [(duration, state), ...]}
+        the phases are expanded to per-second "seconds until green" arrays by models/signals.py
     """
-    tree = ET.parse(file_name)
-    root = tree.getroot()
 
-    tls_data = {}
-    for tl in root.findall('.//tlLogic'):
-        tl_id = tl.get('id')
+    from models import loader  # the XML parser, environment.read_programs() takes the programs from the snapshot when valid
+    return loader.read_tls(file_name)  # streamed, the file is never held as a whole tree
 
-        if tl_id not in tls_data:
-            tls_data[tl_id] = {}
-        else:
-            sys.exit(f"Error: {tl_id} duplicated")
 
-        phases = tl.findall('.//phase')
-
-        for phase in phases:
-            duration = phase.get('duration')
-            state = phase.get('state')
-
-            # Make tls_data[tl_id][link_index] = nth char in state repeating duration times
-            for link_index in range(len(state)):
-                if link_index not in tls_data[tl_id]:
-                    tls_data[tl_id][link_index] = []
-                tls_data[tl_id][link_index] += [state[link_index] for _ in range(int(duration))]
+def parse_args():
+    """
+    Returns:
+    - args (argparse.Namespace): args.command is None for the demo of the three algorithms, "batch" to route a request file, "serve" to run the routing service,
+        "bench" to run the benchmark suite, "generate" to write a synthetic network
+    """
 
-    return tls_data
+    parser = argparse.ArgumentParser(description='Route optimisation on a SUMO network')
+    commands = parser.add_subparsers(dest='command')
+
+    batch_parser = commands.add_parser('batch', help='route every request of a .jsonl file, headless')
+    batch_parser.add_argument('--in', dest='input_file', required=True, help='.jsonl of {"start_node", "end_node", "id"} requests')
+    batch_parser.add_argument('--out', dest='output_file', required=True, help='.jsonl of results, one line per request as it finishes')
+    batch_parser.add_argument('--algo', dest='algorithm', default='dijkstra', choices=batch.ALGORITHMS)
+    batch_parser.add_argument('--processes', type=int, default=None, help='size of the worker pool, 1 to route in this process (default: cpu count)')
+    batch_parser.add_argument('--max-in-flight', type=int, default=None, help='requests queued in the pool at once (default: 4 per process)')
+    batch_parser.add_argument('--episodes', type=int, default=5000, help='limit of episodes of qlearning/sarsa')
+    batch_parser.add_argument('--threshold', type=int, default=5, help='threshold to converge of qlearning/sarsa')
+    batch_parser.add_argument('--batch-size', type=int, default=None, help='train qlearning/sarsa with train_batch() of this size')
+    batch_parser.add_argument('--seed', type=int, default=None, help='seed of qlearning/sarsa')
+
+    serve_parser = commands.add_parser('serve', help='serve /route, /matrix and /congestion over HTTP/JSON on the network loaded once')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--window', type=float, default=0.005, help='seconds a batch of route queries from one source stays open')
+    serve_parser.add_argument('--processes', type=int, default=1, help='size of the process pool of each matrix, 1 to solve in the server')
+    serve_parser.add_argument('--verbose', action='store_true', help='log every request')
+
+    bench_parser = commands.add_parser('bench', help='benchmark the searches, the route evaluation and the agents, reported as JSON')
+    bench_parser.add_argument('--out', dest='output_file', default='benchmark.json', help='.json of the results')
+    bench_parser.add_argument('--compare', dest='baseline_file', default=None, help='.json of an earlier run, exits with an error on regressions')
+    bench_parser.add_argument('--tolerance', type=float, default=0.2, help='relative change allowed by --compare')
+    bench_parser.add_argument('--seed', type=int, default=0, help='seed of the congestion, the OD pairs and the agents')
+    bench_parser.add_argument('--pairs', type=int, default=200, help='OD pairs of the searches')
+    bench_parser.add_argument('--rl-pairs', type=int, default=3, help='OD pairs each agent is trained on, 0 to skip the agents')
+    bench_parser.add_argument('--episodes', type=int, default=5000, help='limit of episodes of the agents')
+    bench_parser.add_argument('--threshold', type=int, default=5, help='threshold to converge of the agents')
+    bench_parser.add_argument('--network', dest='network_file', default=None, help='.net.xml(.gz) to benchmark instead of the default network, e.g. one written by generate')
+    bench_parser.add_argument('--congestion-level', default='low', choices=('low', 'medium', 'high'))
+
+    generate_parser = commands.add_parser('generate', help='write a synthetic grid, radial or planar city as .net.xml(.gz), with its lights')
+    generate_parser.add_argument('--kind', default='grid', choices=('grid', 'radial', 'planar'))
+    generate_parser.add_argument('--junctions', type=int, default=2500, help='number of junctions, about 4 edges each')
+    generate_parser.add_argument('--signals', type=float, default=0.3, help='share of junctions of degree 3 or more with a light')
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--out', dest='output_file', required=True, help='.net.xml or .net.xml.gz to write')
+    generate_parser.add_argument('--tll', dest='tll_file', default=None, help='also write the programs alone to this .tll.xml')
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
+    args = parse_args()
 
     # 01 Setup SUMO
-    sumo_config()
+    if args.command in ('batch', 'serve', 'bench', 'generate'):
+        import matplotlib
+        matplotlib.use('Agg')  # headless, nothing is shown
+    else:
+        sumo_config()
 
 
     # 02 Configure network variables
-    network_file = './network_files/ncku_network.net.xml'  # download .osm and then netconvert to .net.xml, see more in "https://www.openstreetmap.org/" and "config.txt" is the netconvert config
-    tls = tls_from_tllxml('./network_files/ncku_network.tll.xml')  # tll.xml is exported from netedit
+    network_file = './network_files/osm.net.xml.gz'  # download .osm and then netconvert to .net.xml(.gz), see more in "https://www.openstreetmap.org/" and "config.txt" is the netconvert config
+    tls_file = network_file  # the programs netconvert put in the net, or a tll.xml exported from netedit
+    tls = environment.read_programs(network_file, tls_file)  # from the snapshot if valid, so a start reads no XML
     congestion = []  # can be defined, but if it is empty, env will randomly decide congested edges
     start_node = "864831599"  # can be defined, the scope is the nodes in the network
     end_node = "5739293224"
 
+    # -------------------
+    # Synthetic network, python main.py generate --kind grid --junctions 25000 --out grid.net.xml.gz
+    # -------------------
+    if args.command == 'generate':
+        print('Generate Start...')
+        city = getattr(generator.synthetic_city, args.kind)(args.junctions, signal_density = args.signals, seed = args.seed)
+        city.write_net(args.output_file, args.tll_file)
+        print(f'-- Junctions: {city.num_nodes}, Edges: {city.num_edges}, Traffic Lights: {len(city.tls)}')
+        sys.exit()
+
+    # -------------------
+    # Benchmark suite, python main.py bench --out benchmark.json [--compare baseline.json], loads the network itself
+    # -------------------
+    if args.command == 'bench':
+        if args.network_file:
+            network_file = tls_file = args.network_file
+        results = benchmark.run_benchmark(
+            network_file, tls_file, args.output_file,  # times the read of the programs as well
+            seed = args.seed,
+            num_pairs = args.pairs,
+            num_rl_pairs = args.rl_pairs,
+            num_episodes = args.episodes,
+            threshold = args.threshold,
+            congestion_level = args.congestion_level,
+        )
+        if args.baseline_file:
+            regressions = benchmark.compare(args.baseline_file, results, args.tolerance)
+            for name, before, after in regressions:
+                print(f'-- Regression: {name} {before} -> {after}')
+            if regressions:
+                sys.exit(f'Error: {len(regressions)} regressions against {args.baseline_file}')
+        sys.exit()
+
     # 03 Initiate Environment
     env = environment.traffic_env(
         network_file = network_file,
         tls = tls,
+        tls_file = tls_file,  # the snapshot keeps the programs read from it
         congestion = congestion,
         evaluation = "time", # Type: "destination" | "time"
         congestion_level = "low",  # Type: "low" | "medium" | "high", only applied if the congestion is not defined
     )
 
 
+    # -------------------
+    # Batch of requests, python main.py batch --in requests.jsonl --out results.jsonl --algo dijkstra
+    # -------------------
+    if args.command == 'batch':
+        batch.run_batch(
+            env, args.input_file, args.output_file, args.algorithm,
+            processes = args.processes,
+            max_in_flight = args.max_in_flight,
+            num_episodes = args.episodes,
+            threshold = args.threshold,
+            batch_size = args.batch_size,
+            seed = args.seed,
+        )
+        sys.exit()
+
+    # -------------------
+    # Routing service, python main.py serve --port 8000, queried by server.routing_client
+    # -------------------
+    if args.command == 'serve':
+        server.serve(env, args.host, args.port, args.window, args.processes, args.verbose)
+        sys.exit()
+
+
     # 04 Activate Agent
     # -------------------
     # Dijkstra Algorithm
@@ -1,8 +1,26 @@
 import numpy as np
+import os
 import sys
+import json
+import time
+import heapq
+import hashlib
 import datetime
+import collections
+
+from models import dijkstra
+from models import episode_log
+
+PROGRESS_INTERVAL = 0.2  # seconds between two redraws of the progress bar
+_progress = {'time': 0.0}
+
+def print_progress_bar(iteration, limit, force = False):
+    # Redrawn at most every PROGRESS_INTERVAL seconds, unless forced
+    now = time.monotonic()
+    if not force and now - _progress['time'] < PROGRESS_INTERVAL:
+        return
+    _progress['time'] = now
 
-def print_progress_bar(iteration, limit):
     fill='█'
     length = 50
     prefix = 'Episodes: '
@@ -16,23 +34,47 @@ def print_progress_bar(iteration, limit):
 
 
 class rl_agent():
-    def __init__ (self, env, start_node, end_node, learning_rate, discount_factor, reward_lst):
+    def __init__ (self, env, start_node, end_node, learning_rate, discount_factor, reward_lst, seed = None):
         # Define the learning parameters
         self.learning_rate = learning_rate
         self.discount_factor = discount_factor
         self.reward_lst = reward_lst
+        self.exploration_rate = 0  # greedy unless derived classes explore
+        self.rng = np.random.default_rng(seed)  # per-agent randomness, so that runs side by side are reproducible
 
         # Initialise environment
         self.env = env
         self.env.set_start_end(start_node, end_node)  # let the env knows where are the start and end nodes
 
+        # The agent runs on node/edge indices of the compiled network, IDs are only used for logs and results
+        self.graph = self.env.graph
+        self.start_index = self.env.node_index[start_node]
+        self.end_index = self.env.node_index[end_node]
+
+        # Episode log settings, can be changed before train()
+        self.log_window = None  # the number of recent episodes whose edges stay in memory, None for all
+        self.log_file = None  # the prefix to also stream every episode to, see episode_log
+        self.heuristic_init = False  # start from heuristic_q_table() instead of zeros when train() gets no q_table
 
 
     # Reset agent
-    def reset(self):
-        self.q_table = np.zeros((len(self.env.state_space), len(self.env.action_space)))  # state_space * action_space
-        self.logs = {}  # self.logs[episode] = [node_path, edge_path]
+    def reset(self, q_table = None):
+        if q_table is None and self.heuristic_init:
+            q_table = self.heuristic_q_table()
+        if q_table is None:
+            self.q_table = np.zeros((len(self.env.state_space), len(self.env.action_space)))  # state_space * action_space
+        else:  # warm start
+            if q_table.shape != (len(self.env.state_space), len(self.env.action_space)):
+                sys.exit(f'Error: Invalid q_table shape {q_table.shape} ...call by reset')
+            if isinstance(q_table, np.memmap) and q_table.mode == 'c' and q_table.dtype == np.float64:
+                self.q_table = q_table  # copy-on-write, only the pages updated are copied and the file is left untouched
+            else:
+                self.q_table = np.array(q_table, dtype=np.float64)
+        self.logs = episode_log.episode_log(self.env, self.start_index, self.log_window, self.log_file)  # self.logs[episode] = [node_path, edge_path]
         self.best_result = 0
+        self.steps = 0  # actions taken over all episodes, for models/benchmark.py
+        self.travelled_pairs = set()  # (edge, next_edge) pairs travelled in the current episode, to detect loops
+        self.route = self.env.new_route()  # running cost of the current episode
 
 
     def act(self):
@@ -42,10 +84,8 @@ class rl_agent():
     def step(self, action, node_path, edge_path):
         # 0. initialise step
         is_terminate = False
-        current_state = node_path[-1]
-        current_edge = edge_path[-1] if edge_path else None
-
-        outgoing_edges = self.env.decode_node_to_edges(current_state, direction = 'outgoing')
+        current_state = node_path[-1]  # node index
+        current_edge = edge_path[-1] if edge_path else None  # edge index
 
         # 1. Determine reward paramaters
         invalid_action_reward = self.reward_lst[0]
@@ -60,55 +100,50 @@ class rl_agent():
 
 
         # 2. Compute the reward and the next state
+        next_edge = self.graph.transition_edge[current_state, action]
+
         # Case 1. Out-Of-Bound Action
-        if action not in self.env.decode_edges_to_actions(outgoing_edges):  # e.g. it may be unable to turn right
+        if next_edge < 0:  # e.g. it may be unable to turn right
             reward += invalid_action_reward
             next_state = current_state
             next_edge = current_edge
 
         # Case 2. Valid Action
         else:
-            next_edge = self.env.decode_edges_action_to_edge(outgoing_edges, action)
-            next_state = self.env.decode_edge_to_node(next_edge, direction = 'end')
+            next_edge = int(next_edge)
+            next_state = int(self.graph.edge_to[next_edge])
 
             # Case 2-1. End Node
-            if next_state in self.env.end_node:
+            if next_state == self.end_index:
                 reward += completion_reward
                 is_terminate = True
 
                 # check if the route is the shortest distance/time
-                if self.env.evaluation in ("time"):
-                    current_result = self.env.get_edge_time(edge_path + [next_edge]) + self.env.get_tl_offset(edge_path + [next_edge])
-                else:
-                    current_result = self.env.get_edge_distance(edge_path + [next_edge])
+                current_result = self.route.cost_with(next_edge)  # the running cost of the episode, plus next_edge
 
                 if self.best_result == 0:
                     self.best_result = current_result
                 elif current_result < self.best_result:
                     for edge in edge_path:
-                        state_index = self.env.state_space.index(self.env.decode_edge_to_node(edge, direction = 'start'))
-                        action_index = self.env.edge_label[edge]
-                        self.q_table[state_index][action_index] += bonus_reward
+                        self.q_table[self.graph.edge_from[edge], self.graph.edge_label[edge]] += bonus_reward
                     self.best_result = current_result
 
             # Case 2-2. Dead-end Route
-            elif not self.env.decode_node_to_edges(next_state, direction = 'outgoing'):
+            elif self.graph.dead_end[next_state]:
                 reward += dead_end_reward
                 is_terminate = True
 
                 # Backtrack and find bottleneck
                 for edge in reversed(edge_path):
-                    if len(self.env.decode_node_to_edges(self.env.decode_edge_to_node(edge, direction = 'end'), direction = 'outgoing')) > 1:
+                    if self.graph.out_degree[self.graph.edge_to[edge]] > 1:
                         break
 
-                    state_index = self.env.state_space.index(self.env.decode_edge_to_node(edge, direction = 'start'))
-                    action_index = self.env.edge_label[edge]
-                    self.q_table[state_index][action_index] += dead_end_reward
+                    self.q_table[self.graph.edge_from[edge], self.graph.edge_label[edge]] += dead_end_reward
 
             # Case 2-3. Travelling
             elif current_edge != None:
                 # Case 2-4. Travelling in a loop
-                if (current_edge, next_edge) in [(edge_path[i], edge_path[i+1]) for i in range(len(edge_path)-1)]:
+                if (current_edge, next_edge) in self.travelled_pairs:
                     reward += loop_reward
 
         return next_edge, next_state, reward, is_terminate  # return the next state, reward and is_terminate
@@ -117,28 +152,68 @@ class rl_agent():
     # Update the Q-table
     def learn(self, current_state, action, next_state, reward):
         # 1. Get original Q-value
-        q_predict = self.q_table[self.env.state_space.index(current_state)][action]
+        q_predict = self.q_table[current_state, action]
 
         # 2. Calculate how much Q-value should change
         # ---------------------------------- #
         # Q(S,a) = R + gamma * max(Q(S',a')  #
         # ---------------------------------- #
-        q_target = reward + self.discount_factor * np.max(self.q_table[self.env.state_space.index(next_state)])
+        q_target = reward + self.discount_factor * np.max(self.q_table[next_state])
         # what we need is to find the max one from all q_table[next_state][action]
 
         # 3. Update Q-value practically
         # -------------------------------------------------------------- #
         # Q(S,a) = Q(S,a) + alpha * (R + gamma * max(Q(S',a') - Q(S,a))  #
         # -------------------------------------------------------------- #
-        self.q_table[self.env.state_space.index(current_state)][action] += self.learning_rate * (q_target - q_predict)
+        self.q_table[current_state, action] += self.learning_rate * (q_target - q_predict)
+
+
+    # act(), step() and learn() of train(), timed and counted in metrics
+    def measured_step(self, metrics, last_state, node_path, edge_path):
+        """
+        Args:
+        - metrics (instrument.metrics): Where to count and time
+        - last_state (int): The node index the agent is at
+        - node_path, edge_path (list): The episode so far
+
+        Returns:
+        - Same as step()
+        """
+
+        start_time = time.perf_counter()
+        action = self.act(last_state)
+        act_time = time.perf_counter()
+        next_edge, next_state, reward, is_terminate = self.step(action, node_path, edge_path)
+        step_time = time.perf_counter()
+        self.learn(last_state, action, next_state, reward)
+        end_time = time.perf_counter()
+        metrics.add_time('act', act_time - start_time)
+        metrics.add_time('step', step_time - act_time)
+        metrics.add_time('learn', end_time - step_time)
+
+        # Outcome of the step, as rewarded by step()
+        metrics.count('steps')
+        if next_state == last_state:
+            metrics.count('invalid_actions')
+        elif next_state == self.end_index:
+            metrics.count('completions')
+        elif is_terminate:
+            metrics.count('dead_ends')
+        elif edge_path and (edge_path[-1], next_edge) in self.travelled_pairs:
+            metrics.count('loops')
+        return next_edge, next_state, reward, is_terminate
 
 
     # Main function implemented
-    def train(self, num_episodes, threshold):
+    def train(self, num_episodes, threshold, q_table = None):
+        if threshold < 1:
+            sys.exit('Error: Invalid threshold, provide at least 1 ...call by train')
         print('Training Start...')
         start_time = datetime.datetime.now() # record the start time
-        self.reset()  # initialise agent
-
+        self.reset(q_table)  # initialise agent, from q_table if given (e.g. load_q_table() before a congestion update)
+        self.num_episodes = num_episodes
+        window = collections.deque(maxlen=threshold)  # time taken in the last episodes, rounded
+        metrics = self.env.metrics  # instrument.metrics, None unless instrumented
 
         # Iterate through episodes
         for episode in range(num_episodes):
@@ -146,81 +221,380 @@ class rl_agent():
             print_progress_bar(episode, num_episodes)
 
             # Initialise state
-            node_path = [self.env.start_node]
+            node_path = [self.start_index]
             edge_path = []
             is_terminate = False
+            self.travelled_pairs = set()
+            self.route = self.env.new_route()
 
             # Iterate until reach the assigned terminate
             while True:
                 last_state = node_path[-1]
-                if is_terminate or last_state in self.env.end_node:
+                if is_terminate or last_state == self.end_index:
                     break
 
-                # Decide the action
-                action = self.act(last_state)
+                if metrics is None:
+                    # Decide the action
+                    action = self.act(last_state)
 
-                # Take the action and observe the outcome
-                next_edge, next_state, reward, is_terminate = self.step(action, node_path, edge_path)
+                    # Take the action and observe the outcome
+                    next_edge, next_state, reward, is_terminate = self.step(action, node_path, edge_path)
 
-                # Learn from the outcome by updating Q-table
-                self.learn(last_state, action, next_state, reward)
+                    # Learn from the outcome by updating Q-table
+                    self.learn(last_state, action, next_state, reward)
+                else:  # the same, timed and counted
+                    next_edge, next_state, reward, is_terminate = self.measured_step(metrics, last_state, node_path, edge_path)
+                self.steps += 1
 
                 # Update state
                 if last_state != next_state:  # last_state == next_state only if the action is not valid
+                    if edge_path:
+                        self.travelled_pairs.add((edge_path[-1], next_edge))
                     edge_path.append(next_edge)
                     node_path.append(next_state)
+                    if metrics is None:
+                        self.route.append(next_edge)
+                    else:
+                        start_time_evaluate = time.perf_counter()
+                        self.route.append(next_edge)
+                        metrics.add_time('evaluate', time.perf_counter() - start_time_evaluate)
 
-            # Append to logs
-            self.logs[episode] = [node_path, edge_path]
+            # Append to logs, as edge indices and costs
+            self.logs.append(edge_path, self.route.cost("time"), self.route.distance)
+            window.append(round(self.route.cost("time"), 2))  # as get_edge_time() + get_tl_offset(), computed once per episode
+            if metrics is not None:
+                metrics.count('episodes')
+                metrics.tick()
 
             # Deal with convergence: > threshold to make same results for needed times, and make sure reach the end node
-            if episode > threshold and self.logs[episode][0][-1] == self.env.end_node:
-
-                # Convergence when time taken in 5 episodes is consistent
-                threshold_lst = []
-                for i in range(threshold):
-                    threshold_lst.append(round(self.env.get_edge_time(self.logs[episode-i][1]) + self.env.get_tl_offset(self.logs[episode-i][1]), 2))
-
-                if all(x == threshold_lst[0] for x in threshold_lst):
-                    end_time = datetime.datetime.now()  # record ending time
-                    time_difference = end_time - start_time
-                    processing_seconds = time_difference.total_seconds()
-
-                    # --- results output ---
-                    print('\nTraining Completed...\n')
-                    print(f'-- Last Episode: {episode}\n')
-                    print(f'-- States: {self.logs[episode][0]}\n')
-                    print(f'-- Edges: {self.logs[episode][1]}\n')
-                    print(f'-- Processing Time: {processing_seconds} seconds')
-
-                    if self.env.evaluation in ("time"):
-                        print(f'-- Travelled Time: {round((self.env.get_edge_time(self.logs[episode][1]) + self.env.get_tl_offset(self.logs[episode][1]))/60, 2)} mins')
-                    else:
-                        print(f'-- Travelled Distance: {round(self.env.get_edge_distance(self.logs[episode][1]), 2)} m')
+            if episode > threshold and node_path[-1] == self.end_index:
 
-                    return self.logs[episode][0], self.logs[episode][1], episode, self.logs
+                # Convergence when time taken in threshold episodes is consistent
+                if window.count(window[0]) == threshold:
+                    return self.training_completed(start_time, episode)
 
 
             # Deal with the case that it is unable to converge
             if episode+1 == num_episodes:
-                print('\nTraining Completed...\n')
-                end_time = datetime.datetime.now()
-                time_difference = end_time - start_time
-                processing_seconds = time_difference.total_seconds()
-                print(f'-- Processing Time: {processing_seconds} seconds')
-                self.env.plot_performance(episode, self.logs)  # still print the plot_performance even if not converge
-                sys.exit(f'Cannot find shortest route within {num_episodes} episodes')
+                self.training_failed(start_time, episode, num_episodes)
+
+
+    # Vectorised counterpart of act(), for train_batch()
+    def act_batch(self, states):
+        # Choose action with highest Q-value, ties broken at random so that the episodes of a batch do not move in lockstep
+        q_values = self.q_table[states]
+        is_best = q_values == q_values.max(axis=1, keepdims=True)
+        return np.argmax(np.where(is_best, self.rng.random(q_values.shape), -1), axis=1)
+
+
+    # Batched training: advance batch_size independent episodes at once
+    def train_batch(self, num_episodes, threshold, batch_size = 32, q_table = None):
+        """
+        Same rewards and convergence criterion as train(), but batch_size episodes run side by side,
+        each tick taking one step in every episode with NumPy operations.
+
+        - Episodes are numbered in the order they finish, and convergence is checked on that order.
+        - Q-updates of a tick are computed from the Q-table before the tick (synchronous update).
+          When several episodes update the same (state, action) in one tick, their TD errors are averaged.
+        - A loop is travelling an edge from the same edge it was last travelled from in the episode.
+        - Greedy ties are broken at random, and episodes terminating in the same tick count once towards convergence.
+
+        Args:
+        - num_episodes (int): The limit of episodes
+        - threshold (int): The number of consistent episodes to converge
+        - batch_size (int): The number of episodes in flight
+        - q_table (np.ndarray or None): The Q-table to start from, as for train()
+
+        Returns:
+        - Same as train()
+        """
+
+        if threshold < 1:
+            sys.exit('Error: Invalid threshold, provide at least 1 ...call by train_batch')
+        print('Training Start...')
+        start_time = datetime.datetime.now() # record the start time
+        self.reset(q_table)  # initialise agent
+        self.num_episodes = num_episodes
+
+        graph = self.graph
+        invalid_action_reward, dead_end_reward, loop_reward, completion_reward, bonus_reward, continue_reward = self.reward_lst
+
+        # 1. Episode slots, a slot starts a new episode as soon as its episode terminates
+        batch_size = max(1, min(batch_size, num_episodes))
+        slots = np.arange(batch_size)
+        states = np.full(batch_size, self.start_index, dtype=np.int32)
+        last_edges = np.full(batch_size, -1, dtype=np.int32)
+        paths = np.zeros((batch_size, 64), dtype=np.int32)  # edge indices travelled by each slot
+        lengths = np.zeros(batch_size, dtype=np.int32)
+        came_from = {}  # [slot * num_edges + edge] = the edge it was last travelled from in the episode of slot, only edges travelled are kept
+        slot_offset = np.arange(batch_size, dtype=np.int64) * graph.num_edges
+        edge_cost = self.env.get_edge_costs("time")
+        profiles = self.env.profiles
+        penalty = self.env.congestion_penalty
+        departure_time = self.env.departure_time
+        ends_at_light = self.env.tl_node_mask[graph.edge_to]
+        route_time = np.zeros(batch_size)  # running get_edge_time() + get_tl_offset() of each slot, also its clock as in env.new_route()
+        route_distance = np.zeros(batch_size)
+        window = collections.deque(maxlen=threshold)  # time taken in the last ticks that terminated episodes
+        episode = -1
+        metrics = self.env.metrics  # instrument.metrics, None unless instrumented
+
+        def measure(phase, since):
+            # Time since the last phase ended
+            now = time.perf_counter()
+            metrics.add_time(phase, now - since)
+            return now
+
+        while True:
+            # 2. Decide the actions and look up the transitions
+            if metrics is not None:
+                lap = time.perf_counter()
+            actions = self.act_batch(states)
+            self.steps += batch_size
+            if metrics is not None:
+                lap = measure('act', lap)
+            next_edges = graph.transition_edge[states, actions]
+            valid = next_edges >= 0
+            next_states = np.where(valid, graph.edge_to[next_edges], states)
+
+            completed = valid & (next_states == self.end_index)
+            dead_ended = valid & ~completed & graph.dead_end[next_states]
+            looped = np.zeros(batch_size, dtype=bool)
+            travelling = np.flatnonzero(valid & ~completed & ~dead_ended & (last_edges >= 0))
+            if came_from and travelling.size:
+                came_from_get = came_from.get
+                previous = [came_from_get(key, -2) for key in (slot_offset[travelling] + next_edges[travelling]).tolist()]
+                looped[travelling] = np.array(previous) == last_edges[travelling]
+
+            rewards = np.full(batch_size, float(continue_reward))
+            rewards[~valid] += invalid_action_reward
+            rewards[completed] += completion_reward
+            rewards[dead_ended] += dead_end_reward
+            rewards[looped] += loop_reward
+            if metrics is not None:
+                metrics.count('steps', batch_size)
+                metrics.count('invalid_actions', int(batch_size - valid.sum()))
+                metrics.count('completions', int(completed.sum()))
+                metrics.count('dead_ends', int(dead_ended.sum()))
+                metrics.count('loops', int(looped.sum()))
+                lap = measure('step', lap)
+
+            # 3. Running costs of the episodes moved, lights only looked up where the last edge may end at one
+            moved = np.flatnonzero(valid)
+            lit = moved[ends_at_light[last_edges[moved]] & (last_edges[moved] >= 0)]
+            if lit.size:
+                route_time[lit] += self.env.signals.get_waits(last_edges[lit], next_edges[lit], departure_time + route_time[lit])
+            if profiles is None:
+                route_time[moved] += edge_cost[next_edges[moved]]
+            else:  # the speed of the edge at the time it is entered
+                route_time[moved] += profiles.travel_time(graph.edge_time, next_edges[moved], departure_time + route_time[moved]) + penalty[next_edges[moved]]
+            route_distance[moved] += graph.edge_length[next_edges[moved]]
+            if metrics is not None:
+                lap = measure('evaluate', lap)
+
+            # 4. Bonus and bottleneck penalties of terminated episodes, on their paths before this step
+            for slot in np.flatnonzero(completed | dead_ended).tolist():
+                edge_path = paths[slot, :lengths[slot]]
+                if completed[slot]:
+                    current_result = route_time[slot] if self.env.evaluation in ("time") else route_distance[slot]
+                    if self.best_result == 0:
+                        self.best_result = current_result
+                    elif current_result < self.best_result:
+                        np.add.at(self.q_table, (graph.edge_from[edge_path], graph.edge_label[edge_path]), bonus_reward)
+                        self.best_result = current_result
+                else:
+                    for edge in reversed(edge_path.tolist()):
+                        if graph.out_degree[graph.edge_to[edge]] > 1:
+                            break
+                        self.q_table[graph.edge_from[edge], graph.edge_label[edge]] += dead_end_reward
+
+            # 5. Learn, TD errors of the same (state, action) are averaged
+            if metrics is not None:
+                lap = measure('step', lap)
+            q_predict = self.q_table[states, actions]
+            q_target = rewards + self.discount_factor * np.max(self.q_table[next_states], axis=1)
+            flat_index = states.astype(np.int64) * self.q_table.shape[1] + actions
+            unique_index, inverse = np.unique(flat_index, return_inverse=True)
+            td_error = np.bincount(inverse, weights=q_target - q_predict) / np.bincount(inverse)
+            self.q_table.reshape(-1)[unique_index] += self.learning_rate * td_error
+            if metrics is not None:
+                lap = measure('learn', lap)
+
+            # 6. Move the episodes along valid actions
+            if lengths.max() + 1 >= paths.shape[1]:
+                paths = np.concatenate((paths, np.zeros_like(paths)), axis=1)
+            came_from.update(zip((slot_offset[moved] + next_edges[moved]).tolist(), last_edges[moved].tolist()))
+            paths[moved, lengths[moved]] = next_edges[moved]
+            lengths[moved] += 1
+            states[moved] = next_states[moved]
+            last_edges[moved] = next_edges[moved]
+
+            # 7. Log terminated episodes and restart their slots
+            terminated = np.flatnonzero(completed | dead_ended).tolist()
+            del terminated[num_episodes - (episode+1):]  # only the episodes left of num_episodes count
+            tick_costs = set()
+            for slot in terminated:
+                episode += 1
+                print_progress_bar(episode, num_episodes)
+                self.logs.append(paths[slot, :lengths[slot]], route_time[slot], route_distance[slot])
+                tick_costs.add(round(float(route_time[slot]), 2))
+
+                # Reset the slot for its next episode
+                for key in (slot_offset[slot] + paths[slot, :lengths[slot]]).tolist():
+                    came_from.pop(key, None)
+                lengths[slot] = 0
+                states[slot] = self.start_index
+                last_edges[slot] = -1
+                route_time[slot] = route_distance[slot] = 0
+            if metrics is not None:
+                measure('step', lap)
+                metrics.count('episodes', len(terminated))
+                metrics.tick()
+
+            # 8. Convergence when the time taken is consistent over threshold ticks that terminated episodes.
+            #    Episodes finishing in the same tick could not learn from each other, so they count once
+            if terminated:
+                window.append(tick_costs.pop() if len(tick_costs) == 1 else None)
+                if episode > threshold and completed[terminated[-1]] and len(window) == threshold and window[0] is not None and window.count(window[0]) == threshold:
+                    return self.training_completed(start_time, episode)
+
+            # 9. Deal with the case that it is unable to converge, after the convergence check as in train()
+            if episode+1 == num_episodes:
+                self.training_failed(start_time, episode, num_episodes)
+
+
+    def heuristic_q_table(self, evaluation = None):
+        """
+        Q-table seeded with minus the cost to go to end_node through each action, from one reverse search,
+        so that the greedy route of the first episode is already the shortest one on these costs.
+        As an initialisation it is potential-based shaping: the update rule and the rewards are unchanged.
+
+        The costs are divided by the largest one, so that the seeds lie in [-1, 0] and stay small against
+        the rewards: a loop or a dead end still outweighs any difference of cost between two actions.
+
+        Args:
+        - evaluation (str or None): "distance" or "time", the costs of env.get_edge_costs(), defaults to env.evaluation
+
+        Returns:
+        - q_table (np.ndarray [states, actions]): -(edge cost + cost to go from the end of the edge) / largest of them
+            for every valid action. Invalid actions and actions that cannot reach end_node get -1 + invalid_action_reward
+        """
+
+        # 1. Cost to go of every node, Dijkstra from end_node on the reversed edges
+        _, _, in_ptr, in_edges, edge_from, _ = self.graph.adjacency_lists()
+        edge_costs = self.env.get_edge_costs(evaluation)
+        cost_to_go, _ = dijkstra.one_to_all(in_ptr, in_edges, edge_from, edge_costs, self.end_index)
+
+        # 2. Through each action
+        transition_edge = self.graph.transition_edge
+        valid = transition_edge >= 0
+        edges = np.where(valid, transition_edge, 0)
+        cost = edge_costs[edges] + np.asarray(cost_to_go)[self.graph.edge_to[edges]]
+        reachable = valid & np.isfinite(cost)
+        largest = cost[reachable].max() if reachable.any() else 1
+        return np.where(reachable, -cost / (largest or 1), -1 + self.reward_lst[0])
+
+
+    def q_table_key(self):
+        """
+        Returns:
+        - The key (str) a Q-table is stored under: the network, end node, evaluation type and rewards it was learnt with.
+            The congestion is left out, so that a table can warm-start training after a congestion update
+        """
+
+        settings = json.dumps([self.graph.digest(), self.env.end_node, self.env.evaluation, [float(reward) for reward in self.reward_lst]])
+        return hashlib.sha1(settings.encode()).hexdigest()
+
+
+    def save_q_table(self, directory = './q_tables'):
+        """
+        Save the Q-table as .npy under q_table_key(), replacing any previous one atomically so that readers never see a partial file
+
+        Args:
+        - directory (str): The folder of the tables
+
+        Returns:
+        - file_name (str): The file written
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        file_name = os.path.join(directory, f'{self.q_table_key()}.npy')
+        temp_name = f'{file_name}.{os.getpid()}.tmp'
+        with open(temp_name, 'wb') as file:
+            np.save(file, np.asarray(self.q_table, dtype=np.float64))
+        os.replace(temp_name, file_name)
+        return file_name
+
+
+    def load_q_table(self, directory = './q_tables', mmap_mode = 'c'):
+        """
+        Map the Q-table saved for this agent's settings, to be passed to train(q_table=...)
+
+        Args:
+        - directory (str): The folder of the tables
+        - mmap_mode (str): 'c' to train on it copy-on-write, 'r' to only read it (then train() copies it), as numpy.load()
+
+        Returns:
+        - q_table (np.memmap or None): None if no table is saved for these settings
+        """
+
+        file_name = os.path.join(directory, f'{self.q_table_key()}.npy')
+        if not os.path.exists(file_name):
+            return None
+        return np.load(file_name, mmap_mode=mmap_mode)
+
+
+    def training_completed(self, start_time, episode):
+        # Report the converged episode and return it as train() does
+        end_time = datetime.datetime.now()  # record ending time
+        time_difference = end_time - start_time
+        processing_seconds = time_difference.total_seconds()
+
+        # --- results output ---
+        print_progress_bar(episode, self.num_episodes, force=True)  # the last redraw may be older than the end
+        self.logs.close()
+        if self.env.metrics is not None:
+            self.env.metrics.tick(force=True)
+        node_path, edge_path = self.logs[episode]
+        print('\nTraining Completed...\n')
+        print(f'-- Last Episode: {episode}\n')
+        print(f'-- States: {node_path}\n')
+        print(f'-- Edges: {edge_path}\n')
+        print(f'-- Processing Time: {processing_seconds} seconds')
+
+        if self.env.evaluation in ("time"):
+            print(f'-- Travelled Time: {round((self.env.get_edge_time(edge_path) + self.env.get_tl_offset(edge_path))/60, 2)} mins')
+        else:
+            print(f'-- Travelled Distance: {round(self.env.get_edge_distance(edge_path), 2)} m')
+
+        return node_path, edge_path, episode, self.logs
+
+
+    def training_failed(self, start_time, episode, num_episodes):
+        # Report the failure to converge and exit as train() does
+        print_progress_bar(episode + 1, num_episodes, force=True)
+        if self.env.metrics is not None:
+            self.env.metrics.tick(force=True)
+        print('\nTraining Completed...\n')
+        end_time = datetime.datetime.now()
+        time_difference = end_time - start_time
+        processing_seconds = time_difference.total_seconds()
+        print(f'-- Processing Time: {processing_seconds} seconds')
+        self.logs.close()
+        self.env.plot_performance(episode, self.logs)  # still print the plot_performance even if not converge
+        sys.exit(f'Cannot find shortest route within {num_episodes} episodes')
 
 
 class Q_Learning(rl_agent):
-    def __init__ (self, env, start_node, end_node):
+    def __init__ (self, env, start_node, end_node, learning_rate = 0.9, discount_factor = 0.1, reward_lst = None, seed = None):
 
         # --------------------------
-        # Hyperparameters
+        # Hyperparameters, defaults in the signature
         # --------------------------
-        learning_rate = 0.9  # alpha
-        discount_factor = 0.1  # gamma
-        reward_lst = [-50, -50, -30, 50, 50, 0]
+        # learning_rate = 0.9  # alpha
+        # discount_factor = 0.1  # gamma
+        if reward_lst is None:
+            reward_lst = [-50, -50, -30, 50, 50, 0]
         # --------------------------
         #
         # --------------------------
@@ -237,42 +611,381 @@ class Q_Learning(rl_agent):
             3. completion_reward, defualt 50
             4. bonus_reward: is the shortest one so far, default 50
             5. continue_reward: make agent be aggresive on go straight, defualt 0
+        - seed (int or None): seed of the agent's numpy.random.Generator
         """
 
 
-        super().__init__(env, start_node, end_node, learning_rate, discount_factor, reward_lst)
+        super().__init__(env, start_node, end_node, learning_rate, discount_factor, reward_lst, seed)
 
     def act(self, state):
         # Choose action with highest Q-value
-        state_index = self.env.state_space.index(state)
-        action = np.argmax(self.q_table[state_index])
+        action = np.argmax(self.q_table[state])
         return action
 
 
 class SARSA(rl_agent):
-    def __init__ (self, env, start_node, end_node):
+    def __init__ (self, env, start_node, end_node, learning_rate = 0.9, discount_factor = 0.1, exploration_rate = 0.1, reward_lst = None, seed = None):
 
         # --------------------------
-        # Hyperparameters
+        # Hyperparameters, defaults in the signature
         # --------------------------
-        learning_rate = 0.9  # alpha
-        discount_factor = 0.1  # gamma
-        exploration_rate = 0.1  # ratio of exploration and exploitation
-        reward_lst = [-50, -50, -30, 50, 50, 0]  # similar to Q_Learning one
+        # learning_rate = 0.9  # alpha
+        # discount_factor = 0.1  # gamma
+        # exploration_rate = 0.1  # ratio of exploration and exploitation
+        if reward_lst is None:
+            reward_lst = [-50, -50, -30, 50, 50, 0]  # similar to Q_Learning one
         # --------------------------
         #
         # --------------------------
 
-        super().__init__(env, start_node, end_node, learning_rate, discount_factor, reward_lst)
+        super().__init__(env, start_node, end_node, learning_rate, discount_factor, reward_lst, seed)
         self.exploration_rate = exploration_rate
 
 
     def act(self, state):
-        if np.random.random() < self.exploration_rate:
+        if self.rng.random() < self.exploration_rate:
             # Exploration
-            action = np.random.choice(len(self.env.action_space))
+            action = self.rng.integers(len(self.env.action_space))
         else:
             # Exploitation
-            state_index = self.env.state_space.index(state)
-            action = np.argmax(self.q_table[state_index])
+            action = np.argmax(self.q_table[state])
+        return action
+
+
+    def act_batch(self, states):
+        actions = super().act_batch(states)  # Exploitation
+        explore = self.rng.random(len(states)) < self.exploration_rate  # Exploration
+        actions[explore] = self.rng.integers(len(self.env.action_space), size=int(explore.sum()))
+        return actions
+
+
+class Prioritized_Sweeping(rl_agent):
+    def __init__ (self, env, start_node, end_node, learning_rate = 0.9, discount_factor = 0.1, planning_steps = 5, priority_threshold = 1e-4, reward_lst = None, seed = None):
+        """
+        Q_Learning with a learned model of the transitions and planning updates by prioritized sweeping (Dyna-Q).
+
+        Every real step records its reward and next state in the model, as the last observed ones: the next
+        state of an action is fixed by the network, and the rewards of step() only depend on where it leads,
+        but for loops and bonuses. After the real update, the (state, action) leading into the state just
+        updated are queued by their TD error, and up to planning_steps of the largest are updated from the
+        model, each queueing its own predecessors in turn. Only train() plans, train_batch() is that of Q_Learning.
+
+        A (state, action) is queued once, at its largest TD error: a larger one replaces its entry in the heap,
+        the stale entry is skipped when popped, and the heap is rebuilt when stale entries outnumber the live ones,
+        so it stays within about twice the size of the model. Invalid actions, which leave the agent where it was,
+        are not recorded: planning them would only repeat their penalty.
+
+        Args:
+        - learning_rate, discount_factor, reward_lst, seed: As for Q_Learning
+        - planning_steps (int): The model updates after every real step, 0 for Q_Learning
+        - priority_threshold (float): The smallest TD error queued
+        """
+
+        if reward_lst is None:
+            reward_lst = [-50, -50, -30, 50, 50, 0]  # same as Q_Learning
+        super().__init__(env, start_node, end_node, learning_rate, discount_factor, reward_lst, seed)
+        self.planning_steps = planning_steps
+        self.priority_threshold = priority_threshold
+
+
+    def reset(self, q_table = None):
+        super().reset(q_table)
+        self.model = {}  # (state, action) -> (reward, next_state), as last observed
+        self.predecessors = collections.defaultdict(set)  # next_state -> {(state, action)} of the model
+        self.queue = []  # heap of (-priority, state, action), entries not in priorities are stale
+        self.priorities = {}  # (state, action) -> priority of its live entry in queue
+        self.planning_updates = 0
+
+
+    def act(self, state):
+        # Choose action with highest Q-value
+        action = np.argmax(self.q_table[state])
         return action
+
+
+    def queue_predecessors(self, state):
+        # Queue the (state, action) of the model leading into state by their TD error
+        q_table = self.q_table
+        value = q_table[state].max()
+        for last_state, action in self.predecessors[state]:
+            reward, _ = self.model[last_state, action]
+            priority = abs(reward + self.discount_factor * value - q_table[last_state, action])
+            if priority > self.priority_threshold and priority > self.priorities.get((last_state, action), 0):
+                self.priorities[last_state, action] = priority
+                heapq.heappush(self.queue, (-priority, last_state, action))
+
+        # Drop the stale entries once they outnumber the live ones
+        if len(self.queue) > 2 * len(self.priorities) + 64:
+            self.queue = [(-priority, last_state, action) for (last_state, action), priority in self.priorities.items()]
+            heapq.heapify(self.queue)
+
+
+    def learn(self, current_state, action, next_state, reward):
+        # 1. Real update, as Q_Learning
+        super().learn(current_state, action, next_state, reward)
+
+        # 2. Learn the model, but for invalid actions that stay in current_state
+        if next_state != current_state:
+            self.model[current_state, action] = (reward, next_state)
+            self.predecessors[next_state].add((current_state, action))
+        self.queue_predecessors(current_state)
+
+        # 3. Planning, the largest TD errors first, each the update of learn() on the model
+        q_table = self.q_table
+        planned = 0
+        while planned < self.planning_steps and self.queue:
+            priority, state, planned_action = heapq.heappop(self.queue)
+            if self.priorities.get((state, planned_action)) != -priority:  # replaced by a larger priority
+                continue
+            del self.priorities[state, planned_action]
+            planned += 1
+            planned_reward, planned_next_state = self.model[state, planned_action]
+            q_target = planned_reward + self.discount_factor * q_table[planned_next_state].max()
+            q_table[state, planned_action] += self.learning_rate * (q_target - q_table[state, planned_action])
+            self.planning_updates += 1
+            self.queue_predecessors(state)
+
+
+class Multi_Goal_Q_Learning():
+    UNREACHABLE = -1e9  # value of invalid actions and of states the goal cannot be reached from
+
+    def __init__ (self, env, goals = None, learning_rate = 1.0, exploration_rate = 0.1, evaluation = None, seed = None):
+        """
+        Goal-conditioned Q-learning of many destinations at once, Q(goal, state, action) in one float32 table.
+
+        Q(goal, state, action) is minus the cost to go to goal through action, so every transition taken
+        updates the values of all goals together: the move, its edge cost and its next state do not depend
+        on the goal, only the end of the episode does. One training then answers route() to any of the goals
+        with one table lookup per step, without training again.
+
+        The reward of a step is minus the cost of its edge, env.get_edge_costs(evaluation) at the start of
+        train(), with no discount. The waits at red lights depend on the arrival time, not on the state, so
+        they are left out of the values. Invalid actions are masked instead of punished, and a dead end is
+        worth UNREACHABLE, so that reward_lst has no use here.
+
+        Args:
+        - env (traffic_env): The environment
+        - goals (list or None): The destination node IDs, None for every node
+        - learning_rate (float): alpha, 1.0 as the transitions are deterministic
+        - exploration_rate (float): The share of random valid actions
+        - evaluation (str or None): "distance" or "time", defaults to env.evaluation
+        - seed (int or None): seed of the agent's numpy.random.Generator
+        """
+
+        self.env = env
+        self.graph = env.graph
+        self.learning_rate = learning_rate
+        self.exploration_rate = exploration_rate
+        self.evaluation = evaluation or env.evaluation
+        self.rng = np.random.default_rng(seed)
+
+        if goals is None:
+            goals = env.nodes
+        for node in goals:
+            if node not in env.node_index:
+                sys.exit(f'Error: Invalid goal {node} ...call by Multi_Goal_Q_Learning')
+        self.goals = list(dict.fromkeys(goals))
+        self.goal_nodes = np.array([env.node_index[node] for node in self.goals], dtype=np.int32)  # goal slot -> node index
+        self.goal_slot = {node: slot for slot, node in enumerate(self.goals)}
+
+        self.valid = self.graph.transition_edge >= 0  # [state, action]
+        self.q_table = None
+
+
+    def reset(self, q_table = None):
+        shape = (len(self.goals), len(self.env.state_space), len(self.env.action_space))
+        if q_table is None:
+            # 0 is optimistic, every true value is a cost to go <= 0, so the greedy walks explore by themselves
+            self.q_table = np.empty(shape, dtype=np.float32)
+            self.q_table[:] = np.where(self.valid, 0, self.UNREACHABLE)
+        else:  # warm start
+            if q_table.shape != shape:
+                sys.exit(f'Error: Invalid q_table shape {q_table.shape} ...call by reset')
+            self.q_table = np.array(q_table, dtype=np.float32)
+        self.steps = 0
+
+
+    def act_batch(self, slots, states):
+        # Greedy on the values of each walker's goal, ties broken at random, else a random valid action
+        q_values = self.q_table[slots, states]
+        is_best = q_values == q_values.max(axis=1, keepdims=True)
+        actions = np.argmax(np.where(is_best, self.rng.random(q_values.shape), -1), axis=1)
+        explore = self.rng.random(len(states)) < self.exploration_rate
+        if explore.any():
+            choices = np.where(self.valid[states[explore]], self.rng.random((int(explore.sum()), q_values.shape[1])), -1)
+            actions[explore] = np.argmax(choices, axis=1)
+        return actions
+
+
+    def greedy_path(self, start_index, slot):
+        """
+        Follow the table from start_index to the goal of slot, one lookup per step
+
+        Returns:
+        - edge_path (list or None): The edge indices, None if the walk dead-ends or loops
+        """
+
+        goal_index = int(self.goal_nodes[slot])
+        q_values = self.q_table[slot]
+        transition_edge = self.graph.transition_edge
+        edge_to = self.graph.edge_to
+        state, edge_path, visited = start_index, [], {start_index}
+        while state != goal_index:
+            action = int(np.argmax(q_values[state]))
+            if q_values[state, action] <= self.UNREACHABLE / 2:
+                return None
+            edge = int(transition_edge[state, action])
+            state = int(edge_to[edge])
+            if state in visited:
+                return None
+            visited.add(state)
+            edge_path.append(edge)
+        return edge_path
+
+
+    def route(self, start_node, end_node):
+        """
+        Route to a goal learned by train()
+
+        Args:
+        - start_node (str): Any node ID
+        - end_node (str): One of the goals
+
+        Returns:
+        - node_path (list): The node IDs
+        - edge_path (list): The edge IDs
+        """
+
+        if self.q_table is None:
+            sys.exit('Error: Not trained, call train() or reset(q_table) first ...call by route')
+        if start_node not in self.env.node_index:
+            sys.exit('Error: Invalid start node')
+        if end_node not in self.goal_slot:
+            sys.exit(f'Error: {end_node} is not one of the goals ...call by route')
+
+        edge_path = self.greedy_path(self.env.node_index[start_node], self.goal_slot[end_node])
+        if edge_path is None:
+            sys.exit(f'Cannot find a route from {start_node} to {end_node} in the table')
+        node_path = [start_node] + [self.env.nodes[index] for index in self.graph.edge_to[edge_path].tolist()]
+        return node_path, [self.env.edges[index] for index in edge_path]
+
+
+    def probe_costs(self, probes, edge_cost):
+        # Cost of the greedy route of each (start_index, slot), None where it is not reached
+        costs = []
+        for start_index, slot in probes:
+            edge_path = self.greedy_path(start_index, slot)
+            costs.append(None if edge_path is None else round(float(edge_cost[edge_path].sum()), 2))
+        return costs
+
+
+    def train(self, num_episodes, threshold, batch_size = 64, num_probes = 64, q_table = None):
+        """
+        Walk batch_size episodes side by side, each from a random node to a random goal, and update
+        Q(goal, state, action) of every goal at every (state, action) walked.
+
+        - An episode ends at its goal, at a dead end, or after as many steps as there are nodes.
+        - Every batch_size episodes, the greedy routes of num_probes seeded (start, goal) pairs are followed.
+          Training converges once all of them are reached at the same costs over threshold checks in a row.
+
+        Args:
+        - num_episodes (int): The limit of episodes, all goals together
+        - threshold (int): The number of consistent checks to converge
+        - batch_size (int): The number of episodes in flight
+        - num_probes (int): The number of (start, goal) pairs checked
+        - q_table (np.ndarray or None): The table [goals, states, actions] to start from
+
+        Returns:
+        - episode (int): The last episode
+        - probe_costs (list): The costs of the probed routes at convergence
+        """
+
+        if threshold < 1:
+            sys.exit('Error: Invalid threshold, provide at least 1 ...call by train')
+        print('Training Start...')
+        start_time = datetime.datetime.now()
+        self.reset(q_table)
+        self.num_episodes = num_episodes
+
+        graph = self.graph
+        num_states = len(self.env.state_space)
+        edge_cost = np.asarray(self.env.get_edge_costs(self.evaluation), dtype=np.float64)
+        step_reward = (-edge_cost).astype(np.float32)
+        goal_nodes = self.goal_nodes[:, None]
+        alpha = np.float32(self.learning_rate)
+
+        # 1. Probes, drawn once so that the checks compare the same routes, each goal reachable from its start
+        out_ptr, out_edges, _, _, _, edge_to = graph.adjacency_lists()
+        probes = []
+        for _ in range(100 * num_probes):
+            if len(probes) == num_probes:
+                break
+            start_index, slot = int(self.rng.integers(num_states)), int(self.rng.integers(len(self.goals)))
+            goal_index = int(self.goal_nodes[slot])
+            cost, _ = dijkstra.one_to_all(out_ptr, out_edges, edge_to, edge_cost, start_index, targets=[goal_index])
+            if start_index != goal_index and cost[goal_index] < float('inf'):
+                probes.append((start_index, slot))
+        window = collections.deque(maxlen=threshold)
+
+        # 2. Walkers, each restarted from a random node towards a random goal when its episode ends
+        batch_size = max(1, min(batch_size, num_episodes))
+        slots = self.rng.integers(len(self.goals), size=batch_size)
+        states = self.rng.integers(num_states, size=batch_size)
+        lengths = np.zeros(batch_size, dtype=np.int64)
+        episode, next_check = -1, batch_size
+
+        while True:
+            # 3. Step every walker
+            actions = self.act_batch(slots, states)
+            self.steps += batch_size
+            next_edges = graph.transition_edge[states, actions]
+            moved = next_edges >= 0  # False only at dead ends, where every action is invalid
+            next_states = np.where(moved, graph.edge_to[next_edges], states)
+
+            # 4. Learn for all goals: Q(g, s, a) <- -cost(a) + max Q(g, s', .), 0 past the goal
+            learn_states, learn_actions, learn_edges, learn_next = states[moved], actions[moved], next_edges[moved], next_states[moved]
+            next_values = self.q_table[:, learn_next].max(axis=2)  # [goals, walkers]
+            next_values[goal_nodes == learn_next[None]] = 0
+            q_target = np.maximum(step_reward[learn_edges][None] + next_values, self.UNREACHABLE)
+            q_predict = self.q_table[:, learn_states, learn_actions]
+            self.q_table[:, learn_states, learn_actions] = q_predict + alpha * (q_target - q_predict)
+
+            # 5. End the episodes at their goal, at a dead end or past the step limit, and restart their walkers
+            states = next_states
+            lengths += 1
+            terminated = np.flatnonzero((states == self.goal_nodes[slots]) | ~moved | (lengths >= num_states))
+            if terminated.size:
+                slots[terminated] = self.rng.integers(len(self.goals), size=terminated.size)
+                states[terminated] = self.rng.integers(num_states, size=terminated.size)
+                lengths[terminated] = 0
+                episode += terminated.size
+                print_progress_bar(min(episode + 1, num_episodes), num_episodes)
+
+            # 6. Convergence when the probed routes are all reached at the same costs over threshold checks
+            if episode + 1 >= next_check:
+                next_check += batch_size
+                costs = self.probe_costs(probes, edge_cost)
+                window.append(costs if None not in costs else None)
+                if len(window) == threshold and window[0] is not None and window.count(window[0]) == threshold:
+                    return self.training_completed(start_time, episode, window[0])
+
+            if episode + 1 >= num_episodes:
+                self.training_failed(start_time, episode, num_episodes)
+
+
+    def training_completed(self, start_time, episode, costs):
+        processing_seconds = (datetime.datetime.now() - start_time).total_seconds()
+        print_progress_bar(episode + 1, self.num_episodes, force=True)
+        print('\nTraining Completed...\n')
+        print(f'-- Last Episode: {episode}\n')
+        print(f'-- Goals: {len(self.goals)}\n')
+        print(f'-- Processing Time: {processing_seconds} seconds')
+        return episode, costs
+
+
+    def training_failed(self, start_time, episode, num_episodes):
+        print_progress_bar(num_episodes, num_episodes, force=True)
+        print('\nTraining Completed...\n')
+        processing_seconds = (datetime.datetime.now() - start_time).total_seconds()
+        print(f'-- Processing Time: {processing_seconds} seconds')
+        sys.exit(f'Cannot learn the routes to the goals within {num_episodes} episodes')
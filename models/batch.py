@@ -0,0 +1,207 @@
+import io
+import os
+import sys
+import json
+import time
+import contextlib
+import concurrent.futures
+
+
+# The environment loaded once by each worker of the pool
+_worker = {}
+
+ALGORITHMS = ('dijkstra', 'astar', 'bidirectional', 'bidirectional_astar', 'time_dependent', 'time_dependent_astar', 'qlearning', 'sarsa')
+
+
+def read_requests(input_file):
+    """
+    Stream the requests of a .jsonl file, one line at a time
+
+    Args:
+    - input_file (str): One JSON object per line, {"start_node": str, "end_node": str} and optionally "id",
+        blank lines are skipped
+
+    Yields:
+    - (line, request): The line number (int, from 1) and the request (dict), or the error (str) if the line is not a valid request
+    """
+
+    with open(input_file, 'r') as file:
+        for line, text in enumerate(file, 1):
+            if not text.strip():
+                continue
+            try:
+                request = json.loads(text)
+            except ValueError as error:
+                yield line, f'Invalid JSON: {error}'
+                continue
+            if not isinstance(request, dict) or 'start_node' not in request or 'end_node' not in request:
+                yield line, 'Invalid request, provide "start_node" and "end_node"'
+                continue
+            yield line, request
+
+
+def _load(env_args, algorithm, options):
+    # Pool initializer: one environment per worker, shared by all of its requests
+    import matplotlib
+    matplotlib.use('Agg')  # nothing to show in a worker, plot_performance() skips its plot
+
+    from models import environment
+    _bind(environment.worker_env(env_args), algorithm, options)
+
+
+def _bind(env, algorithm, options):
+    _worker['env'] = env
+    _worker['algorithm'] = algorithm
+    _worker['options'] = options
+
+
+def _reachable(env, start_node, end_node):
+    # Whether end_node can be reached from start_node, checked before training an agent on them
+    from models import dijkstra
+    if start_node not in env.node_index or end_node not in env.node_index:
+        return True  # left to the agent to report
+    out_ptr, out_edges, _, _, _, edge_to = env.graph.adjacency_lists()
+    end_index = env.node_index[end_node]
+    cost, _ = dijkstra.one_to_all(out_ptr, out_edges, edge_to, env.graph.edge_length, env.node_index[start_node], targets=[end_index])
+    return cost[end_index] < float('inf')
+
+
+def _route(task):
+    # Worker task: route one request, a failure is a result
+    line, request = task
+    env = _worker['env']
+    algorithm = _worker['algorithm']
+    options = _worker['options']
+    result = {'line': line, 'id': request.get('id'), 'start_node': request['start_node'], 'end_node': request['end_node'], 'algorithm': algorithm}
+
+    start_time = time.perf_counter()
+    node_path, edge_path, error = None, None, None
+    with contextlib.redirect_stdout(io.StringIO()):  # the searches and trainings report to stdout
+        try:
+            if algorithm in ('qlearning', 'sarsa'):
+                from models import agent
+                if not _reachable(env, request['start_node'], request['end_node']):  # the episodes would only end at dead ends
+                    raise SystemExit('Unreachable end node')
+                rl_class = agent.Q_Learning if algorithm == 'qlearning' else agent.SARSA
+                rl = rl_class(env, request['start_node'], request['end_node'], seed=request.get('seed', options['seed']))
+                if options['batch_size']:
+                    node_path, edge_path, episode, _ = rl.train_batch(options['num_episodes'], options['threshold'], options['batch_size'])
+                else:
+                    node_path, edge_path, episode, _ = rl.train(options['num_episodes'], options['threshold'])
+                result['episodes'] = episode + 1
+            else:
+                from models import dijkstra
+                node_path, edge_path = dijkstra.Dijkstra(env, request['start_node'], request['end_node'], mode=algorithm).search()
+        except SystemExit as stop:  # invalid node, or the agent did not converge
+            error = str(stop.code)
+        except Exception as failure:  # any other failure is the request's, the batch goes on
+            error = _error(failure)
+    compute_time = time.perf_counter() - start_time
+
+    # An unreachable end node gives an empty path, unless it is the start node
+    if error is None and not edge_path and request['start_node'] != request['end_node']:
+        error = 'Unreachable end node'
+    if error is None:
+        try:
+            edge_indices = env.get_edge_indices(edge_path, caller='run_batch')
+            return dict(
+                result,
+                status = 'ok',
+                node_path = node_path,
+                edge_path = edge_path,
+                cost = env.get_route_cost(edge_indices),
+                tl_offset = env.get_route_waits(edge_indices)[0],
+                compute_time = round(compute_time, 6),
+            )
+        except SystemExit as stop:
+            error = str(stop.code)
+        except Exception as failure:
+            error = _error(failure)
+    return dict(result, status='error', error=error, compute_time=round(compute_time, 6))
+
+
+def _error(failure):
+    # The error of a result, for an exception that is not one of the checks exiting with their message
+    return f'{type(failure).__name__}: {failure}'
+
+
+def run_batch(env, input_file, output_file, algorithm = 'dijkstra', processes = None, max_in_flight = None,
+              num_episodes = 5000, threshold = 5, batch_size = None, seed = None):
+    """
+    Route every request of a .jsonl file in a process pool and stream one result line per request as it finishes
+
+    The requests are read lazily and at most max_in_flight of them are queued in the pool at once,
+    so memory does not grow with the size of the input. Results come in the order they finish,
+    each carries the line number of its request.
+
+    Every worker reloads the environment once from env.network_file, with env's tls, congested edges,
+    speed profiles and evaluation, so that all requests see the same network.
+    With processes=1 the requests are routed on env itself, in order.
+
+    Args:
+    - env (traffic_env): The environment to route on
+    - input_file (str): .jsonl of requests, see read_requests()
+    - output_file (str): .jsonl, one line per request:
+        {line, id, start_node, end_node, algorithm, status: "ok", node_path, edge_path, cost, tl_offset, compute_time}
+        or {line, id, start_node, end_node, algorithm, status: "error", error, compute_time},
+        with episodes as well for the agents. cost is get_route_cost() under env.evaluation, tl_offset the red-light waits
+        in seconds, compute_time the seconds spent on the request
+    - algorithm (str): A search mode of Dijkstra ("dijkstra", "astar", ...), "qlearning" or "sarsa"
+    - processes (int or None): The size of the process pool, None for os.cpu_count(), 1 to route in this process
+    - max_in_flight (int or None): The number of requests queued in the pool at once, None for 4 per process
+    - num_episodes, threshold, batch_size: As for rl_agent.train() / train_batch(), for "qlearning" and "sarsa"
+    - seed (int or None): The seed of every agent, unless a request gives its own "seed"
+
+    Returns:
+    - summary (dict): The number of requests, ok and error results written
+    """
+
+    # 1. Check the inputs
+    if algorithm not in ALGORITHMS:
+        sys.exit(f'Error: Invalid algorithm, provide only {", ".join(ALGORITHMS)}')
+    if not os.path.isfile(input_file):
+        sys.exit(f'Error: Input file {input_file} not found')
+
+    options = {'num_episodes': num_episodes, 'threshold': threshold, 'batch_size': batch_size, 'seed': seed}
+    initargs = (env.worker_args(), algorithm, options)
+    processes = processes or os.cpu_count() or 1
+    max_in_flight = max(1, max_in_flight or 4 * processes)
+
+    # 2. Route, writing each result as soon as it comes back
+    print('Batch Start...')
+    start_time = time.perf_counter()
+    summary = {'requests': 0, 'ok': 0, 'error': 0}
+    with open(output_file, 'w') as file:
+
+        def write(row):
+            file.write(json.dumps(row) + '\n')
+            file.flush()
+            summary['requests'] += 1
+            summary[row['status']] += 1
+
+        def invalid(line, error):
+            return {'line': line, 'id': None, 'start_node': None, 'end_node': None, 'algorithm': algorithm, 'status': 'error', 'error': error, 'compute_time': 0.0}
+
+        if processes <= 1:
+            _bind(env, algorithm, options)
+            for line, request in read_requests(input_file):
+                write(_route((line, request)) if isinstance(request, dict) else invalid(line, request))
+            _worker.clear()
+        else:
+            with concurrent.futures.ProcessPoolExecutor(processes, initializer=_load, initargs=initargs) as pool:
+                in_flight = set()
+                for line, request in read_requests(input_file):
+                    if not isinstance(request, dict):
+                        write(invalid(line, request))
+                        continue
+                    if len(in_flight) >= max_in_flight:  # wait for a slot before reading further
+                        done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            write(future.result())
+                    in_flight.add(pool.submit(_route, (line, request)))
+                for future in concurrent.futures.as_completed(in_flight):
+                    write(future.result())
+
+    print(f"-- Requests: {summary['requests']} ({summary['ok']} ok, {summary['error']} error)")
+    print(f'-- Processing Time: {round(time.perf_counter() - start_time, 2)} seconds')
+    return summary
@@ -0,0 +1,338 @@
+import io
+import sys
+import json
+import time
+import random
+import platform
+import subprocess
+import contextlib
+import numpy as np
+
+
+# Metrics compared by compare(), and whether a larger value is better
+METRICS = {
+    'load.parse_seconds': False,
+    'load.snapshot_seconds': False,
+    'route_evaluation.routes_per_second': True,
+    'route_evaluation.batch_routes_per_second': True,
+    'rl.qlearning.steps_per_second': True,
+    'rl.sarsa.steps_per_second': True,
+    'rl.sweeping.steps_per_second': True,
+}
+
+
+def _timed(function, *args, **kwargs):
+    # (result, seconds) of a call, with whatever it prints discarded
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        return result, time.perf_counter() - start_time
+
+
+def _commit():
+    # The commit benchmarked, None outside a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def od_pairs(env, num_pairs, seed = 0):
+    """
+    Seeded origin-destination pairs, each end node reachable from its start node
+
+    Args:
+    - env (traffic_env): The environment to draw from
+    - num_pairs (int): The number of pairs
+    - seed (int): The seed, the same seed gives the same pairs on the same network
+
+    Returns:
+    - pairs (list): (start_node, end_node) IDs
+    """
+
+    from models import dijkstra
+    rng = random.Random(seed)
+    out_ptr, out_edges, _, _, _, edge_to = env.graph.adjacency_lists()
+    pairs = []
+    for _ in range(100 * num_pairs):
+        if len(pairs) == num_pairs:
+            break
+        start_node, end_node = rng.sample(env.nodes, 2)
+        end_index = env.node_index[end_node]
+        cost, _ = dijkstra.one_to_all(out_ptr, out_edges, edge_to, env.graph.edge_length, env.node_index[start_node], targets=[end_index])
+        if cost[end_index] < float('inf'):
+            pairs.append((start_node, end_node))
+    return pairs
+
+
+def _percentiles(seconds):
+    milliseconds = np.asarray(seconds) * 1000
+    return {
+        'queries': len(milliseconds),
+        'p50_ms': round(float(np.percentile(milliseconds, 50)), 4),
+        'p99_ms': round(float(np.percentile(milliseconds, 99)), 4),
+        'mean_ms': round(float(milliseconds.mean()), 4),
+    }
+
+
+CONGESTION_LEVELS = {'low': 0.05, 'medium': 0.10, 'high': 0.20}  # share of congested edges, as traffic_env
+
+
+def seeded_congestion(edges, congestion_level, seed):
+    """
+    The random congestion of traffic_env, drawn from its own generator so that the caller's random module is left alone
+
+    Returns:
+    - congestion (list): (edge ID, duration in seconds) of every congested edge
+    """
+
+    rng = random.Random(seed)
+    congested_edges = rng.sample(edges, round(len(edges) * CONGESTION_LEVELS[congestion_level]))
+    return [(edge, rng.randint(60, 120)) for edge in congested_edges]
+
+
+def bench_load(network_file, tls_file = None, seed = 0, congestion_level = "low"):
+    """
+    Time the whole start of an environment, the read of the light programs included
+
+    Args:
+    - network_file (str): The .net.xml(.gz) to load
+    - tls_file (str or None): The .tll.xml of the programs, None for those embedded in network_file
+
+    Returns:
+    - env (traffic_env): The environment benchmarked, its congestion drawn from seed
+    - metrics (dict): parse_seconds, the start parsing the XML of the network and the programs,
+        and snapshot_seconds, the start from the snapshot (environment.read_programs() and traffic_env)
+    """
+
+    from models import loader
+    from models import environment
+    if congestion_level not in CONGESTION_LEVELS:
+        sys.exit('Error: Invalid congestion_level, provide only "low", "medium" or "high"')
+    tls_file = tls_file or network_file
+
+    def parse_start():
+        tls = loader.read_tls(tls_file)
+        return environment.traffic_env(network_file, tls, evaluation="time", use_snapshot=False)  # no congestion drawn
+
+    def snapshot_start():
+        tls = environment.read_programs(network_file, tls_file)
+        return environment.traffic_env(network_file, tls, congestion=congestion, evaluation="time", tls_file=tls_file)
+
+    env, parse_seconds = _timed(parse_start)
+    congestion = seeded_congestion(env.edges, congestion_level, seed)
+    env.set_congestion(congestion)
+    _timed(snapshot_start)  # writes the snapshot, with the programs, if missing or stale
+    _, snapshot_seconds = _timed(snapshot_start)
+    return env, {'parse_seconds': round(parse_seconds, 4), 'snapshot_seconds': round(snapshot_seconds, 4)}
+
+
+def bench_search(env, pairs, modes = ('dijkstra', 'astar', 'bidirectional', 'bidirectional_astar', 'time_dependent')):
+    """
+    Query latency of each search mode over the same pairs, one warm-up query first.
+    Only Dijkstra.search_indices() is timed: the search objects are built before, and the routes are not evaluated nor printed
+
+    Returns:
+    - metrics (dict): [mode] = {queries, p50_ms, p99_ms, mean_ms}
+    - routes (list): The edge paths (IDs) found by the first mode, for bench_route_evaluation()
+    """
+
+    from models import dijkstra
+    metrics, routes = {}, []
+    for mode in modes:
+        dijkstra.Dijkstra(env, *pairs[0], mode=mode).search_indices()
+        seconds = []
+        for start_node, end_node in pairs:
+            search = dijkstra.Dijkstra(env, start_node, end_node, mode=mode)
+            start_time = time.perf_counter()
+            edge_indices = search.search_indices()
+            seconds.append(time.perf_counter() - start_time)
+            if mode == modes[0]:
+                routes.append([env.edges[edge] for edge in edge_indices])
+        metrics[mode] = _percentiles(seconds)
+    return metrics, routes
+
+
+def _throughput(function, count, min_seconds, rounds = 5):
+    # The best calls per second of function() over rounds, each repeated for min_seconds / rounds, count calls per function()
+    best = 0.0
+    for _ in range(rounds):
+        calls, start_time = 0, time.perf_counter()
+        while True:
+            function()
+            calls += count
+            elapsed = time.perf_counter() - start_time
+            if elapsed >= min_seconds / rounds:
+                break
+        best = max(best, calls / elapsed)
+    return round(best, 1)
+
+
+def bench_route_evaluation(env, routes, min_seconds = 2.0):
+    """
+    Throughput of the route costs: get_edge_time() + get_tl_offset() of one route at a time,
+    and get_routes_cost() of all routes at once. The best of several rounds is kept, the least disturbed by the machine
+
+    Args:
+    - routes (list): The edge paths (IDs) to evaluate, repeated for at least min_seconds
+
+    Returns:
+    - metrics (dict): routes, routes_per_second, batch_routes_per_second
+    """
+
+    routes = [route for route in routes if route]
+    indices = [env.get_edge_indices(route, caller='bench_route_evaluation') for route in routes]
+
+    def evaluate():
+        for route in routes:
+            env.get_edge_time(route) + env.get_tl_offset(route)
+
+    return {
+        'routes': len(routes),
+        'routes_per_second': _throughput(evaluate, len(routes), min_seconds),
+        'batch_routes_per_second': _throughput(lambda: env.get_routes_cost(indices, "time"), len(indices), min_seconds),
+    }
+
+
+def bench_rl(env, pairs, algorithm = 'qlearning', num_episodes = 5000, threshold = 5, seed = 0):
+    """
+    Train one agent per pair with train(), the runs that do not converge still count in the throughput
+
+    Args:
+    - algorithm (str): "qlearning", "sarsa" or "sweeping" (Prioritized_Sweeping)
+
+    Returns:
+    - metrics (dict): runs, converged, seconds and steps_per_second over all runs, and episodes_to_converge of each run (None if it did not)
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')  # nothing to show, plot_performance() skips its plot
+
+    from models import agent
+    rl_class = {'qlearning': agent.Q_Learning, 'sarsa': agent.SARSA, 'sweeping': agent.Prioritized_Sweeping}[algorithm]
+    steps, seconds, episodes = 0, 0.0, []
+    for start_node, end_node in pairs:
+        rl = rl_class(env, start_node, end_node, seed=seed)
+        start_time = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, _, episode, _ = rl.train(num_episodes, threshold)
+            episodes.append(episode + 1)
+        except SystemExit:
+            episodes.append(None)
+        seconds += time.perf_counter() - start_time
+        steps += rl.steps
+    return {
+        'runs': len(pairs),
+        'converged': sum(episode is not None for episode in episodes),
+        'seconds': round(seconds, 4),
+        'steps_per_second': round(steps / seconds, 1) if seconds else None,
+        'episodes_to_converge': episodes,
+    }
+
+
+def run_benchmark(network_file, tls_file = None, output_file = None, seed = 0, num_pairs = 200, num_rl_pairs = 3, num_episodes = 5000, threshold = 5, congestion_level = "low"):
+    """
+    Run the whole suite offline and report it as JSON, to be compared across commits with compare()
+
+    Every part runs on the same seeded congestion and OD pairs, so two runs of the same commit differ only by timing noise.
+
+    Args:
+    - network_file (str): The .net.xml(.gz) to load, e.g. a city of generator.py for larger networks
+    - tls_file (str or None): The .tll.xml of the light programs, None for those embedded in network_file
+    - output_file (str or None): The .json to write, None to only return the results
+    - seed (int): The seed of the congestion, the pairs and the agents
+    - num_pairs (int): The number of OD pairs of the searches and the route evaluation
+    - num_rl_pairs (int): The number of OD pairs each agent is trained on, 0 to skip the agents
+    - num_episodes, threshold: As for rl_agent.train()
+    - congestion_level (str): "low", "medium" or "high", as for traffic_env
+
+    Returns:
+    - results (dict): meta, load, search, route_evaluation and rl
+    """
+
+    print('Benchmark Start...')
+    start_time = time.perf_counter()
+    results = {'meta': {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'network_file': network_file,
+        'seed': seed,
+        'num_pairs': num_pairs,
+        'congestion_level': congestion_level,
+    }}
+
+    # 1. Load the network, parsed and from the snapshot
+    env, results['load'] = bench_load(network_file, tls_file, seed, congestion_level)
+    print(f"-- Load: {results['load']['parse_seconds']} seconds parsed, {results['load']['snapshot_seconds']} seconds from snapshot")
+
+    # 2. Query latency of the searches
+    pairs = od_pairs(env, num_pairs, seed)
+    results['search'], routes = bench_search(env, pairs)
+    for mode, metrics in results['search'].items():
+        print(f"-- {mode}: p50 {metrics['p50_ms']} ms, p99 {metrics['p99_ms']} ms")
+
+    # 3. Route evaluation throughput
+    results['route_evaluation'] = bench_route_evaluation(env, routes)
+    print(f"-- Route evaluation: {results['route_evaluation']['routes_per_second']} routes/s, {results['route_evaluation']['batch_routes_per_second']} routes/s batched")
+
+    # 4. Agents, on the first pairs
+    results['rl'] = {}
+    for algorithm in ('qlearning', 'sarsa', 'sweeping') if num_rl_pairs else ():
+        results['rl'][algorithm] = bench_rl(env, pairs[:num_rl_pairs], algorithm, num_episodes, threshold, seed)
+        print(f"-- {algorithm}: {results['rl'][algorithm]['seconds']} seconds, {results['rl'][algorithm]['steps_per_second']} steps/s, episodes {results['rl'][algorithm]['episodes_to_converge']}")
+
+    results['meta']['total_seconds'] = round(time.perf_counter() - start_time, 2)
+    if output_file:
+        with open(output_file, 'w') as file:
+            json.dump(results, file, indent=2)
+    print(f"-- Processing Time: {results['meta']['total_seconds']} seconds")
+    return results
+
+
+def _metric(results, name):
+    # A value of results by dotted name, the p50/p99 of the searches included, None if missing
+    value = results
+    for key in name.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(baseline, results, tolerance = 0.2):
+    """
+    Find the metrics that got worse than baseline by more than tolerance
+
+    Args:
+    - baseline, results (dict or str): Results of run_benchmark(), or the .json they were written to
+    - tolerance (float): The relative change allowed, 0.2 for 20%
+
+    Returns:
+    - regressions (list): (metric, baseline value, value) of every regression
+    """
+
+    loaded = []
+    for item in (baseline, results):
+        if isinstance(item, str):
+            with open(item, 'r') as file:
+                item = json.load(file)
+        loaded.append(item)
+    baseline, results = loaded
+
+    metrics = dict(METRICS)
+    for mode in results.get('search', {}):
+        metrics[f'search.{mode}.p50_ms'] = False
+        metrics[f'search.{mode}.p99_ms'] = False
+
+    regressions = []
+    for name, larger_is_better in metrics.items():
+        before, after = _metric(baseline, name), _metric(results, name)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        if (-change if larger_is_better else change) > tolerance:
+            regressions.append((name, before, after))
+    return regressions
@@ -0,0 +1,162 @@
+import threading
+import collections
+
+from models import dijkstra
+
+
+class route_cache:
+    def __init__ (self, env, max_trees = 64, max_routes = 4096):
+        """
+        LRU cache of one-to-all shortest-path trees and of route results
+
+        Trees are kept by (source, evaluation) with the congestion version they were searched on, so that
+        any target from a cached source is answered by walking its tree. env.set_congestion() and
+        env.update_congestion() bump env.congestion_version: a tree of an older version is repaired around
+        the edges changed since (dijkstra.repair_tree()) the next time it is asked for, and results of older
+        versions are never hit again and are evicted as the least recently used, without flushing the rest.
+        Distance trees do not depend on the congestion and stay valid, but every route result is kept by the
+        congestion version, as its tl_offset (the waits at red lights) changes with the congestion.
+
+        Args:
+        - env (traffic_env): The environment to search on
+        - max_trees (int): The number of trees kept, each holds two lists of num_nodes
+        - max_routes (int): The number of route results kept
+        """
+
+        self.env = env
+        self.max_trees = max(1, max_trees)
+        self.max_routes = max(1, max_routes)
+        self.lock = threading.Lock()
+        self.repair_limit = 0.25  # above this share of edges changed, a tree is searched again rather than repaired
+        self.trees = collections.OrderedDict()  # [(source, evaluation)] = (version, cost, predecessor), least recently used first
+        self.routes = collections.OrderedDict()  # [(source, target, evaluation, version)] = result
+        self._edge_costs = {}  # [evaluation] = (version, edge costs as list)
+        self.stats = {'tree_hits': 0, 'tree_misses': 0, 'tree_repairs': 0, 'route_hits': 0, 'route_misses': 0}
+
+
+    def version(self, evaluation):
+        # The congestion version a tree depends on
+        return self.env.congestion_version if evaluation == "time" else 0
+
+
+    def edge_costs(self, evaluation, version):
+        # The costs of every edge as a list, converted once per congestion version
+        cached = self._edge_costs.get(evaluation)
+        if cached is None or cached[0] != version:
+            cached = (version, self.env.get_edge_costs(evaluation).tolist())
+            self._edge_costs[evaluation] = cached
+        return cached[1]
+
+
+    def _get(self, entries, key, stat):
+        # LRU lookup, counted in stats
+        with self.lock:
+            if key in entries:
+                entries.move_to_end(key)
+                self.stats[f'{stat}_hits'] += 1
+                return entries[key]
+            self.stats[f'{stat}_misses'] += 1
+            return None
+
+
+    def _put(self, entries, key, value, size):
+        with self.lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > size:
+                entries.popitem(last=False)  # the least recently used
+
+
+    def tree(self, source, evaluation = None):
+        """
+        Args:
+        - source (int): The node index to search from
+        - evaluation (str or None): "distance" or "time", defaults to env.evaluation
+
+        Returns:
+        - cost, predecessor (list): As dijkstra.one_to_all() over the whole network, shared by the callers, not to be modified
+        """
+
+        env = self.env
+        evaluation = evaluation or env.evaluation
+        key = (source, evaluation)
+        version = self.version(evaluation)
+        with self.lock:
+            entry = self.trees.get(key)
+            if entry is not None:
+                self.trees.move_to_end(key)
+                if entry[0] == version:
+                    self.stats['tree_hits'] += 1
+                    return entry[1], entry[2]
+
+        # 1. A tree of an older congestion, repaired around the edges changed since then
+        changed = env.congestion_changes(entry[0]) if entry is not None else None
+        edge_costs = self.edge_costs(evaluation, version)
+        out_ptr, out_edges, in_ptr, in_edges, edge_from, edge_to = env.graph.adjacency_lists()
+        if changed is not None and len(changed) <= self.repair_limit * env.graph.num_edges:
+            cost, predecessor = list(entry[1]), list(entry[2])  # the old tree may still be walked by other callers
+            dijkstra.repair_tree(out_ptr, out_edges, in_ptr, in_edges, edge_from, edge_to, edge_costs, cost, predecessor, changed.tolist())
+            stat = 'tree_repairs'
+
+        # 2. Otherwise searched again
+        else:
+            cost, predecessor = dijkstra.one_to_all(out_ptr, out_edges, edge_to, edge_costs, source)
+            stat = 'tree_misses'
+
+        with self.lock:
+            self.stats[stat] += 1
+        self._put(self.trees, key, (version, cost, predecessor), self.max_trees)
+        return cost, predecessor
+
+
+    def lookup(self, source, target, evaluation = None):
+        """
+        Returns:
+        - The cached result (dict) of route(), or None without searching. Only hits are counted
+        """
+
+        evaluation = evaluation or self.env.evaluation
+        key = (source, target, evaluation, self.env.congestion_version)  # as route()
+        with self.lock:
+            result = self.routes.get(key)
+            if result is not None:
+                self.routes.move_to_end(key)
+                self.stats['route_hits'] += 1
+            return result
+
+
+    def route(self, source, target, evaluation = None):
+        """
+        Args:
+        - source, target (int): The node indices of the terminals
+        - evaluation (str or None): "distance" or "time", defaults to env.evaluation
+
+        Returns:
+        - result (dict): node_path, edge_path (IDs), cost and tl_offset as env.get_route_cost() / get_route_waits(),
+            node_path is empty and cost None if target is unreachable. Shared by the callers, not to be modified
+        """
+
+        env = self.env
+        evaluation = evaluation or env.evaluation
+        key = (source, target, evaluation, env.congestion_version)  # the tl_offset of a distance route depends on it too
+        result = self._get(self.routes, key, 'route')
+        if result is not None:
+            return result
+
+        cost, predecessor = self.tree(source, evaluation)
+        edge_indices = dijkstra.tree_path(env.graph.edge_from, predecessor, source, target)
+        reachable = cost[target] < float('inf')
+        result = {
+            'node_path': [env.nodes[source]] + [env.nodes[env.graph.edge_to[edge]] for edge in edge_indices] if reachable else [],
+            'edge_path': [env.edges[edge] for edge in edge_indices],
+            'cost': env.get_route_cost(edge_indices, evaluation) if reachable else None,
+            'tl_offset': env.get_route_waits(edge_indices)[0] if reachable else None,
+        }
+        self._put(self.routes, key, result, self.max_routes)
+        return result
+
+
+    def clear(self):
+        with self.lock:
+            self.trees.clear()
+            self.routes.clear()
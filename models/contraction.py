@@ -0,0 +1,368 @@
+import sys
+import heapq
+import datetime
+import numpy as np
+
+
+class ContractionHierarchy:
+    def __init__ (self, env, evaluation = None):
+        """
+        Contraction Hierarchies for repeated point-to-point queries on one congestion snapshot
+
+        The nodes are contracted one by one, and shortcuts are added so that distances among the
+        remaining nodes are kept. A query is then a bidirectional search that only goes upward in
+        the contraction order, which settles far fewer nodes than Dijkstra.
+
+        Args:
+        - env (traffic_env): The environment whose edge costs are contracted
+        - evaluation (str or None): "distance" or "time", defaults to env.evaluation
+        """
+
+        self.env = env
+        self.graph = env.graph
+        self.evaluation = evaluation or env.evaluation
+        if self.evaluation not in ('distance', 'time'):
+            sys.exit('Error: Invalid evaluation type, provide only "distance" or "time"')
+
+        self.witness_limit = 500  # nodes settled by a witness search before giving up and adding the shortcut
+
+
+    # ------ Preprocessing ------
+    def build(self, order = None):
+        """
+        Contract every node, ordered lazily by edge difference
+
+        Args:
+        - order (list or None): The node indices in the order to contract them, e.g. from a previous build, None to order by priority
+
+        Returns:
+        - self
+        """
+
+        print('Build Start...')
+        start_time = datetime.datetime.now()
+
+        num_nodes = self.graph.num_nodes
+        self.edge_costs = self.env.get_edge_costs(self.evaluation)
+
+        # 1. Arcs are original edges first, then shortcuts, a shortcut is the concatenation of its two children arcs
+        self.arc_from = self.graph.edge_from.tolist()
+        self.arc_to = self.graph.edge_to.tolist()
+        self.arc_cost = self.edge_costs.tolist()
+        self.arc_child = [(-1, -1)] * self.graph.num_edges
+
+        # 2. Remaining graph, out_arcs[u][w] = (cost, arc), only the cheapest of parallel edges is kept
+        self.out_arcs = [{} for _ in range(num_nodes)]
+        self.in_arcs = [{} for _ in range(num_nodes)]
+        for arc in range(self.graph.num_edges):
+            self.insert_arc(arc)
+
+        # 3. Contract nodes by priority, re-evaluated lazily when popped
+        self.rank = [-1] * num_nodes
+        self.deleted_neighbours = [0] * num_nodes
+        if order is not None:  # in the given order, no priority to simulate
+            for rank, node in enumerate(order):
+                self.contract_node(node)
+                self.rank[node] = rank
+        else:
+            priority_queue = [(self.contract_node(node, simulate = True), node) for node in range(num_nodes)]
+            heapq.heapify(priority_queue)
+
+            rank = 0
+            while priority_queue:
+                _, node = heapq.heappop(priority_queue)
+                priority = self.contract_node(node, simulate = True)
+                if priority_queue and priority > priority_queue[0][0]:
+                    heapq.heappush(priority_queue, (priority, node))
+                    continue
+
+                self.contract_node(node)
+                self.rank[node] = rank
+                rank += 1
+
+        del self.out_arcs, self.in_arcs  # only needed while contracting
+        self.build_search_graph()
+
+        # time the build process
+        end_time = datetime.datetime.now()
+        time_difference = end_time - start_time
+        processing_seconds = time_difference.total_seconds()
+
+        print('Build Completed...\n')
+        print(f'-- Shortcuts: {len(self.arc_cost) - self.graph.num_edges}')
+        print(f'-- Processing Time: {processing_seconds} seconds')
+        return self
+
+
+    def update(self):
+        """
+        Follow a change of the edge costs, e.g. after env.update_congestion()
+
+        The nodes are contracted again in the order of the current hierarchy, which skips ordering them,
+        the most expensive part of build(). Shortcuts depend on which paths have witnesses under the new
+        costs, so they are recomputed rather than patched, and queries stay exact.
+
+        Returns:
+        - self
+        """
+
+        edge_costs = self.env.get_edge_costs(self.evaluation)
+        if np.array_equal(edge_costs, self.edge_costs):
+            return self
+        order = sorted(range(self.graph.num_nodes), key=self.rank.__getitem__)
+        return self.build(order)
+
+
+    def insert_arc(self, arc):
+        from_node, to_node, cost = self.arc_from[arc], self.arc_to[arc], self.arc_cost[arc]
+        if from_node == to_node:  # a self loop never lies on a shortest path
+            return
+        if to_node not in self.out_arcs[from_node] or cost < self.out_arcs[from_node][to_node][0]:
+            self.out_arcs[from_node][to_node] = (cost, arc)
+            self.in_arcs[to_node][from_node] = (cost, arc)
+
+
+    def witness_search(self, source, ignored_node, targets, limit):
+        """
+        Dijkstra from source in the remaining graph without ignored_node, bounded by cost and settled nodes
+
+        Returns:
+        - cost (dict): The costs found, nodes not reached are absent
+        """
+
+        cost = {source: 0}
+        priority_queue = [(0, source)]
+        remaining = set(targets)
+        settled = 0
+
+        while priority_queue and remaining and settled < self.witness_limit:
+            current_cost, current_node = heapq.heappop(priority_queue)
+            if current_cost > limit:
+                break
+            if current_cost > cost[current_node]:  # an outdated entry of the heap
+                continue
+            remaining.discard(current_node)
+            settled += 1
+
+            for adj_node, (arc_cost, _) in self.out_arcs[current_node].items():
+                if adj_node == ignored_node:
+                    continue
+                temp_cost = current_cost + arc_cost
+                if temp_cost < cost.get(adj_node, float('inf')):
+                    cost[adj_node] = temp_cost
+                    heapq.heappush(priority_queue, (temp_cost, adj_node))
+        return cost
+
+
+    def contract_node(self, node, simulate = False):
+        """
+        Remove node from the remaining graph, adding a shortcut for every shortest path through it
+
+        Args:
+        - node (int): The node index to contract
+        - simulate (bool): Only count the shortcuts, to prioritise the node
+
+        Returns:
+        - priority (int): The edge difference plus the number of contracted neighbours, if simulate
+        """
+
+        in_arcs = self.in_arcs[node]
+        out_arcs = self.out_arcs[node]
+        shortcuts = []
+
+        for from_node, (in_cost, in_arc) in in_arcs.items():
+            targets = [to_node for to_node in out_arcs if to_node != from_node]
+            if not targets:
+                continue
+            limit = in_cost + max(out_arcs[to_node][0] for to_node in targets)
+            witness = self.witness_search(from_node, node, targets, limit)
+
+            for to_node in targets:
+                out_cost, out_arc = out_arcs[to_node]
+                if witness.get(to_node, float('inf')) > in_cost + out_cost:  # no path avoiding node is as short
+                    shortcuts.append((from_node, to_node, in_cost + out_cost, in_arc, out_arc))
+
+        if simulate:
+            return len(shortcuts) - len(in_arcs) - len(out_arcs) + self.deleted_neighbours[node]
+
+        # Add shortcuts
+        for from_node, to_node, cost, in_arc, out_arc in shortcuts:
+            self.arc_from.append(from_node)
+            self.arc_to.append(to_node)
+            self.arc_cost.append(cost)
+            self.arc_child.append((in_arc, out_arc))
+            self.insert_arc(len(self.arc_cost) - 1)
+
+        # Remove node from the remaining graph
+        for from_node in in_arcs:
+            del self.out_arcs[from_node][node]
+            self.deleted_neighbours[from_node] += 1
+        for to_node in out_arcs:
+            del self.in_arcs[to_node][node]
+            self.deleted_neighbours[to_node] += 1
+        self.in_arcs[node] = {}
+        self.out_arcs[node] = {}
+
+
+    def build_search_graph(self):
+        """
+        Split the arcs into the upward graph (forward search) and the reversed downward graph (backward search), in CSR layout
+        """
+
+        arc_from = np.asarray(self.arc_from, dtype=np.int32)
+        arc_to = np.asarray(self.arc_to, dtype=np.int32)
+        rank = np.asarray(self.rank, dtype=np.int32)
+        num_nodes = self.graph.num_nodes
+
+        upward = np.flatnonzero(rank[arc_from] < rank[arc_to])  # searched forward from the start node
+        downward = np.flatnonzero(rank[arc_from] > rank[arc_to])  # searched backward from the end node
+
+        def csr(arcs, key):
+            order = arcs[np.argsort(key[arcs], kind='stable')]
+            ptr = np.zeros(num_nodes + 1, dtype=np.int64)
+            ptr[1:] = np.cumsum(np.bincount(key[arcs], minlength=num_nodes))
+            return ptr.tolist(), order.tolist()
+
+        self.up_ptr, self.up_arcs = csr(upward, arc_from)
+        self.down_ptr, self.down_arcs = csr(downward, arc_to)
+
+
+    # ------ Persistence ------
+    def save(self, file_name):
+        """
+        Save the hierarchy to a .npz file
+
+        Args:
+        - file_name (str): The file to write
+        """
+
+        np.savez(
+            file_name,
+            evaluation = np.array(self.evaluation),
+            edge_costs = self.edge_costs,
+            arc_from = np.asarray(self.arc_from, dtype=np.int32),
+            arc_to = np.asarray(self.arc_to, dtype=np.int32),
+            arc_cost = np.asarray(self.arc_cost, dtype=np.float64),
+            arc_child = np.asarray(self.arc_child, dtype=np.int32).reshape(-1, 2),
+            rank = np.asarray(self.rank, dtype=np.int32),
+        )
+
+
+    @classmethod
+    def load(cls, env, file_name):
+        """
+        Load a hierarchy saved by save(), it must have been built on the same edge costs
+
+        Args:
+        - env (traffic_env): The environment the hierarchy was built on
+        - file_name (str): The .npz file to read
+
+        Returns:
+        - A ContractionHierarchy ready for search()
+        """
+
+        with np.load(file_name) as data:
+            hierarchy = cls(env, str(data['evaluation']))
+            hierarchy.edge_costs = data['edge_costs']
+            if not np.array_equal(hierarchy.edge_costs, env.get_edge_costs(hierarchy.evaluation)):
+                sys.exit(f'Error: {file_name} was built on different edge costs, build it again')
+
+            hierarchy.arc_from = data['arc_from'].tolist()
+            hierarchy.arc_to = data['arc_to'].tolist()
+            hierarchy.arc_cost = data['arc_cost'].tolist()
+            hierarchy.arc_child = [tuple(child) for child in data['arc_child'].tolist()]
+            hierarchy.rank = data['rank'].tolist()
+
+        hierarchy.build_search_graph()
+        return hierarchy
+
+
+    # ------ Query ------
+    def unpack_arc(self, arc, edge_path):
+        # Replace shortcuts by their children until only original edges are left
+        stack = [arc]
+        while stack:
+            arc = stack.pop()
+            first, second = self.arc_child[arc]
+            if first < 0:
+                edge_path.append(arc)
+            else:
+                stack.append(second)
+                stack.append(first)
+
+
+    def search(self, start_node, end_node):
+        """
+        Bidirectional upward search from start_node and end_node
+
+        Args:
+        - start_node, end_node (str): The IDs of the terminals
+
+        Returns:
+        - node_path (list): The IDs of the nodes on the route, only [end_node] if unreachable
+        - edge_path (list): The IDs of the edges on the route, same as Dijkstra.search()
+        """
+
+        if start_node not in self.env.node_index:
+            sys.exit('Error: Invalid start node')
+        elif end_node not in self.env.node_index:
+            sys.exit('Error: Invalid end node')
+        start_index = self.env.node_index[start_node]
+        end_index = self.env.node_index[end_node]
+
+        # Index 0 is the upward search from start_node, index 1 is the backward upward search from end_node
+        cost = [{start_index: 0}, {end_index: 0}]
+        predecessor = [{start_index: -1}, {end_index: -1}]  # the arc used to reach each node
+        priority_queue = [[(0, start_index)], [(0, end_index)]]
+        adjacency = [(self.up_ptr, self.up_arcs, self.arc_to), (self.down_ptr, self.down_arcs, self.arc_from)]
+        self.settled = 0
+
+        best_cost = float('inf')
+        meeting_node = -1
+        if start_index == end_index:
+            best_cost, meeting_node = 0, start_index
+
+        # Each side can stop on its own once its queue cannot improve the best cost
+        while any(queue and queue[0][0] < best_cost for queue in priority_queue):
+            side = 0 if priority_queue[0] and (not priority_queue[1] or priority_queue[0][0][0] <= priority_queue[1][0][0]) else 1
+            current_cost, current_node = heapq.heappop(priority_queue[side])
+            if current_cost > cost[side][current_node]:  # an outdated entry of the heap
+                continue
+            self.settled += 1
+
+            other_cost = cost[1 - side].get(current_node)
+            if other_cost is not None and current_cost + other_cost < best_cost:
+                best_cost = current_cost + other_cost
+                meeting_node = current_node
+
+            ptr, arcs, heads = adjacency[side]
+            for arc in arcs[ptr[current_node]:ptr[current_node+1]]:
+                adj_node = heads[arc]
+                temp_cost = current_cost + self.arc_cost[arc]
+                if temp_cost < cost[side].get(adj_node, float('inf')):
+                    cost[side][adj_node] = temp_cost
+                    predecessor[side][adj_node] = arc
+                    heapq.heappush(priority_queue[side], (temp_cost, adj_node))
+
+        if meeting_node < 0:
+            return [end_node], []
+
+        # Unpack the arcs from start_node to the meeting node, then from the meeting node to end_node
+        arcs = []
+        temp_node = meeting_node
+        while predecessor[0][temp_node] >= 0:
+            arcs.append(predecessor[0][temp_node])
+            temp_node = self.arc_from[arcs[-1]]
+        arcs.reverse()
+        temp_node = meeting_node
+        while predecessor[1][temp_node] >= 0:
+            arcs.append(predecessor[1][temp_node])
+            temp_node = self.arc_to[arcs[-1]]
+
+        edge_indices = []
+        for arc in arcs:
+            self.unpack_arc(arc, edge_indices)
+
+        edge_path = [self.env.edges[edge] for edge in edge_indices]
+        node_path = [start_node] + [self.env.nodes[self.graph.edge_to[edge]] for edge in edge_indices]
+        return node_path, edge_path
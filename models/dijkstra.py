@@ -1,79 +1,487 @@
+import sys
 import heapq
 import datetime
 
+from models import instrument
+
+
+def one_to_all(out_ptr, out_edges, edge_to, edge_costs, source, targets = None):
+    """
+    Dijkstra from one source to every node, on plain index sequences so that it runs on
+    lists, NumPy arrays or memoryviews of shared memory alike
+
+    Args:
+    - out_ptr, out_edges (sequence): The CSR outgoing adjacency of the compiled network
+    - edge_to (sequence): The end node index of each edge
+    - edge_costs (sequence): The cost of each edge
+    - source (int): The node index to search from
+    - targets (iterable or None): Stop once all these node indices are settled, None searches the whole network
+
+    Returns:
+    - cost (list): The cost from source to each node, inf if unreachable
+    - predecessor (list): The edge index used to reach each node, -1 for the source and unreachable nodes
+    """
+
+    num_nodes = len(out_ptr) - 1
+    cost = [float('inf')] * num_nodes
+    predecessor = [-1] * num_nodes
+    settled = [False] * num_nodes
+    cost[source] = 0
+    priority_queue = [(0, source)]
+    remaining = set(targets) if targets is not None else None
+
+    while priority_queue:
+        current_cost, current_node = heapq.heappop(priority_queue)
+        if settled[current_node]:  # an outdated entry of the heap
+            continue
+        settled[current_node] = True
+
+        if remaining is not None:
+            remaining.discard(current_node)
+            if not remaining:
+                break
+
+        for adj_edge in out_edges[out_ptr[current_node]:out_ptr[current_node+1]]:
+            adj_node = edge_to[adj_edge]
+            temp_cost = current_cost + edge_costs[adj_edge]
+            if temp_cost < cost[adj_node]:
+                cost[adj_node] = temp_cost
+                predecessor[adj_node] = adj_edge
+                heapq.heappush(priority_queue, (temp_cost, adj_node))
+
+    return cost, predecessor
+
+
+def repair_tree(out_ptr, out_edges, in_ptr, in_edges, edge_from, edge_to, edge_costs, cost, predecessor, changed_edges):
+    """
+    Update a one_to_all() tree over the whole network, in place, after the cost of some edges changed
+
+    A tree edge that got more expensive cuts its subtree off, the cut nodes are reconnected through
+    their cheapest incoming edge from the rest of the tree, an edge that got cheaper is relaxed, and
+    the changes are propagated as Dijkstra does from there. Nodes away from the changed edges are not touched.
+
+    Args:
+    - out_ptr, out_edges, in_ptr, in_edges (sequence): The CSR adjacency of the compiled network
+    - edge_from, edge_to (sequence): The start/end node index of each edge
+    - edge_costs (sequence): The new cost of each edge
+    - cost, predecessor (list): The tree from one_to_all() on the previous costs, updated in place
+    - changed_edges (iterable): The indices of the edges whose cost changed
+
+    Returns:
+    - touched (int): The number of nodes whose cost was updated
+    """
+
+    inf = float('inf')
+    changed_edges = list(changed_edges)
+
+    # 1. Cut off the subtrees below the tree edges that got more expensive
+    roots = [edge_to[edge] for edge in changed_edges if predecessor[edge_to[edge]] == edge and cost[edge_from[edge]] + edge_costs[edge] > cost[edge_to[edge]]]
+    affected = set()
+    if roots:
+        children = [[] for _ in range(len(cost))]
+        for node, edge in enumerate(predecessor):
+            if edge >= 0:
+                children[edge_from[edge]].append(node)
+        stack = roots
+        while stack:
+            node = stack.pop()
+            if node not in affected:
+                affected.add(node)
+                stack.extend(children[node])
+        for node in affected:
+            cost[node] = inf
+            predecessor[node] = -1
+
+    # 2. Reconnect the cut nodes from the rest of the tree, and relax the edges that got cheaper
+    priority_queue = []
+    for node in affected:
+        for edge in in_edges[in_ptr[node]:in_ptr[node+1]]:
+            temp_cost = cost[edge_from[edge]] + edge_costs[edge]
+            if temp_cost < cost[node]:
+                cost[node] = temp_cost
+                predecessor[node] = edge
+        if cost[node] < inf:
+            priority_queue.append((cost[node], node))
+    for edge in changed_edges:
+        temp_cost = cost[edge_from[edge]] + edge_costs[edge]
+        if temp_cost < cost[edge_to[edge]]:
+            cost[edge_to[edge]] = temp_cost
+            predecessor[edge_to[edge]] = edge
+            priority_queue.append((temp_cost, edge_to[edge]))
+    heapq.heapify(priority_queue)
+
+    # 3. Propagate, a node is pushed again whenever its cost drops
+    touched = set(affected)
+    while priority_queue:
+        current_cost, current_node = heapq.heappop(priority_queue)
+        if current_cost > cost[current_node]:  # an outdated entry of the heap
+            continue
+        touched.add(current_node)
+        for adj_edge in out_edges[out_ptr[current_node]:out_ptr[current_node+1]]:
+            adj_node = edge_to[adj_edge]
+            temp_cost = current_cost + edge_costs[adj_edge]
+            if temp_cost < cost[adj_node]:
+                cost[adj_node] = temp_cost
+                predecessor[adj_node] = adj_edge
+                heapq.heappush(priority_queue, (temp_cost, adj_node))
+
+    return len(touched)
+
+
+def tree_path(edge_from, predecessor, source, target):
+    """
+    Walk a shortest-path tree back from target to source
+
+    Args:
+    - edge_from (sequence): The start node index of each edge
+    - predecessor (sequence): The predecessor edge of each node, as returned by one_to_all()
+    - source, target (int): The node indices of the terminals
+
+    Returns:
+    - edge_path (list): The edge indices from source to target, empty if unreachable or source == target
+    """
+
+    edge_path = []
+    temp_node = target
+    while temp_node != source:
+        edge = predecessor[temp_node]
+        if edge < 0:  # not in the tree
+            return []
+        edge_path.append(edge)
+        temp_node = edge_from[edge]
+    edge_path.reverse()
+    return edge_path
+
 
 class Dijkstra:
-    def __init__ (self, env, start_node, end_node):
+    def __init__ (self, env, start_node, end_node, mode = "dijkstra", route_cache = None):
+        """
+        Args:
+        - env (traffic_env): The environment to search on
+        - start_node, end_node (str): The IDs of the terminals
+        - mode (str): The search strategy
+            - 'dijkstra': plain unidirectional Dijkstra (default)
+            - 'astar': unidirectional A* guided by the straight-line distance to end_node
+            - 'bidirectional': Dijkstra from both terminals until the two searches meet
+            - 'bidirectional_astar': bidirectional search with averaged A* potentials
+            - 'time_dependent': arrival time is the label, red-light waits are applied while searching (evaluation "time" only)
+            - 'time_dependent_astar': time_dependent guided by the A* heuristic
+        - route_cache (cache.route_cache or None): With mode 'dijkstra', the path is walked from the cached tree of start_node
+            (searched over the whole network on a miss), so later searches from the same start node under the same congestion are free
+        """
+
+        if mode not in ('dijkstra', 'astar', 'bidirectional', 'bidirectional_astar', 'time_dependent', 'time_dependent_astar'):
+            sys.exit('Error: Invalid search mode, provide only "dijkstra", "astar", "bidirectional", "bidirectional_astar", "time_dependent" or "time_dependent_astar"')
+        if mode in ('time_dependent', 'time_dependent_astar') and env.evaluation not in ("time"):
+            sys.exit('Error: Time-dependent search needs evaluation "time"')
+        self.mode = mode
+
         self.env = env
         self.env.set_start_end(start_node, end_node)  # call set_start_end() in env to set the start and end node
+        self.graph = self.env.graph
+        self.start_index = self.env.node_index[start_node]
+        self.end_index = self.env.node_index[end_node]
+        self.route_cache = route_cache
+        self.metrics = env.metrics  # instrument.metrics, None unless instrumented
+
+
+    def heap_functions(self):
+        # heapq.heappush / heappop, counted if instrumented
+        if self.metrics is None:
+            return heapq.heappush, heapq.heappop
+        return instrument.counting_heap(self.metrics, heapq.heappush, heapq.heappop)
 
 
     def reset(self):
-        self.cost = {node: float('inf') for node in self.env.nodes}  # set to infinity
-        self.predecessor = {node: None for node in self.env.nodes}
-        self.cost[self.env.start_node] = 0  # cost from start node to itself is 0
-        self.priority_queue = [(0, self.env.start_node)]
+        num_nodes = self.graph.num_nodes
+        self.edge_costs = self.env.get_edge_costs().tolist()
+        self.cost = [float('inf')] * num_nodes  # set to infinity, indexed by node index
+        self.predecessor = [-1] * num_nodes  # the edge index used to reach each node
+        self.cost[self.start_index] = 0  # cost from start node to itself is 0
+        self.priority_queue = [(0, self.start_index)]
+        self.settled = 0  # number of nodes popped with a final cost, to measure the search space
 
 
-    def calculate_cost(self, current_cost, adj_edge):
+    def heuristic(self, node_index):
+        """
+        Admissible estimate of the cost from every node to the given node
+
+        Args:
+        - node_index (int): The target of the estimate
+
+        Returns:
+        - A list (float) of lower bounds, indexed by node index
+        """
+
+        # straight-line distance, scaled down so that it never exceeds the cost of any edge (congestion only adds)
         if self.env.evaluation in ("time"):
-            cost = current_cost + self.env.get_edge_time(adj_edge)
-        else:  # in ("distance")
-            cost = current_cost + self.env.get_edge_distance(adj_edge)
-        return cost
+            scale = self.graph.heuristic_time_scale
+        else:
+            scale = self.graph.heuristic_scale
+        return (self.graph.straight_line_distance(node_index) * scale).tolist()
 
 
-    # main function in dijkstra
-    def search(self):
-        print('Search Start...')
-        start_time = datetime.datetime.now()
+    def calculate_cost(self, current_cost, adj_edge):
+        return current_cost + self.edge_costs[adj_edge]
 
-        self.reset()  # the initial state of the algorithm
 
-        while self.priority_queue:
-            current_cost, current_node = heapq.heappop(self.priority_queue) # get the minimum one from the heap
+    def search_unidirectional(self):
+        heappush, heappop = self.heap_functions()
+        out_ptr, out_edges, _, _, _, edge_to = self.graph.adjacency_lists()
+        cost = self.cost
+        predecessor = self.predecessor
+        priority_queue = self.priority_queue
+        end_index = self.end_index
+
+        # A* only changes the key of the heap, potential = 0 gives Dijkstra
+        if self.mode == 'astar':
+            potential = self.heuristic(end_index)
+            priority_queue[0] = (potential[self.start_index], self.start_index)
+        else:
+            potential = [0.0] * self.graph.num_nodes
+
+        settled = [False] * self.graph.num_nodes
+        while priority_queue:
+            _, current_node = heappop(priority_queue)  # get the minimum one from the heap
+            if settled[current_node]:  # an outdated entry of the heap
+                continue
+            settled[current_node] = True
+            self.settled += 1
 
             # If the node is the end node, then stop searching
-            if current_node == self.env.end_node:
+            if current_node == end_index:
                 break
 
             # Explore the neighbors nodes
-            for adj_edge in self.env.decode_node_to_edges(current_node, direction = 'outgoing'):
-                # Corresponding neighbor node
-                adj_node = self.env.decode_edge_to_node(adj_edge, direction = 'end')
-                # Calculate the cost of the neighbor
-                temp_cost = self.calculate_cost(current_cost, adj_edge)
+            current_cost = cost[current_node]
+            for adj_edge in out_edges[out_ptr[current_node]:out_ptr[current_node+1]]:
+                adj_node = edge_to[adj_edge]  # corresponding neighbor node
+                temp_cost = self.calculate_cost(current_cost, adj_edge)  # calculate the cost of the neighbor
 
                 # If the tentative distance is less than the current distance of the neighbor
-                if temp_cost < self.cost[adj_node]:
-                    self.cost[adj_node] = temp_cost # update the distance of the neighbor
-                    self.predecessor[adj_node] = current_node # update the predecessor of the neighbor
-                    heapq.heappush(self.priority_queue, (temp_cost, adj_node)) # add the neighbor to the priority queue
+                if temp_cost < cost[adj_node]:
+                    cost[adj_node] = temp_cost  # update the distance of the neighbor
+                    predecessor[adj_node] = adj_edge  # update the predecessor of the neighbor
+                    heappush(priority_queue, (temp_cost + potential[adj_node], adj_node))  # add the neighbor to the priority queue
 
-        # Construct the path from the start node to the goal node
-        node_path = []
+        # Construct the edge path from the start node to the goal node
         edge_path = []
+        if cost[end_index] < float('inf'):
+            temp_node = end_index
+            while temp_node != self.start_index:
+                edge_path.append(predecessor[temp_node])
+                temp_node = self.graph.edge_from[predecessor[temp_node]]
+            edge_path.reverse()
+        return edge_path
+
+
+    def search_bidirectional(self):
+        heappush, heappop = self.heap_functions()
+        out_ptr, out_edges, in_ptr, in_edges, edge_from, edge_to = self.graph.adjacency_lists()
+        num_nodes = self.graph.num_nodes
+        start_index, end_index = self.start_index, self.end_index
+        infinity = float('inf')
+
+        # Averaged potentials keep the reduced edge costs the same in both directions (p_backward = -p_forward)
+        if self.mode == 'bidirectional_astar':
+            to_end = self.heuristic(end_index)
+            to_start = self.heuristic(start_index)
+            potential = [(to_end[node] - to_start[node]) / 2 for node in range(num_nodes)]
+        else:
+            potential = [0.0] * num_nodes
+
+        # Index 0 is the forward search from start_node, index 1 is the backward search from end_node
+        cost = [self.cost, [infinity] * num_nodes]
+        predecessor = [self.predecessor, [-1] * num_nodes]  # the backward search stores the successor edge
+        cost[1][end_index] = 0
+        settled = [[False] * num_nodes, [False] * num_nodes]
+        priority_queue = [[(potential[start_index], start_index)], [(-potential[end_index], end_index)]]
+        adjacency = [(out_ptr, out_edges, edge_to), (in_ptr, in_edges, edge_from)]
+        sign = [1, -1]
+
+        best_cost = infinity  # cost of the best path found so far
+        meeting_edge = -1  # the edge joining the two searches on the best path
+        if start_index == end_index:
+            best_cost = 0
+
+        while priority_queue[0] and priority_queue[1]:
+            # Stop once no path through unsettled nodes can be shorter
+            if priority_queue[0][0][0] + priority_queue[1][0][0] >= best_cost:
+                break
+
+            # Expand the side with the smaller key
+            side = 0 if priority_queue[0][0][0] <= priority_queue[1][0][0] else 1
+            _, current_node = heappop(priority_queue[side])
+            if settled[side][current_node]:
+                continue
+            settled[side][current_node] = True
+            self.settled += 1
+
+            ptr, edges, heads = adjacency[side]
+            this_cost, other_cost = cost[side], cost[1 - side]
+            current_cost = this_cost[current_node]
+            for adj_edge in edges[ptr[current_node]:ptr[current_node+1]]:
+                adj_node = heads[adj_edge]
+                temp_cost = self.calculate_cost(current_cost, adj_edge)
+
+                if temp_cost < this_cost[adj_node]:
+                    this_cost[adj_node] = temp_cost
+                    predecessor[side][adj_node] = adj_edge
+                    heappush(priority_queue[side], (temp_cost + sign[side] * potential[adj_node], adj_node))
+
+                # A path start -> current_node -> adj_node -> end has been found
+                if temp_cost + other_cost[adj_node] < best_cost:
+                    best_cost = temp_cost + other_cost[adj_node]
+                    meeting_edge = adj_edge
+
+        # Construct the edge path: forward tree up to the meeting edge, then backward tree down to end_node
+        edge_path = []
+        if meeting_edge >= 0:
+            temp_node = edge_from[meeting_edge]
+            while temp_node != start_index:
+                edge_path.append(predecessor[0][temp_node])
+                temp_node = edge_from[predecessor[0][temp_node]]
+            edge_path.reverse()
+            edge_path.append(meeting_edge)
+
+            temp_node = edge_to[meeting_edge]
+            while temp_node != end_index:
+                edge_path.append(predecessor[1][temp_node])
+                temp_node = edge_to[predecessor[1][temp_node]]
+        return edge_path
+
+
+    def search_time_dependent(self):
+        """
+        Label-setting search on edges, the label of an edge is the arrival time at its end before any red light.
+        The wait at a junction depends on the movement (edge, next_edge), hence labels on edges rather than nodes.
+        Waits are FIFO, so the first label settled on an edge is its earliest arrival and later ones are pruned.
+        The route leaves at env.departure_time: the lights, and the speed profiles if any, are read at
+        departure_time + label. Profiles are assumed FIFO as well (entering later never means leaving earlier).
+        """
+
+        out_ptr, out_edges, _, _, edge_from, edge_to = self.graph.adjacency_lists()
+        heappush, heappop = self.heap_functions()
+        edge_costs = self.edge_costs
+        get_tl_wait = self.env.get_tl_wait
+        tl_node = self.env.tl_node_mask.tolist()
+        departure_time = self.env.departure_time
+        profiles = self.env.profiles
+        if profiles is not None:
+            factor_at = profiles.factor_at
+            edge_time = self.graph.edge_time.tolist()
+            penalty = self.env.congestion_penalty.tolist()
+        start_index, end_index = self.start_index, self.end_index
+        self.arrival_time = 0 if start_index == end_index else float('inf')
+        if start_index == end_index:
+            return []
+
+        if self.mode == 'time_dependent_astar':
+            potential = self.heuristic(end_index)
+        else:
+            potential = [0.0] * self.graph.num_nodes
+
+        num_edges = self.graph.num_edges
+        arrival = [float('inf')] * num_edges
+        predecessor = [-1] * num_edges  # the previous edge on the route
+        settled = [False] * num_edges
+        priority_queue = []
+
+        # The route leaves start_node at time 0, no light to wait for (edge_costs are the speeds at departure)
+        for adj_edge in out_edges[out_ptr[start_index]:out_ptr[start_index+1]]:
+            if edge_costs[adj_edge] < arrival[adj_edge]:
+                arrival[adj_edge] = edge_costs[adj_edge]
+                heappush(priority_queue, (arrival[adj_edge] + potential[edge_to[adj_edge]], adj_edge))
+
+        last_edge = -1
+        while priority_queue:
+            _, current_edge = heappop(priority_queue)
+            if settled[current_edge]:  # an outdated entry of the heap
+                continue
+            settled[current_edge] = True
+            self.settled += 1
+
+            current_node = edge_to[current_edge]
+            if current_node == end_index:
+                last_edge = current_edge
+                self.arrival_time = arrival[current_edge]
+                break
+
+            current_time = arrival[current_edge]
+            signalised = tl_node[current_node]
+            for adj_edge in out_edges[out_ptr[current_node]:out_ptr[current_node+1]]:
+                if profiles is None:
+                    temp_time = current_time + edge_costs[adj_edge]
+                    if signalised:
+                        temp_time += get_tl_wait(current_edge, adj_edge, departure_time + current_time)
+                else:  # the speed of adj_edge once the light lets it be entered
+                    temp_time = current_time
+                    if signalised:
+                        temp_time += get_tl_wait(current_edge, adj_edge, departure_time + current_time)
+                    temp_time += edge_time[adj_edge] / factor_at(adj_edge, departure_time + temp_time) + penalty[adj_edge]
+                if temp_time < arrival[adj_edge]:
+                    arrival[adj_edge] = temp_time
+                    predecessor[adj_edge] = current_edge
+                    heappush(priority_queue, (temp_time + potential[edge_to[adj_edge]], adj_edge))
+
+        # Construct the edge path back from the first edge reaching end_node
+        edge_path = []
+        while last_edge >= 0:
+            edge_path.append(last_edge)
+            last_edge = predecessor[last_edge]
+        edge_path.reverse()
+        return edge_path
+
+
+    # main function in dijkstra
+    def search_indices(self):
+        """
+        The search of the mode alone, without the IDs, the timing and the report of search()
+
+        Returns:
+        - edge_indices (list): The edge indices of the route, empty if end_node is unreachable
+        """
+
+        self.reset()  # the initial state of the algorithm
+
+        if self.route_cache is not None and self.mode == 'dijkstra':
+            _, predecessor = self.route_cache.tree(self.start_index)
+            return tree_path(self.graph.edge_from, predecessor, self.start_index, self.end_index)
+        elif self.mode in ('bidirectional', 'bidirectional_astar'):
+            return self.search_bidirectional()
+        elif self.mode in ('time_dependent', 'time_dependent_astar'):
+            return self.search_time_dependent()
+        else:
+            return self.search_unidirectional()
+
+
+    def search(self):
+        print('Search Start...')
+        start_time = datetime.datetime.now()
 
-        temp_node = self.env.end_node
-        while temp_node is not None:
-            node_path.append(temp_node)
-            temp_node = self.predecessor[temp_node]
-        node_path.reverse()
+        edge_indices = self.search_indices()
 
-        for index in range(len(node_path)-1):
-            intersect_edge = set(self.env.decode_node_to_edges(node_path[index], "outgoing")) & set(self.env.decode_node_to_edges(node_path[index+1], "incoming")) # find the edge between two nodes by knowing their set
-            edge_path.append(next(iter(intersect_edge)))  # temp_edge is a set of elements (only one element here), so use it to get the element rather than the set by change it into iterator and get the next one because of its unordered prop
+        # Translate the path back to IDs, an unreachable end node gives a path of itself only
+        edge_path = [self.env.edges[edge] for edge in edge_indices]
+        if edge_indices:
+            node_path = [self.env.nodes[self.graph.edge_from[edge_indices[0]]]] + [self.env.nodes[self.graph.edge_to[edge]] for edge in edge_indices]
+        else:
+            node_path = [self.env.end_node]
 
         # time the search process
         end_time = datetime.datetime.now()
         time_difference = end_time - start_time
         processing_seconds = time_difference.total_seconds()  # get second rather than timedelta object
+        if self.metrics is not None:
+            self.metrics.count('searches')
+            self.metrics.add_time('search', processing_seconds)
 
         # --- results output ---
         print('Search Completed...\n')
         print(f'-- States: {node_path}\n')
         print(f'-- Edges: {edge_path}\n')  # states is nodes actually
         print(f'-- Processing Time: {processing_seconds} seconds')
+        print(f'-- Settled: {self.settled} ({self.mode}, edges for time-dependent modes, nodes otherwise)')
 
         if self.env.evaluation in ("time"):
             print(f'-- Travelled Time: {round(( self.env.get_edge_time(edge_path) + self.env.get_tl_offset(edge_path) )/60, 2)} mins')
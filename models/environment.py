@@ -1,21 +1,41 @@
 import sys
-import sumolib
-import math
-import networkx as nx
-import matplotlib.pyplot as plt
 import random
+import collections
+import numpy as np
+
+from models import signals
+from models import snapshot
 
 class traffic_env:
-    def __init__ (self, network_file, tls, congestion = [], evaluation = "", congestion_level = ""):
+    def __init__ (self, network_file, tls, congestion = [], evaluation = "", congestion_level = "", use_snapshot = True, compiled = None, tls_file = None):
         # 1. Define network_file
         self.network_file = network_file  # read the file
-
-        self.net = sumolib.net.readNet(network_file)  # file -> net
-        self.nodes = [node.getID().upper() for node in self.net.getNodes()]  # net -> nodes (ID)
-        self.edges = [edge.getID() for edge in self.net.getEdges()]  # net -> edges (ID)
-
-        self.tls = tls  # [tl_id][link_index]=[90] (dict)
-        self.tls_space = [tl.getID() for tl in self.net.getTrafficLights()]
+        self._net = None  # the sumolib net, only read if self.net is asked for, routing runs on self.graph
+
+        # Compiled network and signals, given (e.g. generator.synthetic_city.compile(), network_file is then only a name),
+        # or from the snapshot next to network_file when it is still valid
+        self.in_memory = compiled is not None  # no file to load it again from, see worker_args()
+        # tls_file is the file tls was read from, if known the snapshot also keeps the programs for read_programs()
+        cached = compiled or (snapshot.load(network_file, tls, tls_file) if use_snapshot else None)
+        if cached:
+            self.graph, self.tls_space, self.signals = cached
+        else:
+            from models import loader  # the XML parser, only imported when there is no snapshot to map
+            self.graph, self.tls_space, connections = loader.read_network(network_file)  # file -> integer-indexed arrays, every lookup below is served from it
+            self.signals = signals.compiled_signals(self.graph, connections, tls)  # movement -> link, and seconds until green of every link
+            if use_snapshot:
+                try:
+                    snapshot.save(network_file, tls, self.graph, self.tls_space, self.signals, tls_file=tls_file)
+                except OSError:
+                    pass  # e.g. a read-only folder, the next start parses again
+
+        self.nodes = self.graph.node_ids  # net -> nodes (ID)
+        self.edges = self.graph.edge_ids  # net -> edges (ID)
+        self.node_index = self.graph.node_index  # node ID -> index
+        self.edge_index = self.graph.edge_index  # edge ID -> index
+
+        self.tls = tls  # [tl_id] = {'offset': float, 'phases': [(duration, state), ...]} (dict)
+        self.tl_node_mask = self.signals.tl_node_mask  # nodes where a light may have to be waited for
         self.tls_meet = []  # to print on map
         self.congestion_meet = []  # to print on map
 
@@ -25,16 +45,19 @@ class traffic_env:
 
 
         # 2. Define congestions edges with its original pattern
+        self.congestion_version = 0  # bumped by every set_congestion() / update_congestion(), for caches of costs under the congestion
+        self.congestion_log = collections.deque(maxlen=64)  # (version, indices of the edges whose penalty changed) of the last updates
+        self.profiles = None  # speed_profiles of the time of day (models/profiles.py), None for free-flow speeds all day
+        self.departure_time = 0.0  # seconds after midnight the routes leave at, the clock of the profiles and the lights
+        self.metrics = None  # instrument.metrics counting the env, its agents and searches, None while not instrumented
         if congestion:  # if congestion is defined
-            self.congested_edges = [item[0] for item in congestion]
-            self.congestion_duration = [item[1] for item in congestion]  # the duration of so called "traffic jam"
-
-            for edge in self.congested_edges:  # make sure that all congested_edges are in the net
-                if edge not in self.edges:
-                    sys.exit(f'Error: Invalid congestion_edges {edge}')
+            self.set_congestion(congestion)
             # print(f'Congested Edges: {list(zip(self.congested_edges, self.congestion_duration))}')
             # print(f'Congested/Total: {len(self.congested_edges)}/{len(self.edges)}')
 
+        elif not congestion_level:  # neither given nor to be drawn, e.g. a worker about to set the congestion of its parent
+            self.set_congestion([])
+
         else:  # if congestion is not defined, then set edges and its duration randomly
             if congestion_level == "low":
                 traffic_level = 0.05  # 5% congested
@@ -42,8 +65,9 @@ class traffic_env:
                 traffic_level = 0.10  # 10% congested
             elif congestion_level == "high":
                 traffic_level = 0.20  # 20% congested
-            self.congested_edges = random.sample(self.edges, round(len(self.edges) * traffic_level))
-            self.congestion_duration = [random.randint(60, 120) for _ in range(len(self.congested_edges))]  # 1~2 min
+            congested_edges = random.sample(self.edges, round(len(self.edges) * traffic_level))
+            congestion_duration = [random.randint(60, 120) for _ in range(len(congested_edges))]  # 1~2 min
+            self.set_congestion(list(zip(congested_edges, congestion_duration)))
             # print(f'Congested Edges: {list(zip(self.congested_edges, self.congestion_duration))}')
             # print(f'Congested/Total: {len(self.congested_edges)}/{len(self.edges)}')
 
@@ -54,6 +78,167 @@ class traffic_env:
         self.evaluation = evaluation
 
 
+    # What a worker process needs to build the same environment
+    def worker_args(self):
+        """
+        Returns:
+        - args (tuple): For worker_env() in another process: the network file and programs, the compiled network
+            itself if it was given rather than read from the file, the congestion, the evaluation and the profiles
+        """
+
+        compiled = (self.graph, self.tls_space, self.signals) if self.in_memory else None
+        congestion = list(zip(self.congested_edges, self.congestion_duration))
+        return (self.network_file, self.tls, compiled, congestion, self.evaluation, (self.profiles, self.departure_time))
+
+
+    # The sumolib net, read on first use
+    @property
+    def net(self):
+        if self._net is None:
+            import sumolib  # only for callers wanting sumolib objects
+            self._net = sumolib.net.readNet(self.network_file)  # file -> net
+        return self._net
+
+
+    # Replace the congested edges
+    def set_congestion(self, congestion):
+        """
+        Set the congested edges and their durations, replacing the previous ones
+
+        The penalty arrays are replaced rather than changed in place, so that a search
+        already holding the previous edge costs finishes on them.
+
+        Args:
+        - congestion (list): (edge ID, duration in seconds) of every congested edge
+
+        Returns:
+        - void
+        """
+
+        congested_edges = [item[0] for item in congestion]
+        congestion_duration = [item[1] for item in congestion]  # the duration of so called "traffic jam"
+        for edge in congested_edges:  # make sure that all congested_edges are in the net
+            if edge not in self.edge_index:
+                sys.exit(f'Error: Invalid congestion_edges {edge}')
+
+        # Dense per-edge penalty, the first duration given to an edge wins as .index() did
+        congestion_penalty = np.zeros(self.graph.num_edges)
+        congested_mask = np.zeros(self.graph.num_edges, dtype=bool)
+        for edge, duration in reversed(list(zip(congested_edges, congestion_duration))):
+            congestion_penalty[self.edge_index[edge]] = duration
+            congested_mask[self.edge_index[edge]] = True
+
+        self.replace_congestion(congested_edges, congestion_duration, congestion_penalty, congested_mask)
+
+
+    # Change the congestion of some edges
+    def update_congestion(self, changes):
+        """
+        Change the penalty of some edges in place of the others, e.g. from a live feed
+
+        Only the edges given are touched, and the edges whose penalty changed are logged
+        so that shortest-path trees can be repaired rather than searched again (see cache.py).
+
+        Args:
+        - changes (list): (edge ID, duration in seconds) of every edge to change, a duration of 0 clears its congestion
+
+        Returns:
+        - changed (np.ndarray): The indices of the edges whose penalty changed
+        """
+
+        durations = {}
+        for edge, duration in zip(self.congested_edges, self.congestion_duration):
+            durations.setdefault(edge, duration)  # the first duration given to an edge wins
+        congestion_penalty = self.congestion_penalty.copy()
+        congested_mask = self.congested_mask.copy()
+
+        for edge, duration in changes:
+            if edge not in self.edge_index:
+                sys.exit(f'Error: Invalid congestion_edges {edge}')
+            index = self.edge_index[edge]
+            if duration:
+                durations[edge] = duration
+                congestion_penalty[index] = duration
+                congested_mask[index] = True
+            else:
+                durations.pop(edge, None)
+                congestion_penalty[index] = 0
+                congested_mask[index] = False
+
+        return self.replace_congestion(list(durations), list(durations.values()), congestion_penalty, congested_mask)
+
+
+    def replace_congestion(self, congested_edges, congestion_duration, congestion_penalty, congested_mask):
+        # Swap in new congestion arrays, bump the version and log the edges whose penalty changed
+        if hasattr(self, 'congestion_penalty'):
+            changed = np.flatnonzero(congestion_penalty != self.congestion_penalty)
+        else:
+            changed = np.flatnonzero(congestion_penalty)
+
+        self.congested_edges = congested_edges
+        self.congestion_duration = congestion_duration
+        self.congestion_penalty = congestion_penalty
+        self.congested_mask = congested_mask
+        self.log_congestion(changed)
+        return changed
+
+
+    def log_congestion(self, changed):
+        # Bump the version and log the edges whose cost changed, for the caches of costs under the congestion
+        self.congestion_version += 1
+        self.congestion_log.append((self.congestion_version, changed))
+        if hasattr(self, '_route_lists'):
+            del self._route_lists  # new_route() rebuilds them with the new costs
+
+
+    # Set the time-of-day speed profiles
+    def set_profiles(self, profiles, departure_time = None):
+        """
+        Make the travel time of edges depend on the time they are entered
+
+        The time of an edge entered at t is edge_time / profiles.factor(t) plus its congestion penalty, with
+        t counted from departure_time. Route costs, the time-dependent searches and the agents follow the
+        clock, the other engines search on the speeds at departure_time (get_edge_costs()).
+
+        Args:
+        - profiles (speed_profiles or None): The profiles of every edge, None for free-flow speeds all day
+        - departure_time (float or None): The seconds after midnight the routes leave at, None to keep it
+
+        Returns:
+        - void
+        """
+
+        if profiles is not None and profiles.num_edges != self.graph.num_edges:
+            sys.exit(f'Error: Invalid profiles, {profiles.num_edges} edges given for {self.graph.num_edges}')
+
+        changed = np.zeros(self.graph.num_edges, dtype=bool)  # the edges whose cost at departure may change
+        for previous in (self.profiles, profiles):
+            if previous is not None:
+                changed |= previous.edge_row > 0
+        self.profiles = profiles
+        if departure_time is not None:
+            self.departure_time = float(departure_time)
+        self.log_congestion(np.flatnonzero(changed))
+
+
+    # The edges whose penalty changed since a version
+    def congestion_changes(self, since_version):
+        """
+        Args:
+        - since_version (int): A congestion_version seen before
+
+        Returns:
+        - changed (np.ndarray): The indices of the edges whose penalty changed after since_version,
+            or None if congestion_log does not reach back that far
+        """
+
+        if since_version == self.congestion_version:
+            return np.zeros(0, dtype=np.int64)
+        if not self.congestion_log or self.congestion_log[0][0] > since_version + 1:
+            return None
+        return np.unique(np.concatenate([changed for version, changed in self.congestion_log if version > since_version]))
+
+
     # Set starting and ending nodes
     def set_start_end(self, start_node, end_node):
         """
@@ -64,9 +249,9 @@ class traffic_env:
         """
 
         # Check if the nodes are valid
-        if start_node not in self.nodes:
+        if start_node not in self.node_index:
             sys.exit('Error: Invalid start node')
-        elif end_node not in self.nodes:
+        elif end_node not in self.node_index:
             sys.exit('Error: Invalid end node')
         else:
             self.start_node = start_node
@@ -93,26 +278,19 @@ class traffic_env:
         if direction not in ('incoming', 'outgoing', None):
             sys.exit(f'Invalid direction: {direction}')
 
-        edges = []
-        net_node = self.net.getNode(node)
+        if node not in self.node_index:
+            sys.exit(f'Error: Node {node} not in Nodes Space')
+        node_index = self.node_index[node]
 
         # Match node and direction to return edges
         if direction == 'incoming':
-            for edge in net_node.getIncoming():
-                if edge.getToNode().getID() == node:
-                    edges.append(edge.getID())
-
+            edge_indices = self.graph.incoming(node_index)
         elif direction == 'outgoing':
-            for edge in net_node.getOutgoing():
-                if edge.getFromNode().getID() == node:
-                    edges.append(edge.getID())
-
+            edge_indices = self.graph.outgoing(node_index)
         else:
-            for edge in net_node.getIncoming() + net_node.getOutgoing():
-                if edge.getToNode().getID() == node or edge.getFromNode().getID() == node:
-                    edges.append(edge.getID())
+            edge_indices = np.concatenate((self.graph.incoming(node_index), self.graph.outgoing(node_index)))
 
-        return edges
+        return [self.edges[edge_index] for edge_index in edge_indices]
 
 
     # Label edges based of junction from ( 0 Right -> 1 Up -> 2 Left -> 3 Down )
@@ -124,42 +302,8 @@ class traffic_env:
         - A dictionary of states (str) matched with its direction.
         """
 
-        edge_labelled = {edge: None for edge in self.edges}
-
-        def get_edge_label(node, outgoing_edges):
-            # get the nodes outgoing
-            start_x, start_y = self.net.getNode(node).getCoord()
-
-            # store edge angle
-            edge_angle = []
-
-            # through each outgoing edge
-            for edge in outgoing_edges:
-                # get the end node of the edge
-                end_node = self.decode_edge_to_node(edge)
-                end_x, end_y = self.net.getNode(end_node).getCoord()
-
-                # get the delta_x and delta_y
-                delta_x = end_x - start_x
-                delta_y = end_y - start_y
-
-                # get the angle by delta_x and delta_y
-                angle = math.degrees(math.atan2(delta_y, delta_x))
-
-                # save the edge and its corresponding angle
-                edge_angle.append((edge, angle))
-
-            # sort from 0 to 180 to -180 to 0 (Right -> Up -> Left -> Down -> Right)
-            edge_angle = sorted(edge_angle, key=lambda x: ((x[1] >= 0) * -180, x[1]))
-
-            # label edges
-            for i in range(len(edge_angle)):
-                edge_labelled[edge_angle[i][0]] = i  # edge_angle[i][0] is the ordered edge, btw [1] is its angle
-
-        for node in self.nodes:
-            outgoing_edges = self.decode_node_to_edges(node, 'outgoing')
-            if outgoing_edges:
-                get_edge_label(node, outgoing_edges)
+        # labels are computed once by self.graph when compiling the net
+        edge_labelled = dict(zip(self.edges, self.graph.edge_label.tolist()))
 
         return edge_labelled  # note that two edges in opposite directions have different ID (viewed as different edges)
 
@@ -178,18 +322,15 @@ class traffic_env:
 
         # Check if edges is in the edges list
         for edge in edges:
-            if edge not in self.edges:
+            if edge not in self.edge_index:
                 sys.exit(f'Error: Edge {edge} not in Edges Space')
 
         # Get the label of each edge
         edge_label = self.edge_label
 
         # Returns a list of actions
-        actions_lst = []
-        for action in self.action_space:
-            if action in [edge_label[edge] for edge in edges]:
-                actions_lst.append(action)
-        return actions_lst
+        labels = {edge_label[edge] for edge in edges}
+        return [action for action in self.action_space if action in labels]
 
 
     # Find the correspoding edge by given an edge set from a node and action
@@ -207,7 +348,7 @@ class traffic_env:
 
         # Check if edges is in the edges list
         for edge in edges:
-            if edge not in self.edges:
+            if edge not in self.edge_index:
                 sys.exit(f'Error: Edge {edge} not in Edges Space')
 
         # Get the direction of each edge
@@ -235,20 +376,40 @@ class traffic_env:
         """
 
         # Check if edges is in the edges list
-        if search_edge not in self.edges:
+        if search_edge not in self.edge_index:
             sys.exit('Error: Edge not in Edges Space!')
 
-        edge = self.net.getEdge(search_edge)
+        edge_index = self.edge_index[search_edge]
 
         if direction == 'start':
-            node = edge.getFromNode().getID()
+            node = self.nodes[self.graph.edge_from[edge_index]]
 
         elif direction == 'end':
-            node = edge.getToNode().getID()
+            node = self.nodes[self.graph.edge_to[edge_index]]
 
         return node
 
 
+    # Translate edge IDs to edge indices
+    def get_edge_indices(self, travel_edges, caller = 'get_edge_indices'):
+        """
+        Translate a list of edges to their indices in the compiled network
+
+        Args:
+        - travel_edges (list): The list of edges (str)
+        - caller (str): The name of the calling function, used in the error message
+
+        Returns:
+        - edge_indices (np.ndarray): The index of each edge
+        """
+
+        edge_index = self.edge_index
+        try:
+            return np.fromiter((edge_index[edge] for edge in travel_edges), dtype=np.int32, count=len(travel_edges))
+        except KeyError as error:
+            sys.exit(f'Error: Edge {error.args[0]} not in Edges Space ...call by {caller}')
+
+
     # Find the total distance travelled by giving a single edge / an edge_path
     def get_edge_distance(self, travel_edges):
         """
@@ -261,17 +422,13 @@ class traffic_env:
         - total_distance (float): The total distance travelled
         """
 
-        total_distance = 0
-
         if isinstance(travel_edges, str):  # make "" into [""]
             travel_edges = [travel_edges]
 
-        for edge in travel_edges:
-            # Check if edges are in the edges list
-            if edge not in self.edges:
-                sys.exit(f'Error: Edge {edge} not in Edges Space ...call by get_edge_distance')
-            # Sum up the distance of each edges
-            total_distance += self.net.getEdge(edge).getLength()
+        edge_indices = self.get_edge_indices(travel_edges, caller = 'get_edge_distance')
+
+        # Sum up the distance of each edges
+        total_distance = float(self.graph.edge_length[edge_indices].sum())
 
         return total_distance
 
@@ -292,22 +449,37 @@ class traffic_env:
         if isinstance(travel_edges, str):
             travel_edges = [travel_edges]
 
-        total_time = 0
-        for edge in travel_edges:
-            # Check if edges are in the edges list
-            if edge not in self.edges:
-                sys.exit(f'Error: Edge {edge} not in Edges Space ...call by get_edge_time')
-            # Sum up the distance of each edges
-            total_time += self.net.getEdge(edge).getLength() / self.net.getEdge(edge).getSpeed()
+        edge_indices = self.get_edge_indices(travel_edges, caller = 'get_edge_time')
 
-        # time punishment for the route
-        for i in range(len(travel_edges)):  # time punishment on a specific edge because of only congested edges
-            if travel_edges[i] in self.congested_edges:
-                total_time += self.congestion_duration[self.congested_edges.index(travel_edges[i])]
+        # Sum up the time of each edges, plus the time punishment on congested edges
+        if self.profiles is not None:  # each edge at the time it is entered
+            return self.get_route_times(edge_indices)[0]
+        total_time = float(self.graph.edge_time[edge_indices].sum() + self.congestion_penalty[edge_indices].sum())
 
         return total_time
 
 
+    # Find the cost of every edge under the evaluation type
+    def get_edge_costs(self, evaluation = None):
+        """
+        Cost of every edge in the compiled network, as used by the routing engines
+
+        Args:
+        - evaluation (str or None): "distance" or "time", defaults to self.evaluation
+
+        Returns:
+        - edge_costs (np.ndarray [num_edges]): The length of each edge, or its free-flow time plus congestion penalty,
+            at the speeds of departure_time if there are profiles
+        """
+
+        evaluation = evaluation or self.evaluation
+        if evaluation in ("time"):
+            if self.profiles is not None:
+                return self.profiles.travel_time(self.graph.edge_time, np.arange(self.graph.num_edges), self.departure_time) + self.congestion_penalty
+            return self.graph.edge_time + self.congestion_penalty
+        return self.graph.edge_length
+
+
     # Find the time offset caused by the traffic light
     def get_tl_offset(self, travel_edges):
         """
@@ -315,12 +487,11 @@ class traffic_env:
 
         Args:
         - travel_edges: The list of edges of the selected route.
-        - tls: The dictionary of tls data
 
         Return:
-        - (current_time - self.get_edge_time(travel_edges)) (float): The time offset caused by the traffic light
-            where current_time: the time taken to travel the selected route
-                  get_edge_time(travel_edges): the time taken to travel the selected route w/o considering traffic light
+        - total_wait (float): The time spent waiting at red lights, so that
+            get_edge_time(travel_edges) + get_tl_offset(travel_edges) is the arrival time of the route.
+            The clock runs on the travel time plus congestion penalty from departure_time, as in the time-dependent search of dijkstra.py
         """
         self.tls_meet = []  # to print on map
         self.congestion_meet = []  # to print on map
@@ -328,52 +499,200 @@ class traffic_env:
         if isinstance(travel_edges, str):
             travel_edges = [travel_edges]
 
-        current_time = 0
-        for edge in range(len(travel_edges) - 1):
-            current_edge = travel_edges[edge]
-            next_edge = travel_edges[edge+1]
+        edge_indices = self.get_edge_indices(travel_edges, caller = 'get_tl_offset')
+        if self.metrics is not None:
+            self.metrics.count('route_evaluations')
 
-            # 0. Check if edges are in the edges list
-            if current_edge not in self.edges:
-                sys.exit(f'Error: Edge {current_edge} not in Edges Space ...call by get_tl_offset')
+        # congested edges and lights met, to print on map
+        congested = edge_indices[:-1][self.congested_mask[edge_indices[:-1]]]
+        self.congestion_meet = [self.edges[edge] for edge in dict.fromkeys(congested.tolist())]
 
-            if current_edge in self.congested_edges and current_edge not in self.congestion_meet:
-                self.congestion_meet.append(current_edge)  # to print on map
+        total_wait, signalised = self.get_route_waits(edge_indices)
+        self.tls_meet = [self.nodes[self.graph.edge_to[edge_indices[position]]] for position in signalised]
 
-            # 1. Sum up the distance of each edges
-            current_time += self.net.getEdge(current_edge).getLength() / self.net.getEdge(current_edge).getSpeed()
+        return total_wait
 
-            # 2. Find the end point of the edge
-            tl = self.net.getEdge(current_edge).getToNode().getID()
-            if tl not in self.tls_space:
-                continue
 
-            self.tls_meet.append(tl)  # to print on map
+    # Find the waits of a route given by edge indices
+    def get_route_waits(self, edge_indices):
+        """
+        Sum up the red-light waits along a route
 
-            # 3. Find the connection of current_edge and next_edge
-            connections_set = self.net.getTLS(tl).getConnections()
+        Args:
+        - edge_indices (np.ndarray): The indices of the edges of the route
 
-            for j in range(len(connections_set)):
-                connection = connections_set[j]
-                if connection[0] in self.net.getEdge(current_edge).getLanes() and connection[1] in self.net.getEdge(next_edge).getLanes():
-                    break
+        Return:
+        - total_wait (float): The time spent waiting at red lights
+        - signalised (list): The positions i in the route where the movement (edge i, edge i+1) has a light
+        """
 
-            # 4. Derive that this connection is the nth link of this tl_node
-            tl_phase = self.tls[tl][connection[2]]
+        edge_indices = np.asarray(edge_indices, dtype=np.int32)
+        if len(edge_indices) < 2:
+            return 0.0, []
+        return self.get_route_times(edge_indices, last_edge = False)[1:]
 
-            idle_time = 0
-            if tl_phase[int(current_time) % 90] != "r":
-                continue
+
+    # Follow the clock along a route given by edge indices
+    def get_route_times(self, edge_indices, last_edge = True):
+        """
+        Travel a route from departure_time, every edge at the speed of the time it is entered
+
+        Args:
+        - edge_indices (np.ndarray): The indices of the edges of the route
+        - last_edge (bool): Travel the last edge as well, its time has no wait after it
+
+        Return:
+        - total_time (float): The time spent on the edges, as get_edge_time()
+        - total_wait (float): The time spent waiting at red lights, as get_tl_offset()
+        - signalised (list): The positions i in the route where the movement (edge i, edge i+1) has a light
+        """
+
+        edge_indices = np.asarray(edge_indices, dtype=np.int32)
+        if self.profiles is None:  # the costs of the route's edges only, as get_edge_costs("time") of them
+            edge_cost = (self.graph.edge_time[edge_indices] + self.congestion_penalty[edge_indices]).tolist()
+        has_light = self.tl_node_mask[self.graph.edge_to[edge_indices[:-1]]].tolist()  # only these movements need a lookup
+        edge_indices = edge_indices.tolist()
+        movement_link = self.signals.movement_link
+        get_wait = self.signals.get_wait
+        profiles = self.profiles
+        if profiles is not None:
+            edge_time = self.graph.edge_time
+            penalty = self.congestion_penalty
+
+        current_time = self.departure_time
+        total_time = 0.0
+        total_wait = 0.0
+        signalised = []
+        for position in range(len(edge_indices) - (0 if last_edge else 1)):
+            # 1. Sum up the time of each edges
+            if profiles is None:
+                travel_time = edge_cost[position]
             else:
-                for phase_index in range(90):
-                    if tl_phase[(int(current_time) + phase_index) % 90] != "r":
-                        idle_time = phase_index
-                        break
+                edge = edge_indices[position]
+                travel_time = edge_time[edge] / profiles.factor_at(edge, current_time) + penalty[edge]
+            current_time += travel_time
+            total_time += travel_time
+
+            # 2. Find the light controlling the movement
+            if position + 1 == len(edge_indices) or not has_light[position] or (edge_indices[position], edge_indices[position+1]) not in movement_link:
+                continue
+            signalised.append(position)
 
-            # 5. Sum up the idle
+            # 3. Sum up the idle
+            idle_time = get_wait(edge_indices[position], edge_indices[position+1], current_time)
             current_time += idle_time
+            total_wait += idle_time
+
+        return float(total_time), float(total_wait), signalised
+
+
+    # Find the cost of a route given by edge indices
+    def get_route_cost(self, edge_indices, evaluation = None):
+        """
+        Cost of a route given by edge indices, as reported for results: the distance, or
+        get_edge_time() + get_tl_offset() for time, without the bookkeeping to print on map
+
+        Args:
+        - edge_indices (list or np.ndarray): The indices of the edges of the route
+        - evaluation (str or None): "distance" or "time", defaults to self.evaluation
+
+        Return:
+        - cost (float)
+        """
+
+        edge_indices = np.asarray(edge_indices, dtype=np.int32)
+        evaluation = evaluation or self.evaluation
+        if self.metrics is not None:
+            self.metrics.count('route_evaluations')
+        if evaluation in ("time"):
+            if self.profiles is not None:
+                total_time, total_wait, _ = self.get_route_times(edge_indices)
+                return total_time + total_wait
+            total_time = float(self.graph.edge_time[edge_indices].sum() + self.congestion_penalty[edge_indices].sum())  # same sum as get_edge_time()
+            return total_time + self.get_route_waits(edge_indices)[0]
+        return float(self.graph.edge_length[edge_indices].sum())
+
+
+    # Find the cost of many routes at once
+    def get_routes_cost(self, routes, evaluation = None):
+        """
+        Cost of many candidate routes, as get_route_cost() of each (up to rounding), with every
+        route stepped edge by edge together: the profiles and the lights are looked up with NumPy
+
+        Args:
+        - routes (list): The edge indices (list or np.ndarray) of each route
+        - evaluation (str or None): "distance" or "time", defaults to self.evaluation
+
+        Return:
+        - costs (np.ndarray [len(routes)])
+        """
+
+        lengths = np.fromiter((len(route) for route in routes), dtype=np.int64, count=len(routes))
+        if self.metrics is not None:
+            self.metrics.count('route_evaluations', len(routes))
+        padded = np.zeros((len(routes), lengths.max(initial=0)), dtype=np.int32)
+        for row, route in enumerate(routes):
+            padded[row, :lengths[row]] = route
+        inside = np.arange(padded.shape[1]) < lengths[:, None]
+
+        evaluation = evaluation or self.evaluation
+        if evaluation not in ("time"):
+            return np.where(inside, self.graph.edge_length[padded], 0).sum(axis=1)
+
+        clock = np.full(len(routes), self.departure_time)
+        for position in range(padded.shape[1]):
+            active = np.flatnonzero(inside[:, position])
+            edges = padded[active, position]
+
+            # 1. Wait at the light between the previous edge and this one
+            if position > 0:
+                previous = padded[active, position-1]
+                lit = self.tl_node_mask[self.graph.edge_to[previous]]
+                if lit.any():
+                    clock[active[lit]] += self.signals.get_waits(previous[lit], edges[lit], clock[active[lit]])
+
+            # 2. Travel the edge
+            if self.profiles is None:
+                clock[active] += self.graph.edge_time[edges] + self.congestion_penalty[edges]
+            else:
+                clock[active] += self.profiles.travel_time(self.graph.edge_time, edges, clock[active]) + self.congestion_penalty[edges]
+
+        return clock - self.departure_time
+
+
+    # Start the running cost of a route travelled edge by edge
+    def new_route(self):
+        """
+        Returns:
+        - route (route_cost): An empty route, whose distance, time and waits are updated in O(1) per edge appended
+        """
+
+        if not hasattr(self, '_route_lists'):  # per-edge Python lists shared by every route
+            self._route_lists = (
+                self.graph.edge_length.tolist(),
+                self.get_edge_costs("time").tolist(),
+                self.tl_node_mask[self.graph.edge_to].tolist(),  # whether a light may end the edge
+                self.graph.edge_time.tolist(),
+                self.congestion_penalty.tolist(),
+            )
+        return route_cost(self, *self._route_lists)
+
+
+    # Find the waiting time at the end of an edge
+    def get_tl_wait(self, edge_index, next_edge_index, current_time):
+        """
+        Time to wait at the traffic light between two consecutive edges
+
+        Args:
+        - edge_index, next_edge_index (int): The indices of the movement's edges
+        - current_time (float): The arrival time at the end of edge_index
+
+        Return:
+        - idle_time (float): 0 if the light is not red, otherwise the time until the next non-red second starts.
+            Leaving at that exact moment keeps the waits FIFO, arriving later never means leaving earlier
+        """
 
-        return current_time - self.get_edge_time(travel_edges)
+        return self.signals.get_wait(edge_index, next_edge_index, current_time)
 
 
     # ------ Graph Visualisation ------
@@ -390,16 +709,15 @@ class traffic_env:
         - Plot of network
         """
 
-        nodes_dict = {}  # a list of x_coord and y_coord of every nodes
-        for node in self.nodes:
-            x_coord, y_coord = self.net.getNode(node).getCoord()
-            nodes_dict[node] = (x_coord, y_coord)
+        import networkx as nx  # plotting libraries are only imported to plot, they dominate the start-up otherwise
+        import matplotlib.pyplot as plt
+
+        nodes_dict = dict(zip(self.nodes, zip(self.graph.node_x.tolist(), self.graph.node_y.tolist())))  # a list of x_coord and y_coord of every nodes
 
-        edges_dict = {}  # a list of from_point and to_point of every edges
-        for edge in self.edges:
-            from_id = self.net.getEdge(edge).getFromNode().getID()
-            to_id = self.net.getEdge(edge).getToNode().getID()
-            edges_dict[edge] = (from_id, to_id)
+        edges_dict = {  # a list of from_point and to_point of every edges
+            edge: (self.nodes[from_index], self.nodes[to_index])
+            for edge, from_index, to_index in zip(self.edges, self.graph.edge_from.tolist(), self.graph.edge_to.tolist())
+        }
 
         # Draw the network layout
         net_G = nx.Graph()
@@ -451,19 +769,159 @@ class traffic_env:
 
         Args:
         - num_episodes (int): number of episodes it took for the model to converge, a trimmed one
-        - logs (dict): the logs of the edges and states it took to converge
+        - logs (episode_log or dict): the logs of the edges and states it took to converge
 
         Return:
-        - Plot of the evaluation (time/distance) at each episode
+        - Plot of the evaluation (time/distance) at each episode, none when headless (Agg backend)
         """
 
+        import matplotlib
+        if matplotlib.get_backend().lower() == 'agg':  # batch, sweep and bench workers: nothing is shown, the figures would only pile up
+            return
+        import matplotlib.pyplot as plt
+
         plt.title("Performance of Agent")
         plt.xlabel("Episode")
         if self.evaluation in ("time"):
             plt.ylabel("Time")
-            evaluation = [(self.get_edge_time(logs[episode][1]) + self.get_tl_offset(logs[episode][1]))/60  for episode in range(num_episodes)]
+            if hasattr(logs, 'time'):  # episode_log, costs are already columns
+                evaluation = logs.time[:num_episodes] / 60
+            else:
+                evaluation = [(self.get_edge_time(logs[episode][1]) + self.get_tl_offset(logs[episode][1]))/60  for episode in range(num_episodes)]
         else:
             plt.ylabel("Distance")
-            evaluation = [self.get_edge_distance(logs[episode][1]) for episode in range(num_episodes)]
+            if hasattr(logs, 'distance'):
+                evaluation = logs.distance[:num_episodes]
+            else:
+                evaluation = [self.get_edge_distance(logs[episode][1]) for episode in range(num_episodes)]
         plt.plot(range(num_episodes), evaluation)
         plt.show()
+        plt.close()
+
+
+class route_cost:
+    def __init__ (self, env, edge_length, edge_cost, ends_at_light, edge_time, penalty):
+        """
+        Running cost of a route, made by traffic_env.new_route()
+
+        The clock and the waits follow get_route_times(): the clock runs from env.departure_time on the
+        travel time plus congestion penalty, and the wait of a movement is looked up when its second edge is appended.
+
+        Args:
+        - env (traffic_env): The environment of the route
+        - edge_length, edge_cost (list): The length and the free-flow time plus congestion penalty of every edge
+        - ends_at_light (list): Whether a light may end each edge
+        - edge_time, penalty (list): The free-flow time and the congestion penalty of every edge, for env.profiles
+        """
+
+        self.evaluation = env.evaluation
+        self.get_wait = env.signals.get_wait
+        self.profiles = env.profiles
+        self.edge_length = edge_length
+        self.edge_cost = edge_cost
+        self.ends_at_light = ends_at_light
+        self.edge_time = edge_time
+        self.penalty = penalty
+
+        self.last_edge = None
+        self.distance = 0.0  # metres
+        self.time = 0.0  # free-flow time plus congestion penalty, as get_edge_time()
+        self.wait = 0.0  # red-light waits, as get_tl_offset()
+        self.clock = env.departure_time  # time the end of the last edge is reached
+
+
+    def get_idle(self, edge_index):
+        # Wait at the light between the last edge and edge_index
+        if self.last_edge is None or not self.ends_at_light[self.last_edge]:
+            return 0
+        return self.get_wait(self.last_edge, edge_index, self.clock)
+
+
+    def get_travel(self, edge_index, clock):
+        # Time of edge_index entered at clock
+        if self.profiles is None:
+            return self.edge_cost[edge_index]
+        return self.edge_time[edge_index] / self.profiles.factor_at(edge_index, clock) + self.penalty[edge_index]
+
+
+    def append(self, edge_index):
+        """
+        Travel one more edge
+
+        Args:
+        - edge_index (int): The index of the edge
+        """
+
+        idle_time = self.get_idle(edge_index)
+        self.clock += idle_time
+        self.wait += idle_time
+        travel_time = self.get_travel(edge_index, self.clock)
+        self.clock += travel_time
+        self.time += travel_time
+        self.distance += self.edge_length[edge_index]
+        self.last_edge = edge_index
+
+
+    def cost(self, evaluation = None):
+        """
+        Args:
+        - evaluation (str or None): "distance" or "time", defaults to the env's evaluation
+
+        Returns:
+        - The cost of the route as get_route_cost(): the distance, or get_edge_time() + get_tl_offset() for time
+        """
+
+        if (evaluation or self.evaluation) in ("time"):
+            return self.time + self.wait
+        return self.distance
+
+
+    def cost_with(self, edge_index, evaluation = None):
+        """
+        Returns:
+        - The cost of the route if edge_index were appended, the route itself is left unchanged
+        """
+
+        if (evaluation or self.evaluation) in ("time"):
+            idle_time = self.get_idle(edge_index)
+            return self.time + self.wait + idle_time + self.get_travel(edge_index, self.clock + idle_time)
+        return self.distance + self.edge_length[edge_index]
+
+
+def read_programs(network_file, tls_file = None):
+    """
+    The traffic light programs, from the snapshot of network_file while it is valid, else read from the XML
+
+    Args:
+    - network_file (str): The .net.xml(.gz) of the environment
+    - tls_file (str or None): A .tll.xml, None for the programs embedded in network_file. Pass it to traffic_env as well,
+        so that its snapshot keeps the programs for the next start
+
+    Returns:
+    - tls (dict): As tls_from_tllxml()
+    """
+
+    tls = snapshot.load_tls(network_file, tls_file)
+    if tls is None:
+        from models import loader  # the XML parser, only imported when there is no snapshot to take the programs from
+        tls = loader.read_tls(tls_file or network_file)
+    return tls
+
+
+def worker_env(args):
+    """
+    Build the environment of worker_args() in a worker process, the network from its snapshot (or the arrays shipped)
+    and then the congestion of the parent, never a random one, even when it is empty
+
+    Args:
+    - args (tuple): traffic_env.worker_args() of the parent
+
+    Returns:
+    - env (traffic_env)
+    """
+
+    network_file, tls, compiled, congestion, evaluation, (profiles, departure_time) = args
+    env = traffic_env(network_file, tls, evaluation=evaluation, compiled=compiled)
+    env.set_congestion(congestion)
+    env.set_profiles(profiles, departure_time)
+    return env
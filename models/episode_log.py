@@ -0,0 +1,222 @@
+import struct
+import numpy as np
+
+
+HEADER_SIZE = 256  # bytes of a spilled .npy header, fixed so that the shape can be rewritten in place
+EPISODE_DTYPE = np.dtype([('length', '<i4'), ('time', '<f8'), ('distance', '<f8')])
+
+
+def _write_header(file, dtype, shape):
+    # .npy version 1.0 header padded to HEADER_SIZE, file is left at the start of the data
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape}).encode('latin1')
+    file.seek(0)
+    file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', HEADER_SIZE - 10) + header.ljust(HEADER_SIZE - 11) + b'\n')
+
+
+class episode_log:
+    def __init__ (self, env, start_index, window = None, spill_file = None):
+        """
+        Array-backed log of the episodes of a training
+
+        The edge indices of every episode are appended to one flat int32 buffer, indexed by an offset
+        per episode, next to per-episode length, time and distance columns. Only the edges of the last
+        window episodes stay in memory, and with spill_file every episode is also streamed to disk.
+
+        logs[episode] still gives [node_path, edge_path] as IDs, built only for that episode.
+
+        Args:
+        - env (traffic_env): The environment the episodes ran in
+        - start_index (int): The node index every episode starts from
+        - window (int or None): The number of recent episodes whose edges are kept in memory (at least 1), None to keep all
+        - spill_file (str or None): The prefix of the files to stream to, f'{spill_file}.edges.npy' holds the
+            edge indices and f'{spill_file}.episodes.npy' the (length, time, distance) records
+        """
+
+        self.env = env
+        self.start_index = start_index
+        self.window = window if window is None else max(1, window)
+        self.spill_file = spill_file
+
+        # 1. Per-episode columns, kept for every episode
+        self.num_episodes = 0
+        self._offsets = np.zeros(1024 + 1, dtype=np.int64)  # episode i is stream[offsets[i]:offsets[i+1]]
+        self._episodes = np.zeros(1024, dtype=EPISODE_DTYPE)
+
+        # 2. The end of the edge stream held in memory, from stream offset self._base
+        self._base = 0
+        self._edges = np.zeros(4096, dtype=np.int32)
+
+        # 3. Files streamed to
+        self._files = None
+        self._spilled = None  # memory-mapped (edges, episodes) of the files, valid until the next append
+        if spill_file is not None:
+            self._files = (open(f'{spill_file}.edges.npy', 'wb+'), open(f'{spill_file}.episodes.npy', 'wb+'))
+            _write_header(self._files[0], np.dtype('<i4'), (0,))
+            _write_header(self._files[1], EPISODE_DTYPE, (0,))
+
+
+    @classmethod
+    def load(cls, env, spill_file, start_index):
+        """
+        Open a spilled log, memory-mapped
+
+        Args:
+        - env (traffic_env): The environment the episodes ran in
+        - spill_file (str): The prefix the log was streamed to
+        - start_index (int): The node index every episode started from
+
+        Returns:
+        - An episode_log holding no edges in memory, every episode is read from the files
+        """
+
+        log = cls(env, start_index)
+        log.spill_file = spill_file
+        edges = np.load(f'{spill_file}.edges.npy', mmap_mode='r')
+        episodes = np.load(f'{spill_file}.episodes.npy', mmap_mode='r')
+        log.num_episodes = len(episodes)
+        log._episodes = episodes
+        log._offsets = np.zeros(len(episodes) + 1, dtype=np.int64)
+        np.cumsum(episodes['length'], out=log._offsets[1:])
+        log._base = int(log._offsets[-1])
+        log._spilled = (edges, episodes)
+        return log
+
+
+    def append(self, edge_indices, time, distance):
+        """
+        Log one episode
+
+        Args:
+        - edge_indices (list or np.ndarray): The edge indices travelled
+        - time (float): get_edge_time() + get_tl_offset() of the episode
+        - distance (float): get_edge_distance() of the episode
+
+        Returns:
+        - episode (int): The number of the episode logged
+        """
+
+        edge_indices = np.asarray(edge_indices, dtype=np.int32)
+        episode = self.num_episodes
+
+        # 1. Columns, doubled when full
+        if episode == len(self._episodes):
+            self._episodes = np.resize(self._episodes, 2 * len(self._episodes))
+            self._offsets = np.resize(self._offsets, len(self._episodes) + 1)
+        start = int(self._offsets[episode])
+        end = start + len(edge_indices)
+        self._offsets[episode + 1] = end
+        self._episodes[episode] = (len(edge_indices), time, distance)
+        self.num_episodes += 1
+
+        # 2. Edges, dropping the episodes out of the window once they fill half the buffer
+        if self.window is not None:
+            keep_from = int(self._offsets[max(0, self.num_episodes - self.window)])
+            if keep_from - self._base >= len(self._edges) // 2:
+                used = start - self._base
+                kept = self._edges[keep_from - self._base:used].copy()
+                self._edges[:len(kept)] = kept
+                self._base = keep_from
+        if end - self._base > len(self._edges):
+            self._edges = np.resize(self._edges, max(2 * len(self._edges), end - self._base))
+        self._edges[start - self._base:end - self._base] = edge_indices
+
+        # 3. Stream to disk
+        if self._files is not None:
+            self._files[0].seek(0, 2)
+            self._files[0].write(edge_indices.astype('<i4', copy=False).tobytes())
+            self._files[1].seek(0, 2)
+            self._files[1].write(self._episodes[episode:episode + 1].tobytes())
+            self._spilled = None
+
+        return episode
+
+
+    def flush(self):
+        # Write the current shapes into the spilled headers, so that the files load as .npy
+        if self._files is None:
+            return
+        _write_header(self._files[0], np.dtype('<i4'), (int(self._offsets[self.num_episodes]),))
+        _write_header(self._files[1], EPISODE_DTYPE, (self.num_episodes,))
+        for file in self._files:
+            file.flush()
+
+
+    def close(self):
+        """
+        Finish the spilled files, the log can still be read from them afterwards
+        """
+
+        if self._files is None:
+            return
+        self.flush()
+        for file in self._files:
+            file.close()
+        self._files = None
+        self._spilled = None
+
+
+    def edges(self, episode):
+        """
+        Args:
+        - episode (int): The number of the episode
+
+        Returns:
+        - The edge indices (np.ndarray) travelled in the episode
+        """
+
+        if not 0 <= episode < self.num_episodes:
+            raise KeyError(episode)
+        start, end = int(self._offsets[episode]), int(self._offsets[episode + 1])
+        if start >= self._base:
+            return self._edges[start - self._base:end - self._base]
+
+        if self.spill_file is None:
+            raise KeyError(f'Episode {episode} is out of the log window of {self.window} episodes')
+        if self._spilled is None:
+            self.flush()
+            self._spilled = (np.load(f'{self.spill_file}.edges.npy', mmap_mode='r'), None)
+        return self._spilled[0][start:end]
+
+
+    def nodes(self, episode):
+        """
+        Returns:
+        - The node indices (np.ndarray) visited in the episode, from the start node
+        """
+
+        return np.concatenate(([self.start_index], self.env.graph.edge_to[self.edges(episode)])).astype(np.int32)
+
+
+    @property
+    def length(self):
+        # The number of edges travelled in each episode (np.ndarray [num_episodes])
+        return self._episodes['length'][:self.num_episodes]
+
+
+    @property
+    def time(self):
+        # get_edge_time() + get_tl_offset() of each episode (np.ndarray [num_episodes])
+        return self._episodes['time'][:self.num_episodes]
+
+
+    @property
+    def distance(self):
+        # get_edge_distance() of each episode (np.ndarray [num_episodes])
+        return self._episodes['distance'][:self.num_episodes]
+
+
+    # As the dict of lists it replaces, logs[episode] = [node_path, edge_path]
+    def __getitem__(self, episode):
+        return [[self.env.nodes[node] for node in self.nodes(episode).tolist()], [self.env.edges[edge] for edge in self.edges(episode).tolist()]]
+
+
+    def __len__(self):
+        return self.num_episodes
+
+
+    def __iter__(self):
+        return iter(range(self.num_episodes))
+
+
+    def __contains__(self, episode):
+        return isinstance(episode, (int, np.integer)) and 0 <= episode < self.num_episodes
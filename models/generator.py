@@ -0,0 +1,355 @@
+import sys
+import gzip
+import math
+import numpy as np
+
+from models import network
+from models import signals
+
+
+# Share of edges congested, as traffic_env's congestion_level
+CONGESTION_LEVELS = {'low': 0.05, 'medium': 0.10, 'high': 0.20}
+
+
+class synthetic_city:
+    def __init__ (self, node_x, node_y, roads, arterial, signal_density = 0.3, seed = 0, speeds = (13.89, 8.33), cycle = 90, yellow = 3):
+        """
+        Synthetic road network, for stress tests at any size without netconvert
+
+        Every road is two-way: road i gives edge "e<i>" from its first to its second junction and "-e<i>" back,
+        as SUMO names the two directions of a road. A share of the junctions where at least three roads meet
+        get a fixed-time light with two phase groups, the approaches closer to the x axis and those closer to
+        the y axis. Use the classmethods grid(), radial() and planar() rather than this constructor.
+
+        Args:
+        - node_x, node_y (array-like): The coordinates of the junctions, in metres
+        - roads (array-like [num_roads, 2]): The junction indices at the ends of each road
+        - arterial (array-like [num_roads]): Whether each road is an arterial (speeds[0]) or a local street (speeds[1])
+        - signal_density (float): The share of junctions of degree 3 or more with a light
+        - seed (int): The seed of the lights picked and their offsets
+        - speeds (tuple): The speed of arterials and of local streets, in metres per second
+        - cycle, yellow (int): The cycle of every light and the yellow time after each green, in seconds
+        """
+
+        if not 0 <= signal_density <= 1:
+            sys.exit('Error: Invalid signal_density, provide a share between 0 and 1')
+        roads = np.asarray(roads, dtype=np.int64).reshape(-1, 2)
+        arterial = np.asarray(arterial, dtype=bool)
+
+        # 1. Junctions and edges, the two directions of a road next to each other, to the centimetre as written by write_net()
+        self.node_x = np.round(np.asarray(node_x, dtype=np.float64), 2)
+        self.node_y = np.round(np.asarray(node_y, dtype=np.float64), 2)
+        self.num_nodes = len(self.node_x)
+        self.edge_from = np.column_stack((roads[:, 0], roads[:, 1])).reshape(-1).astype(np.int32)
+        self.edge_to = np.column_stack((roads[:, 1], roads[:, 0])).reshape(-1).astype(np.int32)
+        self.edge_speed = np.where(np.repeat(arterial, 2), speeds[0], speeds[1])
+        self.edge_length = np.round(np.maximum(np.hypot(self.node_x[self.edge_to] - self.node_x[self.edge_from], self.node_y[self.edge_to] - self.node_y[self.edge_from]), 1.0), 2)
+        self.num_edges = len(self.edge_from)
+        self.node_ids = [f'n{node}' for node in range(self.num_nodes)]
+        self.edge_ids = [f'{sign}e{road}' for road in range(len(roads)) for sign in ('', '-')]
+
+        # 2. Lights, at a share of the junctions where three roads or more meet
+        rng = np.random.default_rng(seed)
+        degree = np.bincount(self.edge_to, minlength=self.num_nodes)
+        candidates = np.flatnonzero(degree >= 3)
+        self.signalised = np.zeros(self.num_nodes, dtype=bool)
+        self.signalised[rng.choice(candidates, int(round(len(candidates) * signal_density)), replace=False)] = True
+        self.tls, self.connections = self.build_signals(rng, cycle, yellow)
+
+
+    @classmethod
+    def grid(cls, num_junctions, spacing = 100.0, arterial_every = 5, **options):
+        """
+        Manhattan grid, every arterial_every-th row and column being an arterial
+
+        Args:
+        - num_junctions (int): The number of junctions, about a square of that many
+        - spacing (float): The length of a block, in metres
+        - options: signal_density, seed, speeds, cycle, yellow, as for the constructor
+
+        Returns:
+        - A synthetic_city with about 4 edges per junction
+        """
+
+        rows = max(2, int(round(math.sqrt(num_junctions))))
+        cols = max(2, int(math.ceil(num_junctions / rows)))
+        row, col = np.divmod(np.arange(rows * cols), cols)
+        node = row * cols + col
+
+        horizontal = col < cols - 1
+        vertical = row < rows - 1
+        roads = np.concatenate((
+            np.column_stack((node[horizontal], node[horizontal] + 1)),
+            np.column_stack((node[vertical], node[vertical] + cols)),
+        ))
+        arterial = np.concatenate((row[horizontal] % arterial_every == 0, col[vertical] % arterial_every == 0))
+        return cls(col * spacing, row * spacing, roads, arterial, **options)
+
+
+    @classmethod
+    def radial(cls, num_junctions, spokes = 16, ring_spacing = 150.0, arterial_every = 4, **options):
+        """
+        Ring-and-spoke city around one centre, every arterial_every-th spoke and ring being an arterial
+
+        Args:
+        - num_junctions (int): The number of junctions, rounded up to full rings
+        - spokes (int): The number of radial roads, the centre has that many edges out (beyond the 4 actions of the agents if more than 4)
+        - ring_spacing (float): The distance between rings, in metres
+        - options: signal_density, seed, speeds, cycle, yellow, as for the constructor
+
+        Returns:
+        - A synthetic_city
+        """
+
+        rings = max(1, int(math.ceil((num_junctions - 1) / spokes)))
+        ring, spoke = np.divmod(np.arange(rings * spokes), spokes)
+        ring += 1
+        angle = 2 * np.pi * spoke / spokes
+        node = 1 + (ring - 1) * spokes + spoke  # the centre is junction 0
+
+        inner = ring == 1
+        outer = ring < rings
+        roads = np.concatenate((
+            np.column_stack((np.zeros(spokes, dtype=np.int64), node[inner])),  # centre to the first ring
+            np.column_stack((node, 1 + (ring - 1) * spokes + (spoke + 1) % spokes)),  # along the rings
+            np.column_stack((node[outer], node[outer] + spokes)),  # along the spokes
+        ))
+        arterial = np.concatenate((
+            spoke[inner] % arterial_every == 0,
+            ring % arterial_every == 0,
+            spoke[outer] % arterial_every == 0,
+        ))
+        node_x = np.concatenate(([0.0], ring * ring_spacing * np.cos(angle)))
+        node_y = np.concatenate(([0.0], ring * ring_spacing * np.sin(angle)))
+        return cls(node_x, node_y, roads, arterial, **options)
+
+
+    @classmethod
+    def planar(cls, num_junctions, spacing = 100.0, jitter = 0.25, removal = 0.25, diagonals = 0.15, arterial_every = 5, **options):
+        """
+        Irregular planar city: a grid with its junctions moved at random, some streets removed and some blocks cut
+        by a diagonal, still connected and without crossing roads
+
+        Args:
+        - num_junctions (int): The number of junctions
+        - spacing (float): The mean length of a block, in metres
+        - jitter (float): How far junctions move, as a share of spacing (below 0.25 keeps roads from crossing)
+        - removal (float): The share of streets removed, never those keeping the city connected
+        - diagonals (float): The share of blocks cut by a diagonal
+        - options: signal_density, seed, speeds, cycle, yellow, as for the constructor
+
+        Returns:
+        - A synthetic_city
+        """
+
+        rng = np.random.default_rng(options.get('seed', 0))
+        rows = max(2, int(round(math.sqrt(num_junctions))))
+        cols = max(2, int(math.ceil(num_junctions / rows)))
+        row, col = np.divmod(np.arange(rows * cols), cols)
+        node = row * cols + col
+
+        # 1. Grid streets, a random spanning tree of them always kept
+        horizontal = col < cols - 1
+        vertical = row < rows - 1
+        roads = np.concatenate((np.column_stack((node[horizontal], node[horizontal] + 1)), np.column_stack((node[vertical], node[vertical] + cols))))
+        arterial = np.concatenate((row[horizontal] % arterial_every == 0, col[vertical] % arterial_every == 0))
+        parent = list(range(rows * cols))
+
+        def find(item):
+            while parent[item] != item:
+                parent[item] = parent[parent[item]]
+                item = parent[item]
+            return item
+
+        keep = rng.random(len(roads)) >= removal
+        for road in rng.permutation(len(roads)).tolist():
+            first, second = find(int(roads[road, 0])), find(int(roads[road, 1]))
+            if first != second:
+                parent[first] = second
+                keep[road] = True
+
+        # 2. One diagonal in some blocks
+        corner = node[horizontal & vertical]
+        corner = corner[rng.random(len(corner)) < diagonals]
+        rising = rng.random(len(corner)) < 0.5
+        cut = np.where(rising[:, None], np.column_stack((corner, corner + cols + 1)), np.column_stack((corner + 1, corner + cols)))
+
+        roads = np.concatenate((roads[keep], cut))
+        arterial = np.concatenate((arterial[keep], np.zeros(len(cut), dtype=bool)))
+        node_x = (col + rng.uniform(-jitter, jitter, len(node))) * spacing
+        node_y = (row + rng.uniform(-jitter, jitter, len(node))) * spacing
+        return cls(node_x, node_y, roads, arterial, **options)
+
+
+    def build_signals(self, rng, cycle, yellow):
+        """
+        One light per signalised junction, with a link for every movement through it but the U-turn
+
+        Returns:
+        - tls (dict): tls[tl_id] = {'offset': float, 'phases': [(duration, state), ...]}, as tls_from_tllxml()
+        - connections (list): (from_edge_index, to_edge_index, tl_id, link_index) of every link, as for compiled_signals
+        """
+
+        in_ptr, in_edges = self.build_csr(self.edge_to)
+        out_ptr, out_edges = self.build_csr(self.edge_from)
+        horizontal = (np.abs(self.node_x[self.edge_to] - self.node_x[self.edge_from]) >= np.abs(self.node_y[self.edge_to] - self.node_y[self.edge_from])).tolist()
+        edge_from = self.edge_from.tolist()
+        edge_to = self.edge_to.tolist()
+        green = max(1, (cycle - 2 * yellow) // 2)
+
+        tls, connections = {}, []
+        for node in np.flatnonzero(self.signalised).tolist():
+            tl_id = self.node_ids[node]
+            incoming = in_edges[in_ptr[node]:in_ptr[node+1]].tolist()
+            group = [horizontal[edge] for edge in incoming]
+            if len(set(group)) == 1:  # every approach on one axis, alternate them
+                group = [rank % 2 == 0 for rank in range(len(incoming))]
+
+            # 1. Links, in the order of the incoming edges
+            link_group = []
+            for edge, first_group in zip(incoming, group):
+                for next_edge in out_edges[out_ptr[node]:out_ptr[node+1]].tolist():
+                    if edge_to[next_edge] == edge_from[edge]:
+                        continue  # no U-turn at a light
+                    connections.append((edge, next_edge, tl_id, len(link_group)))
+                    link_group.append(first_group)
+
+            # 2. Two groups, each green then yellow while the other is red
+            phases = []
+            for moving in (True, False):
+                phases.append((green, ''.join('G' if first_group == moving else 'r' for first_group in link_group)))
+                phases.append((yellow, ''.join('y' if first_group == moving else 'r' for first_group in link_group)))
+            tls[tl_id] = {'offset': float(rng.integers(0, 2 * (green + yellow))), 'phases': phases}
+        return tls, connections
+
+
+    def build_csr(self, key):
+        # Edges grouped by one of their end nodes, as compiled_network.build_csr()
+        ptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum(np.bincount(key, minlength=self.num_nodes))
+        return ptr, np.argsort(key, kind='stable')
+
+
+    def compile(self):
+        """
+        Build the compiled network and signals directly, without writing or parsing a file
+
+        Returns:
+        - (graph, tls_space, signals): To pass as traffic_env(..., compiled=...), with tls
+        """
+
+        graph = network.compiled_network(
+            node_ids = self.node_ids,
+            node_x = self.node_x,
+            node_y = self.node_y,
+            edge_ids = self.edge_ids,
+            edge_from = self.edge_from,
+            edge_to = self.edge_to,
+            edge_length = self.edge_length,
+            edge_speed = self.edge_speed,
+        )
+        return graph, list(self.tls), signals.compiled_signals(graph, self.connections, self.tls)
+
+
+    def congestion(self, level = 'low', seed = 0):
+        """
+        Random congested edges, as traffic_env draws them for a congestion_level
+
+        Args:
+        - level (str or float): "low", "medium", "high", or the share of edges congested
+        - seed (int): The seed of the edges and durations
+
+        Returns:
+        - congestion (list): (edge ID, duration in seconds) of every congested edge, for traffic_env(congestion=...)
+        """
+
+        share = CONGESTION_LEVELS.get(level, level)
+        if isinstance(share, str) or not 0 <= share <= 1:
+            sys.exit('Error: Invalid congestion level, provide only "low", "medium", "high" or a share between 0 and 1')
+        rng = np.random.default_rng(seed)
+        edges = rng.choice(self.num_edges, int(round(self.num_edges * share)), replace=False)
+        durations = rng.integers(60, 121, len(edges))  # 1~2 min
+        return [(self.edge_ids[edge], int(duration)) for edge, duration in zip(edges.tolist(), durations.tolist())]
+
+
+    def write_net(self, file_name, tll_file = None):
+        """
+        Write the city as a SUMO .net.xml, with the programs embedded as netconvert does. Every movement
+        but the U-turn (unless it is the only one) is connected, without internal lanes. Gzipped if file_name ends with .gz
+
+        Args:
+        - file_name (str): The .net.xml or .net.xml.gz to write
+        - tll_file (str or None): Also write the programs alone to this .tll.xml
+
+        Returns:
+        - void
+        """
+
+        in_ptr, in_edges = self.build_csr(self.edge_to)
+        out_ptr, out_edges = self.build_csr(self.edge_from)
+        heading = np.degrees(np.arctan2(self.node_y[self.edge_to] - self.node_y[self.edge_from], self.node_x[self.edge_to] - self.node_x[self.edge_from])).tolist()
+        node_x, node_y = self.node_x.tolist(), self.node_y.tolist()
+        edge_from, edge_to = self.edge_from.tolist(), self.edge_to.tolist()
+        edge_speed, edge_length = self.edge_speed.tolist(), self.edge_length.tolist()
+        priority = np.where(self.edge_speed > self.edge_speed.min(initial=0), 2, 1).tolist()  # arterials first
+        edge_ids, node_ids = self.edge_ids, self.node_ids
+        links = {(from_edge, to_edge): (tl_id, link_index) for from_edge, to_edge, tl_id, link_index in self.connections}
+        boundary = f'{min(node_x, default=0):.2f},{min(node_y, default=0):.2f},{max(node_x, default=0):.2f},{max(node_y, default=0):.2f}'
+
+        with (gzip.open(file_name, 'wt', encoding='utf-8') if file_name.endswith('.gz') else open(file_name, 'w', encoding='utf-8')) as file:
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n\n')
+            file.write('<net version="1.16" junctionCornerDetail="5" limitTurnSpeed="5.50">\n\n')
+            file.write(f'    <location netOffset="0.00,0.00" convBoundary="{boundary}" origBoundary="{boundary}" projParameter="!"/>\n\n')
+
+            # 1. Edges, one lane each
+            for edge in range(self.num_edges):
+                start, end = edge_from[edge], edge_to[edge]
+                file.write(f'    <edge id="{edge_ids[edge]}" from="{node_ids[start]}" to="{node_ids[end]}" priority="{priority[edge]}">\n')
+                file.write(f'        <lane id="{edge_ids[edge]}_0" index="0" speed="{edge_speed[edge]:.2f}" length="{edge_length[edge]:.2f}" '
+                           f'shape="{node_x[start]:.2f},{node_y[start]:.2f} {node_x[end]:.2f},{node_y[end]:.2f}"/>\n')
+                file.write('    </edge>\n')
+            file.write('\n')
+
+            # 2. Programs
+            self.write_tls(file)
+
+            # 3. Junctions
+            for node in range(self.num_nodes):
+                incoming = ' '.join(f'{edge_ids[edge]}_0' for edge in in_edges[in_ptr[node]:in_ptr[node+1]].tolist())
+                kind = 'traffic_light' if self.signalised[node] else ('dead_end' if out_ptr[node] == out_ptr[node+1] else 'priority')
+                file.write(f'    <junction id="{node_ids[node]}" type="{kind}" x="{node_x[node]:.2f}" y="{node_y[node]:.2f}" incLanes="{incoming}" intLanes="" '
+                           f'shape="{node_x[node]:.2f},{node_y[node]:.2f}"/>\n')
+            file.write('\n')
+
+            # 4. Connections, those through a light with their link
+            for edge in range(self.num_edges):
+                node = edge_to[edge]
+                following = out_edges[out_ptr[node]:out_ptr[node+1]].tolist()
+                for next_edge in following:
+                    turn = (heading[next_edge] - heading[edge] + 180) % 360 - 180
+                    if edge_to[next_edge] == edge_from[edge]:
+                        if len(following) > 1:
+                            continue
+                        direction = 't'
+                    else:
+                        direction = 's' if abs(turn) < 30 else ('l' if turn > 0 else 'r')
+                    light = links.get((edge, next_edge))
+                    controlled = f' tl="{light[0]}" linkIndex="{light[1]}"' if light else ''
+                    file.write(f'    <connection from="{edge_ids[edge]}" to="{edge_ids[next_edge]}" fromLane="0" toLane="0"{controlled} dir="{direction}" state="{"O" if light else "M"}"/>\n')
+            file.write('\n</net>\n')
+
+        if tll_file:
+            with open(tll_file, 'w', encoding='utf-8') as file:
+                file.write('<?xml version="1.0" encoding="UTF-8"?>\n\n<additional>\n')
+                self.write_tls(file)
+                file.write('</additional>\n')
+
+
+    def write_tls(self, file):
+        # The <tlLogic> of every light, as in a .net.xml or a .tll.xml
+        for tl_id, program in self.tls.items():
+            file.write(f'    <tlLogic id="{tl_id}" type="static" programID="0" offset="{program["offset"]:g}">\n')
+            for duration, state in program['phases']:
+                file.write(f'        <phase duration="{duration}" state="{state}"/>\n')
+            file.write('    </tlLogic>\n')
+        file.write('\n')
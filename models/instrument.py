@@ -0,0 +1,158 @@
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import collections
+
+
+class metrics:
+    def __init__ (self, snapshot_file = None, snapshot_every = 1.0):
+        """
+        Counters and phase timers of a run, opt-in: set env.metrics = metrics() and the env, its agents
+        and its searches start counting. While env.metrics is None, they only check that it is None.
+
+        Counters: steps, invalid_actions, dead_ends, loops, completions, episodes, heap_pushes, heap_pops,
+        searches, route_evaluations. Timers, in seconds: act, step, learn, evaluate, search.
+
+        Args:
+        - snapshot_file (str or None): The .jsonl to append a snapshot to every snapshot_every seconds, see tick()
+        - snapshot_every (float): The seconds between two snapshots
+        """
+
+        self.counts = collections.defaultdict(int)
+        self.seconds = collections.defaultdict(float)
+        self.snapshot_file = snapshot_file
+        self.snapshot_every = snapshot_every
+        self.start_time = time.perf_counter()
+        self.last_snapshot = self.start_time
+
+
+    def count(self, name, amount = 1):
+        self.counts[name] += amount
+
+
+    def add_time(self, name, seconds):
+        self.seconds[name] += seconds
+
+
+    def as_dict(self):
+        """
+        Returns:
+        - metrics (dict): elapsed seconds since the start, counts {name: int}, seconds {phase: float}
+            and per_second {name: float} of every count
+        """
+
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'elapsed': round(elapsed, 6),
+            'counts': dict(self.counts),
+            'seconds': {name: round(seconds, 6) for name, seconds in self.seconds.items()},
+            'per_second': {name: round(count / elapsed, 1) for name, count in self.counts.items()} if elapsed else {},
+        }
+
+
+    def tick(self, force = False):
+        """
+        Append a snapshot (as_dict()) to snapshot_file if snapshot_every seconds passed since the last one,
+        called by the agents after every episode
+
+        Args:
+        - force (bool): Append one now, e.g. at the end of a run
+
+        Returns:
+        - void
+        """
+
+        if self.snapshot_file is None:
+            return
+        now = time.perf_counter()
+        if not force and now - self.last_snapshot < self.snapshot_every:
+            return
+        self.last_snapshot = now
+        with open(self.snapshot_file, 'a') as file:
+            file.write(json.dumps(self.as_dict()) + '\n')
+
+
+    def reset(self):
+        self.counts.clear()
+        self.seconds.clear()
+        self.start_time = self.last_snapshot = time.perf_counter()
+
+
+def counting_heap(metrics, heappush, heappop):
+    """
+    Wrap heapq.heappush / heappop to count heap_pushes and heap_pops in metrics
+
+    Returns:
+    - heappush, heappop (function)
+    """
+
+    counts = metrics.counts
+
+    def counted_push(heap, item):
+        counts['heap_pushes'] += 1
+        heappush(heap, item)
+
+    def counted_pop(heap):
+        counts['heap_pops'] += 1
+        return heappop(heap)
+
+    return counted_push, counted_pop
+
+
+def profile_train(rl, num_episodes, threshold, output_file = None, tool = 'cprofile', batch_size = None, **options):
+    """
+    Profile a single training of an agent
+
+    Args:
+    - rl (rl_agent): The agent to train
+    - num_episodes, threshold: As for train()
+    - output_file (str or None): Where to save the profile, .prof for cProfile (read by pstats or snakeviz),
+        .html or .txt for pyinstrument, None to only print it
+    - tool (str): "cprofile", or "pyinstrument" if installed
+    - batch_size (int or None): Profile train_batch() of this size instead of train()
+    - options: The other arguments of train() / train_batch(), e.g. q_table
+
+    Returns:
+    - The returns of train() / train_batch(). A training that does not converge still saves and prints its profile before exiting
+    """
+
+    train = (lambda: rl.train_batch(num_episodes, threshold, batch_size, **options)) if batch_size else (lambda: rl.train(num_episodes, threshold, **options))
+
+    # 1. pyinstrument, a sampling profiler, only if installed
+    if tool == 'pyinstrument':
+        try:
+            import pyinstrument
+        except ImportError:
+            sys.exit('Error: pyinstrument is not installed, pip install pyinstrument or use tool "cprofile"')
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        try:
+            return train()
+        finally:
+            profiler.stop()
+            if output_file and output_file.endswith('.html'):
+                with open(output_file, 'w') as file:
+                    file.write(profiler.output_html())
+            elif output_file:
+                with open(output_file, 'w') as file:
+                    file.write(profiler.output_text())
+            print(profiler.output_text())
+
+    if tool != 'cprofile':
+        sys.exit('Error: Invalid tool, provide only "cprofile" or "pyinstrument"')
+
+    # 2. cProfile, deterministic
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return train()
+    finally:
+        profiler.disable()
+        if output_file:
+            profiler.dump_stats(output_file)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(20)
+        print(report.getvalue())
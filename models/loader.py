@@ -0,0 +1,139 @@
+import sys
+import gzip
+import xml.etree.ElementTree as ET
+
+from models import network
+
+
+def _open(file_name):
+    # .gz files are read through gzip, whatever their extension says
+    with open(file_name, 'rb') as file:
+        is_gzip = file.read(2) == b'\x1f\x8b'
+    return gzip.open(file_name, 'rb') if is_gzip else open(file_name, 'rb')
+
+
+def _iterparse(file_name):
+    """
+    Stream the elements of an XML file, freeing every top-level element once it ends so that memory stays flat
+
+    Yields:
+    - (event, element): 'start' with the attributes of the element, or 'end'
+    """
+
+    with _open(file_name) as source:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        depth = 1
+        for event, element in context:
+            yield event, element
+            if event == 'start':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1:
+                    root.clear()  # drop the finished top-level element, and the empty ones before it
+
+
+def read_network(file_name):
+    """
+    Read the routable part of a .net.xml / .net.xml.gz in one streaming pass, as sumolib.net.readNet() sees it:
+    the non-internal edges, their junctions, and the connections controlled by traffic lights
+
+    Args:
+    - file_name (str): The network file
+
+    Returns:
+    - graph (compiled_network): The compiled network, nodes and edges in the order sumolib gives them
+    - tls_space (list): The IDs of the traffic lights, in the order sumolib gives them
+    - connections (list): (from_edge_index, to_edge_index, tl_id, link_index) of every signalised connection, for compiled_signals
+    """
+
+    node_index, node_x, node_y = {}, [], []
+    edge_index, edge_from, edge_to, edge_length, edge_speed = {}, [], [], [], []
+    skipped = set()  # crossings, walking areas and macro connectors, their connections are left out as by sumolib
+    tl_links = {}  # tl_id -> [(from_edge_index, to_edge_index, link_index)], in order of first appearance
+    edge = None  # [edge_id, from_node, to_node, length of the first lane, speed of the last lane]
+
+    def add_node(node):
+        if node not in node_index:
+            node_index[node] = len(node_index)
+            node_x.append(float('nan'))
+            node_y.append(float('nan'))
+        return node_index[node]
+
+    for event, element in _iterparse(file_name):
+        tag = element.tag
+        if event == 'start':
+            if tag == 'edge':
+                function = element.get('function', '')
+                edge = [element.get('id'), element.get('from'), element.get('to'), None, None] if function == '' else None
+                if function in ('crossing', 'walkingarea', 'connector'):
+                    skipped.add(element.get('id'))
+            elif tag == 'lane' and edge is not None:
+                if edge[3] is None:
+                    edge[3] = float(element.get('length'))
+                edge[4] = float(element.get('speed'))
+            continue
+
+        if tag == 'edge' and edge is not None:
+            edge_index[edge[0]] = len(edge_index)
+            edge_from.append(add_node(edge[1]))
+            edge_to.append(add_node(edge[2]))
+            edge_length.append(edge[3])
+            edge_speed.append(edge[4])
+            edge = None
+
+        elif tag == 'junction':
+            node = element.get('id')
+            if node[0] != ':':
+                index = add_node(node)
+                node_x[index] = float(element.get('x'))
+                node_y[index] = float(element.get('y'))
+
+        elif tag == 'connection' and element.get('tl'):
+            from_edge, to_edge = element.get('from'), element.get('to')
+            if from_edge[0] == ':' or from_edge in skipped or to_edge in skipped:
+                continue
+            if from_edge in edge_index and to_edge in edge_index:
+                tl_links.setdefault(element.get('tl'), []).append((edge_index[from_edge], edge_index[to_edge], int(element.get('linkIndex'))))
+
+    graph = network.compiled_network(
+        node_ids = list(node_index),
+        node_x = node_x,
+        node_y = node_y,
+        edge_ids = list(edge_index),
+        edge_from = edge_from,
+        edge_to = edge_to,
+        edge_length = edge_length,
+        edge_speed = edge_speed,
+    )
+    connections = [(from_edge, to_edge, tl_id, link_index) for tl_id, links in tl_links.items() for from_edge, to_edge, link_index in links]
+    return graph, list(tl_links), connections
+
+
+def read_tls(file_name):
+    """
+    Read the traffic light programs of a .tll.xml, or those embedded in a .net.xml / .net.xml.gz, in one streaming pass
+
+    Args:
+    - file_name (str): The file holding <tlLogic> elements
+
+    Returns:
+    - tls_data (dict): tls_data[tl_id] = {'offset': float, 'phases': [(duration, state), ...]}
+    """
+
+    tls_data = {}
+    phases = None
+    for event, element in _iterparse(file_name):
+        if event != 'start':
+            continue
+        if element.tag == 'tlLogic':
+            tl_id = element.get('id')
+            if tl_id in tls_data:
+                sys.exit(f"Error: {tl_id} duplicated")
+            phases = []
+            tls_data[tl_id] = {'offset': float(element.get('offset', 0)), 'phases': phases}
+        elif element.tag == 'phase' and phases is not None:
+            phases.append((float(element.get('duration')), element.get('state')))
+
+    return tls_data
@@ -0,0 +1,128 @@
+import os
+import sys
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+
+from models import dijkstra
+
+
+# Arrays attached by each worker of the pool, read-only views of the parent's shared memory
+_shared = {}
+
+
+def _share(array):
+    """
+    Copy an array into a new shared memory block
+
+    Returns:
+    - block (SharedMemory): The block, to be closed and unlinked by the owner
+    - spec (tuple): (name, shape, dtype) for a worker to attach it
+    """
+
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach(specs):
+    # Pool initializer: attach every block once per worker
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        _shared[key] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+
+def _view(key):
+    # memoryviews index as fast as lists in the heap loop, without copying the arrays
+    array = _shared[key][1]
+    return memoryview(array).cast('B').cast(array.dtype.char) if array.ndim == 1 else array
+
+
+def _solve_row(row):
+    # Worker task: one-to-all search from sources[row], written straight into the shared results
+    source = int(_shared['sources'][1][row])
+    targets = _shared['targets'][1]
+    cost, predecessor = dijkstra.one_to_all(
+        _view('out_ptr'), _view('out_edges'), _view('edge_to'), _view('edge_costs'),
+        source, None if 'predecessors' in _shared else targets.tolist(),
+    )
+    _shared['matrix'][1][row] = np.asarray(cost)[targets]
+    if 'predecessors' in _shared:
+        _shared['predecessors'][1][row] = predecessor
+    return row
+
+
+def cost_matrix(env, sources, targets, evaluation = None, processes = None, return_predecessors = False):
+    """
+    Many-to-many cost matrix, one one-to-all search per source
+
+    The compiled network is placed in shared memory once, and every worker of the pool reads it
+    from there, so neither the sumolib net nor the arrays are pickled per task.
+    env.start_node/env.end_node are left untouched.
+
+    Args:
+    - env (traffic_env): The environment to search on
+    - sources, targets (list): The IDs (str) of the origin and destination nodes
+    - evaluation (str or None): "distance" or "time", defaults to env.evaluation
+    - processes (int or None): The size of the process pool, None for os.cpu_count(), 1 to search in this process
+    - return_predecessors (bool): Also return the full shortest-path tree of every source
+
+    Returns:
+    - matrix (np.ndarray [len(sources), len(targets)]): The cost of every pair, inf if unreachable
+    - predecessors (np.ndarray [len(sources), num_nodes]): The predecessor edge index of every node, -1 if none.
+        Only if return_predecessors, a route is recovered by dijkstra.tree_path()
+    """
+
+    # 1. Translate the IDs
+    for node in list(sources) + list(targets):
+        if node not in env.node_index:
+            sys.exit(f'Error: Node {node} not in Nodes Space ...call by cost_matrix')
+    graph = env.graph
+    arrays = {
+        'out_ptr': graph.out_ptr,
+        'out_edges': graph.out_edges,
+        'edge_to': graph.edge_to,
+        'edge_costs': np.ascontiguousarray(env.get_edge_costs(evaluation), dtype=np.float64),
+        'sources': np.array([env.node_index[node] for node in sources], dtype=np.int32),
+        'targets': np.array([env.node_index[node] for node in targets], dtype=np.int32),
+        'matrix': np.zeros((len(sources), len(targets)), dtype=np.float64),
+    }
+    if return_predecessors:
+        arrays['predecessors'] = np.zeros((len(sources), graph.num_nodes), dtype=np.int32)
+
+    processes = min(processes or os.cpu_count() or 1, len(sources))
+
+    # 2. Search in this process
+    if processes <= 1:
+        out_ptr, out_edges, _, _, _, edge_to = graph.adjacency_lists()
+        edge_costs = arrays['edge_costs'].tolist()
+        for row, source in enumerate(arrays['sources'].tolist()):
+            cost, predecessor = dijkstra.one_to_all(out_ptr, out_edges, edge_to, edge_costs, source, None if return_predecessors else arrays['targets'].tolist())
+            arrays['matrix'][row] = np.asarray(cost)[arrays['targets']]
+            if return_predecessors:
+                arrays['predecessors'][row] = predecessor
+        if return_predecessors:
+            return arrays['matrix'], arrays['predecessors']
+        return arrays['matrix']
+
+    # 3. Search in a process pool sharing the arrays
+    blocks = {}
+    try:
+        specs = {}
+        for key, array in arrays.items():
+            blocks[key], specs[key] = _share(array)
+
+        with multiprocessing.Pool(processes, initializer=_attach, initargs=(specs,)) as pool:
+            for _ in pool.imap_unordered(_solve_row, range(len(sources))):
+                pass
+
+        matrix = np.ndarray(arrays['matrix'].shape, dtype=np.float64, buffer=blocks['matrix'].buf).copy()
+        if return_predecessors:
+            predecessors = np.ndarray(arrays['predecessors'].shape, dtype=np.int32, buffer=blocks['predecessors'].buf).copy()
+            return matrix, predecessors
+        return matrix
+
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
@@ -0,0 +1,251 @@
+import hashlib
+import numpy as np
+
+
+class compiled_network:
+    def __init__ (self, node_ids, node_x, node_y, edge_ids, edge_from, edge_to, edge_length, edge_speed):
+        """
+        Compact integer-indexed representation of a road network.
+
+        Every node and edge is given an index (its position in node_ids/edge_ids), and all
+        attributes are stored in NumPy arrays so that lookups are O(1) instead of going
+        through sumolib objects.
+
+        Args:
+        - node_ids (list): The IDs (str) of the nodes
+        - node_x, node_y (array-like): The x-y coordinates of the nodes
+        - edge_ids (list): The IDs (str) of the edges
+        - edge_from, edge_to (array-like): The start/end node index of each edge
+        - edge_length (array-like): The length of each edge (in metres)
+        - edge_speed (array-like): The speed limit of each edge (in metres per second)
+        """
+
+        # 1. Nodes
+        self.node_ids = list(node_ids)
+        self.node_index = {node: index for index, node in enumerate(self.node_ids)}  # node ID -> node index
+        self.node_x = np.asarray(node_x, dtype=np.float64)
+        self.node_y = np.asarray(node_y, dtype=np.float64)
+        self.num_nodes = len(self.node_ids)
+
+        # 2. Edges
+        self.edge_ids = list(edge_ids)
+        self.edge_index = {edge: index for index, edge in enumerate(self.edge_ids)}  # edge ID -> edge index
+        self.edge_from = np.asarray(edge_from, dtype=np.int32)
+        self.edge_to = np.asarray(edge_to, dtype=np.int32)
+        self.edge_length = np.asarray(edge_length, dtype=np.float64)
+        self.edge_speed = np.asarray(edge_speed, dtype=np.float64)
+        self.edge_time = self.edge_length / self.edge_speed  # free-flow travel time (in seconds)
+        self.num_edges = len(self.edge_ids)
+
+        # 3. CSR adjacency, edges of node i are out_edges[out_ptr[i]:out_ptr[i+1]]
+        self.out_ptr, self.out_edges = self.build_csr(self.edge_from)
+        self.in_ptr, self.in_edges = self.build_csr(self.edge_to)
+
+        # 4. Direction label of every edge ( 0 Right -> 1 Up -> 2 Left -> 3 Down )
+        self.edge_label = self.build_edge_label()
+
+        # 5. (state, action) transition table and dead-end flag of every node
+        self.transition_node, self.transition_edge = self.build_transitions()
+        self.out_degree = np.diff(self.out_ptr)
+        self.dead_end = self.out_degree == 0
+
+        # 6. Lower bounds of cost per metre of straight line, used by A* heuristics
+        #    edge length can be shorter than the straight line between junction centres, so the bounds are taken over every edge
+        straight_line = np.hypot(self.node_x[self.edge_to] - self.node_x[self.edge_from], self.node_y[self.edge_to] - self.node_y[self.edge_from])
+        positive = straight_line > 0
+        self.heuristic_scale = float(min(1.0, np.min(self.edge_length[positive] / straight_line[positive], initial=1.0)))  # metres per metre
+        self.heuristic_time_scale = float(np.min(self.edge_time[positive] / straight_line[positive], initial=self.heuristic_scale / np.max(self.edge_speed, initial=1.0)))  # seconds per metre
+
+
+    @classmethod
+    def from_sumolib(cls, net):
+        """
+        Compile a sumolib net object
+
+        Args:
+        - net (sumolib.net.Net): The net read by sumolib.net.readNet
+
+        Returns:
+        - A compiled_network
+        """
+
+        nodes = net.getNodes()
+        edges = net.getEdges()
+        node_index = {node.getID(): index for index, node in enumerate(nodes)}
+
+        return cls(
+            node_ids = [node.getID() for node in nodes],
+            node_x = [node.getCoord()[0] for node in nodes],
+            node_y = [node.getCoord()[1] for node in nodes],
+            edge_ids = [edge.getID() for edge in edges],
+            edge_from = [node_index[edge.getFromNode().getID()] for edge in edges],
+            edge_to = [node_index[edge.getToNode().getID()] for edge in edges],
+            edge_length = [edge.getLength() for edge in edges],
+            edge_speed = [edge.getSpeed() for edge in edges],
+        )
+
+
+    # Arrays kept by to_arrays(), everything else is rebuilt from them by from_arrays()
+    ARRAYS = (
+        'node_x', 'node_y', 'edge_from', 'edge_to', 'edge_length', 'edge_speed', 'edge_time',
+        'out_ptr', 'out_edges', 'in_ptr', 'in_edges', 'edge_label', 'transition_node', 'transition_edge',
+    )
+
+
+    def to_arrays(self):
+        """
+        Everything compiled, as plain arrays and scalars for models/snapshot.py
+
+        Returns:
+        - node_ids, edge_ids (list): The IDs (str)
+        - arrays (dict): [name] = np.ndarray, for each name of ARRAYS
+        - scalars (dict): [name] = float
+        """
+
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        scalars = {'heuristic_scale': self.heuristic_scale, 'heuristic_time_scale': self.heuristic_time_scale}
+        return self.node_ids, self.edge_ids, arrays, scalars
+
+
+    @classmethod
+    def from_arrays(cls, node_ids, edge_ids, arrays, scalars):
+        """
+        Rebuild a compiled_network from to_arrays() without compiling again, the arrays are used as given (e.g. memory-mapped)
+
+        Returns:
+        - A compiled_network
+        """
+
+        graph = cls.__new__(cls)
+        graph.node_ids = node_ids
+        graph.node_index = {node: index for index, node in enumerate(node_ids)}
+        graph.num_nodes = len(node_ids)
+        graph.edge_ids = edge_ids
+        graph.edge_index = {edge: index for index, edge in enumerate(edge_ids)}
+        graph.num_edges = len(edge_ids)
+        for name in cls.ARRAYS:
+            setattr(graph, name, arrays[name])
+        graph.out_degree = np.diff(graph.out_ptr)
+        graph.dead_end = graph.out_degree == 0
+        graph.heuristic_scale = scalars['heuristic_scale']
+        graph.heuristic_time_scale = scalars['heuristic_time_scale']
+        return graph
+
+
+    def build_csr(self, key):
+        """
+        Group edges by one of their end nodes in Compressed Sparse Row layout
+
+        Args:
+        - key (np.ndarray): The node index of each edge to group by (edge_from or edge_to)
+
+        Returns:
+        - ptr (np.ndarray [num_nodes+1]): The offsets of each node in edges
+        - edges (np.ndarray [num_edges]): The edge indices, ordered by node and then by edge index
+        """
+
+        ptr = np.zeros(self.num_nodes + 1, dtype=np.int32)
+        ptr[1:] = np.cumsum(np.bincount(key, minlength=self.num_nodes))
+        edges = np.argsort(key, kind='stable').astype(np.int32)  # stable, so edges keep the order of the net file
+        return ptr, edges
+
+
+    def build_edge_label(self):
+        """
+        Label the outgoing edges of every node by their angle, from 0 to 180 to -180 to 0 (Right -> Up -> Left -> Down -> Right)
+
+        Returns:
+        - labels (np.ndarray [num_edges]): The label of each edge
+        """
+
+        delta_x = self.node_x[self.edge_to] - self.node_x[self.edge_from]
+        delta_y = self.node_y[self.edge_to] - self.node_y[self.edge_from]
+        angle = np.arctan2(delta_y, delta_x)
+
+        # sort by node first, then upper half-plane before lower half-plane, then angle
+        order = np.lexsort((angle, angle < 0, self.edge_from))
+
+        labels = np.empty(self.num_edges, dtype=np.int32)
+        labels[order] = np.arange(self.num_edges, dtype=np.int32) - self.out_ptr[self.edge_from[order]]
+        return labels
+
+
+    def build_transitions(self, num_actions = 4):
+        """
+        Tabulate where each action leads from each node, an action is the label of an outgoing edge
+
+        Args:
+        - num_actions (int): The size of the action space, edges labelled beyond it are unreachable
+
+        Returns:
+        - transition_node (np.ndarray [num_nodes, num_actions]): The next node index, or -1 if the action is invalid
+        - transition_edge (np.ndarray [num_nodes, num_actions]): The edge index taken, or -1 if the action is invalid
+        """
+
+        transition_node = np.full((self.num_nodes, num_actions), -1, dtype=np.int32)
+        transition_edge = np.full((self.num_nodes, num_actions), -1, dtype=np.int32)
+
+        valid = self.edge_label < num_actions
+        transition_node[self.edge_from[valid], self.edge_label[valid]] = self.edge_to[valid]
+        transition_edge[self.edge_from[valid], self.edge_label[valid]] = np.flatnonzero(valid)
+        return transition_node, transition_edge
+
+
+    def adjacency_lists(self):
+        """
+        Python list copies of the CSR arrays, indexing lists is much faster than indexing NumPy scalars in heap loops
+
+        Returns:
+        - out_ptr, out_edges, in_ptr, in_edges, edge_from, edge_to (list)
+        """
+
+        if not hasattr(self, '_adjacency_lists'):
+            self._adjacency_lists = (
+                self.out_ptr.tolist(), self.out_edges.tolist(),
+                self.in_ptr.tolist(), self.in_edges.tolist(),
+                self.edge_from.tolist(), self.edge_to.tolist(),
+            )
+        return self._adjacency_lists
+
+
+    def digest(self):
+        """
+        Fingerprint of the network: the IDs, the topology and the edge attributes, not the congestion
+
+        Returns:
+        - The SHA-1 hex digest (str), identical for identical networks across processes and runs
+        """
+
+        if not hasattr(self, '_digest'):
+            sha = hashlib.sha1()
+            sha.update('\n'.join(self.node_ids).encode())
+            sha.update(b'\0')
+            sha.update('\n'.join(self.edge_ids).encode())
+            for array in (self.edge_from, self.edge_to, self.edge_length, self.edge_speed):
+                sha.update(np.ascontiguousarray(array).tobytes())
+            self._digest = sha.hexdigest()
+        return self._digest
+
+
+    def straight_line_distance(self, node_index):
+        """
+        Returns:
+        - The straight-line distance (np.ndarray [num_nodes]) from every node to the given node
+        """
+        return np.hypot(self.node_x - self.node_x[node_index], self.node_y - self.node_y[node_index])
+
+
+    def outgoing(self, node_index):
+        """
+        Returns:
+        - The indices (np.ndarray) of edges starting from the given node
+        """
+        return self.out_edges[self.out_ptr[node_index]:self.out_ptr[node_index+1]]
+
+
+    def incoming(self, node_index):
+        """
+        Returns:
+        - The indices (np.ndarray) of edges ending at the given node
+        """
+        return self.in_edges[self.in_ptr[node_index]:self.in_ptr[node_index+1]]
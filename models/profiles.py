@@ -0,0 +1,121 @@
+import sys
+import numpy as np
+
+
+DAY = 86400  # seconds, the profiles repeat every day
+
+
+class speed_profiles:
+    def __init__ (self, profiles, edge_profile, bin_seconds = 900):
+        """
+        Time-of-day speed profiles of the edges, piecewise linear between bins
+
+        A profile is the share of the free-flow speed (0, 1] at the start of every bin of the day, linear in
+        between and wrapping around at midnight. Edges share profiles, so only one small table and one
+        index per edge are stored. The travel time of an edge entered at time t is edge_time / factor(t).
+
+        Args:
+        - profiles (array-like [num_profiles, num_bins]): The speed factors, num_bins * bin_seconds must be a day
+        - edge_profile (array-like [num_edges]): The profile of each edge, -1 for free flow all day
+        - bin_seconds (int): The length of a bin, 900 for 15 minutes
+        """
+
+        profiles = np.asarray(profiles, dtype=np.float64).reshape(len(profiles), -1)
+        edge_profile = np.asarray(edge_profile, dtype=np.int64)
+        num_profiles, num_bins = profiles.shape
+        if num_bins * bin_seconds != DAY:
+            sys.exit(f'Error: Invalid profiles, {num_bins} bins of {bin_seconds} seconds do not make a day')
+        if profiles.size and (profiles.min() <= 0 or profiles.max() > 1):
+            sys.exit('Error: Invalid profiles, speed factors must be in (0, 1]')  # never faster than free flow, so A* stays admissible
+        if edge_profile.size and (edge_profile.min() < -1 or edge_profile.max() >= num_profiles):
+            sys.exit('Error: Invalid edge_profile, provide -1 or the index of a profile for every edge')
+
+        self.bin_seconds = bin_seconds
+        self.num_bins = num_bins
+        self.num_edges = len(edge_profile)
+
+        # Row 0 is free flow, and every row repeats its first bin at the end so that bin + 1 never wraps
+        self.table = np.ones((num_profiles + 1, num_bins + 1), dtype=np.float64)
+        self.table[1:, :num_bins] = profiles
+        self.table[1:, num_bins] = profiles[:, 0] if num_profiles else 1
+        self.edge_row = (edge_profile + 1).astype(np.int16 if num_profiles < np.iinfo(np.int16).max else np.int32)
+
+        # Python copies for the lookups of heap loops
+        self._table = self.table.tolist()
+        self._edge_row = self.edge_row.tolist()
+
+
+    @classmethod
+    def rush_hour(cls, num_edges, edges, slowest = 0.4, peaks = (8.0, 18.0), width = 1.0, bin_seconds = 900):
+        """
+        One profile with a dip of speed around each rush hour, given to some edges
+
+        Args:
+        - num_edges (int): The number of edges of the network
+        - edges (array-like): The indices of the edges to slow down, e.g. np.flatnonzero(env.congested_mask)
+        - slowest (float): The speed factor at the peaks
+        - peaks (tuple): The hours of the peaks
+        - width (float): The standard deviation of each dip, in hours
+
+        Returns:
+        - A speed_profiles
+        """
+
+        hours = np.arange(DAY // bin_seconds) * bin_seconds / 3600
+        dip = np.zeros_like(hours)
+        for peak in peaks:
+            distance = np.abs((hours - peak + 12) % 24 - 12)  # hours away from the peak, around midnight as well
+            dip = np.maximum(dip, np.exp(-0.5 * (distance / width) ** 2))
+        edge_profile = np.full(num_edges, -1, dtype=np.int64)
+        edge_profile[np.asarray(edges, dtype=np.int64)] = 0
+        return cls([1 - (1 - slowest) * dip], edge_profile, bin_seconds)
+
+
+    def save(self, file_name):
+        # .npz of the profiles and the profile of each edge
+        np.savez(file_name, profiles=self.table[1:, :self.num_bins], edge_profile=self.edge_row.astype(np.int64) - 1, bin_seconds=self.bin_seconds)
+
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            return cls(data['profiles'], data['edge_profile'], int(data['bin_seconds']))
+
+
+    def factor(self, edge_indices, times):
+        """
+        Vectorised lookup
+
+        Args:
+        - edge_indices (np.ndarray): The edges
+        - times (np.ndarray or float): The time each edge is entered, in seconds after midnight of the first day
+
+        Returns:
+        - factors (np.ndarray): The share of the free-flow speed of each edge at its time
+        """
+
+        rows = self.edge_row[edge_indices]
+        position = (np.asarray(times, dtype=np.float64) % DAY) / self.bin_seconds
+        bins = np.minimum(position.astype(np.int64), self.num_bins - 1)  # a time rounding up to midnight stays in the last bin
+        start = self.table[rows, bins]
+        return start + (self.table[rows, bins + 1] - start) * (position - bins)
+
+
+    def factor_at(self, edge_index, time):
+        # Scalar lookup, same arithmetic as factor()
+        row = self._edge_row[edge_index]
+        if not row:
+            return 1.0
+        position = (time % DAY) / self.bin_seconds
+        index = min(int(position), self.num_bins - 1)
+        values = self._table[row]
+        return values[index] + (values[index + 1] - values[index]) * (position - index)
+
+
+    def travel_time(self, edge_time, edge_indices, times):
+        """
+        Returns:
+        - The travel times (np.ndarray) of the edges entered at times, edge_time being the free-flow time of every edge
+        """
+
+        return edge_time[edge_indices] / self.factor(edge_indices, times)
@@ -0,0 +1,293 @@
+import json
+import time
+import threading
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from models import cache
+from models import matrix
+
+
+def _finite(value):
+    # JSON has no inf, an unreachable cost is sent as null
+    return value if value != float('inf') else None
+
+
+class micro_batcher:
+    def __init__ (self, env, window = 0.005, route_cache = None):
+        """
+        Shares one one-to-all search between the route queries from the same source that arrive together
+
+        The first query of a (source, evaluation) opens a batch and waits window seconds for others to join,
+        then gets the tree of the source once for the whole batch, and every query walks it to its target.
+        Trees and results come from route_cache, so a query already answered returns at once.
+
+        Args:
+        - env (traffic_env): The environment to search on
+        - window (float): The seconds a batch stays open, 0 to search at once
+        - route_cache (cache.route_cache or None): The cache of trees and results, None for a new one
+        """
+
+        self.env = env
+        self.window = window
+        self.cache = route_cache or cache.route_cache(env)
+        self.lock = threading.Lock()
+        self.pending = {}  # [(source, evaluation)] = the batch still open to queries
+        self.searches = 0  # the number of batches run
+        self.queries = 0  # the number of queries answered
+
+
+    def route(self, start_node, end_node, evaluation = None):
+        """
+        Args:
+        - start_node, end_node (str): The IDs of the terminals
+        - evaluation (str or None): "distance" or "time", defaults to env.evaluation
+
+        Returns:
+        - result (dict): node_path, edge_path, cost and tl_offset as for the batch results, and batch_size
+            the number of queries the tree was shared by, 0 if the result was cached. cost is None if end_node is unreachable
+        """
+
+        env = self.env
+        evaluation = evaluation or env.evaluation
+        if evaluation not in ('distance', 'time'):
+            raise ValueError('Invalid evaluation type, provide only "distance" or "time"')
+        for node in (start_node, end_node):
+            if node not in env.node_index:
+                raise ValueError(f'Node {node} not in Nodes Space')
+        source, target = env.node_index[start_node], env.node_index[end_node]
+        with self.lock:
+            self.queries += 1
+
+        # 1. Answered before
+        result = self.cache.lookup(source, target, evaluation)
+        if result is not None:
+            return dict(result, start_node=start_node, end_node=end_node, evaluation=evaluation, batch_size=0)
+
+        # 2. Join the open batch of the source, or open one
+        key = (source, evaluation)
+        with self.lock:
+            batch = self.pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = {'done': threading.Event(), 'ready': False, 'size': 0}
+                self.pending[key] = batch
+            batch['size'] += 1
+
+        # 3. The leader gets the tree for the whole batch once it is closed, the others wait for it
+        if leader:
+            try:
+                if self.window:
+                    time.sleep(self.window)
+                with self.lock:
+                    del self.pending[key]  # later queries open the next batch
+                    self.searches += 1
+                self.cache.tree(source, evaluation)
+                batch['ready'] = True
+            finally:
+                batch['done'].set()
+        else:
+            batch['done'].wait()
+        if not batch['ready']:
+            raise RuntimeError('The search of the batch failed')
+
+        # 4. Walk the tree to the target
+        result = self.cache.route(source, target, evaluation)
+        return dict(result, start_node=start_node, end_node=end_node, evaluation=evaluation, batch_size=batch['size'])
+
+
+class request_handler(BaseHTTPRequestHandler):
+    """
+    JSON endpoints of routing_server, every body and response is a JSON object
+
+    - GET  /route?start_node=..&end_node=..[&evaluation=..], or POST /route {"start_node", "end_node", "evaluation"}
+    - POST /matrix {"sources": [...], "targets": [...], "evaluation"}: {"matrix": [[cost or null, ...], ...]}
+    - GET  /congestion: {"congestion": [[edge, duration], ...]}
+    - POST /congestion {"congestion": [[edge, duration], ...]}: replaces the congested edges,
+        or {"changes": [[edge, duration], ...]}: changes only these edges, a duration of 0 clears one
+    - GET  /stats: the hits and misses of the cache, the queries and searches of the batches
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        self.dispatch(url.path, query, 'GET')
+
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as error:
+            return self.respond(400, {'error': f'Invalid JSON: {error}'})
+        if not isinstance(body, dict):
+            return self.respond(400, {'error': 'Invalid body, provide a JSON object'})
+        self.dispatch(url.path, body, 'POST')
+
+
+    def dispatch(self, path, params, method):
+        routes = {
+            ('/route', 'GET'): self.server.route,
+            ('/route', 'POST'): self.server.route,
+            ('/matrix', 'POST'): self.server.matrix,
+            ('/congestion', 'GET'): self.server.get_congestion,
+            ('/congestion', 'POST'): self.server.set_congestion,
+            ('/stats', 'GET'): self.server.get_stats,
+        }
+        if (path, method) not in routes:
+            return self.respond(404, {'error': f'No endpoint {method} {path}'})
+        try:
+            self.respond(200, routes[path, method](params))
+        except (KeyError, TypeError, ValueError) as error:
+            self.respond(400, {'error': f'Invalid request: {error}'})
+        except SystemExit as error:  # the checks of env exit with their message
+            self.respond(400, {'error': str(error.code)})
+
+
+    def respond(self, status, content):
+        encoded = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class routing_server(ThreadingHTTPServer):
+    request_queue_size = 128  # listen backlog, the default of 5 resets concurrent clients
+    daemon_threads = True
+
+    def __init__ (self, env, host = '127.0.0.1', port = 8000, window = 0.005, processes = 1, verbose = False):
+        """
+        HTTP/JSON routing service on one environment loaded once, see request_handler for the endpoints
+
+        Every request is served on its own thread. Route queries from the same source are micro-batched
+        (see micro_batcher), and matrices are solved by matrix.cost_matrix() over a process pool.
+
+        Args:
+        - env (traffic_env): The environment to serve
+        - host, port: The address to listen on, port 0 picks a free port (see server_address)
+        - window (float): The seconds a batch of route queries stays open
+        - processes (int or None): The size of the process pool of each matrix, 1 to solve in the server
+        - verbose (bool): Log every request to stderr
+        """
+
+        super().__init__((host, port), request_handler)
+        self.env = env
+        self.batcher = micro_batcher(env, window)
+        self.processes = processes
+        self.verbose = verbose
+        self.congestion_lock = threading.Lock()
+
+
+    def route(self, params):
+        return self.batcher.route(params['start_node'], params['end_node'], params.get('evaluation'))
+
+
+    def matrix(self, params):
+        sources, targets = list(params['sources']), list(params['targets'])
+        if not sources or not targets:
+            raise ValueError('provide "sources" and "targets"')
+        evaluation = params.get('evaluation') or self.env.evaluation
+        if evaluation not in ('distance', 'time'):
+            raise ValueError('Invalid evaluation type, provide only "distance" or "time"')
+        for node in sources + targets:
+            if node not in self.env.node_index:
+                raise ValueError(f'Node {node} not in Nodes Space')
+        costs = matrix.cost_matrix(self.env, sources, targets, evaluation, processes=self.processes)
+        return {'sources': sources, 'targets': targets, 'evaluation': evaluation, 'matrix': [[_finite(cost) for cost in row] for row in costs.tolist()]}
+
+
+    def get_congestion(self, params):
+        return {'congestion': [list(item) for item in zip(self.env.congested_edges, self.env.congestion_duration)]}
+
+
+    def get_stats(self, params):
+        batcher = self.batcher
+        return dict(batcher.cache.stats, queries=batcher.queries, searches=batcher.searches, congestion_version=self.env.congestion_version)
+
+
+    def set_congestion(self, params):
+        with self.congestion_lock:
+            if 'changes' in params:
+                self.env.update_congestion([(edge, float(duration)) for edge, duration in params['changes']])
+            else:
+                self.env.set_congestion([(edge, float(duration)) for edge, duration in params['congestion']])
+        return self.get_congestion(params)
+
+
+def serve(env, host = '127.0.0.1', port = 8000, window = 0.005, processes = 1, verbose = False):
+    """
+    Run a routing_server until interrupted
+
+    Returns:
+    - void
+    """
+
+    server = routing_server(env, host, port, window, processes, verbose)
+    print('Server Start...')
+    print(f'-- Listening on http://{server.server_address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f'-- Queries: {server.batcher.queries}, Searches: {server.batcher.searches}')
+
+
+class routing_client:
+    def __init__ (self, host = '127.0.0.1', port = 8000, timeout = 60):
+        """
+        Client of a routing_server
+
+        Args:
+        - host, port: The address of the server
+        - timeout (float): The seconds to wait for each response
+        """
+
+        self.url = f'http://{host}:{port}'
+        self.timeout = timeout
+
+
+    def request(self, path, body = None):
+        """
+        Returns:
+        - The JSON response (dict), an error response raises urllib.error.HTTPError
+        """
+
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+
+    def route(self, start_node, end_node, evaluation = None):
+        return self.request('/route', {'start_node': start_node, 'end_node': end_node, 'evaluation': evaluation})
+
+
+    def matrix(self, sources, targets, evaluation = None):
+        return self.request('/matrix', {'sources': sources, 'targets': targets, 'evaluation': evaluation})['matrix']
+
+
+    def congestion(self):
+        return self.request('/congestion')['congestion']
+
+
+    def stats(self):
+        return self.request('/stats')
+
+
+    def set_congestion(self, congestion):
+        return self.request('/congestion', {'congestion': [list(item) for item in congestion]})['congestion']
+
+
+    def update_congestion(self, changes):
+        return self.request('/congestion', {'changes': [list(item) for item in changes]})['congestion']
@@ -0,0 +1,233 @@
+import numpy as np
+
+
+class compiled_signals:
+    def __init__ (self, graph, connections, tls):
+        """
+        Compact signal model: which link of which traffic light controls each movement, and for every
+        link and every second of its cycle, how long until the light is no longer red.
+
+        Args:
+        - graph (compiled_network): The network the connections refer to
+        - connections (list): (from_edge_index, to_edge_index, tl_id, link_index) of every signalised connection, in net order
+        - tls (dict): The programs read by tls_from_tllxml(), tls[tl_id] = {'offset': float, 'phases': [(duration, state), ...]}
+        """
+
+        self.connections = connections  # kept for models/snapshot.py
+
+        # 1. One row per (tl, link_index), a link waits on wait_table[link_ptr[row] + second_of_cycle]
+        self.tl_ids = list(tls)
+        self.tl_row = {}  # tl_id -> row of its link 0
+        self.tl_num_links = {}  # tl_id -> number of links in its program
+        link_cycle, link_offset, wait_table = [], [], []
+        expanded = {}  # phases -> until_green, lights often run the same program
+        for tl_id in self.tl_ids:
+            phases = tuple(tls[tl_id]['phases'])
+            if phases not in expanded:
+                expanded[phases] = self.build_until_green(phases)
+            until_green = expanded[phases]
+            num_links, cycle = until_green.shape
+            self.tl_row[tl_id] = len(link_cycle)
+            self.tl_num_links[tl_id] = num_links
+            wait_table.append(until_green.ravel())  # the links of a light share its cycle
+            link_cycle.extend([cycle] * num_links)
+            link_offset.extend([float(tls[tl_id].get('offset', 0))] * num_links)
+
+        self.link_cycle = np.asarray(link_cycle, dtype=np.int32)
+        self.link_offset = np.asarray(link_offset, dtype=np.float64)
+        self.link_ptr = np.concatenate(([0], np.cumsum(self.link_cycle, dtype=np.int64)))
+        self.wait_table = np.concatenate(wait_table).astype(np.int32) if wait_table else np.zeros(0, dtype=np.int32)
+
+        # 2. Movement -> link row, the first connection of a movement wins, movements of unknown programs are not signalised
+        self.movement_link = {}  # (from_edge_index, to_edge_index) -> row
+        self.movement_tl = {}  # (from_edge_index, to_edge_index) -> tl_id, to print on map
+        for from_edge, to_edge, tl_id, link_index in connections:
+            movement = (from_edge, to_edge)
+            if movement in self.movement_link or tl_id not in self.tl_row:
+                continue
+            if not 0 <= link_index < self.tl_num_links[tl_id]:
+                continue  # the program has fewer links than the net
+            self.movement_link[movement] = self.tl_row[tl_id] + link_index
+            self.movement_tl[movement] = tl_id
+
+        self.tl_node_mask = np.zeros(graph.num_nodes, dtype=bool)  # nodes where a light may have to be waited for
+        for from_edge, _ in self.movement_link:
+            self.tl_node_mask[graph.edge_to[from_edge]] = True
+
+        self.build_lookups()
+
+
+    def build_lookups(self):
+        # Python copies for the per-call lookups
+        self._link_ptr = self.link_ptr.tolist()
+        self._link_cycle = self.link_cycle.tolist()
+        self._link_offset = self.link_offset.tolist()
+        self._wait_table = self.wait_table.tolist()
+
+        # Sorted movement keys (from_edge << 32 | to_edge) and their rows, for the vectorised get_waits()
+        movements = np.array([(from_edge, to_edge, row) for (from_edge, to_edge), row in self.movement_link.items()], dtype=np.int64).reshape(-1, 3)
+        keys = (movements[:, 0] << 32) | movements[:, 1]
+        order = np.argsort(keys)
+        self.movement_keys = keys[order]
+        self.movement_rows = movements[order, 2]
+
+
+    @classmethod
+    def from_sumolib(cls, net, graph, tls):
+        """
+        Collect the signalised connections of a sumolib net
+
+        Args:
+        - net (sumolib.net.Net): The net read by sumolib.net.readNet
+        - graph (compiled_network): The compiled net
+        - tls (dict): The programs read by tls_from_tllxml()
+
+        Returns:
+        - A compiled_signals
+        """
+
+        connections = []
+        for tl in net.getTrafficLights():
+            for in_lane, out_lane, link_index in tl.getConnections():
+                from_edge = graph.edge_index.get(in_lane.getEdge().getID())
+                to_edge = graph.edge_index.get(out_lane.getEdge().getID())
+                if from_edge is not None and to_edge is not None:
+                    connections.append((from_edge, to_edge, tl.getID(), link_index))
+        return cls(graph, connections, tls)
+
+
+    def to_arrays(self):
+        """
+        Everything compiled, as plain arrays for models/snapshot.py
+
+        Returns:
+        - tl_ids (list): The IDs (str) of the programs
+        - arrays (dict): [name] = np.ndarray
+        """
+
+        tl_position = {tl_id: position for position, tl_id in enumerate(self.tl_ids)}
+        movements = list(self.movement_link)
+        connection_tls = sorted({tl_id for _, _, tl_id, _ in self.connections} - set(tl_position))
+        tl_position.update({tl_id: len(self.tl_ids) + position for position, tl_id in enumerate(connection_tls)})
+
+        arrays = {
+            'tl_row': np.array([self.tl_row[tl_id] for tl_id in self.tl_ids], dtype=np.int64),
+            'tl_num_links': np.array([self.tl_num_links[tl_id] for tl_id in self.tl_ids], dtype=np.int64),
+            'link_ptr': self.link_ptr,
+            'link_cycle': self.link_cycle,
+            'link_offset': self.link_offset,
+            'wait_table': self.wait_table,
+            'movements': np.array([(from_edge, to_edge, self.movement_link[(from_edge, to_edge)], tl_position[self.movement_tl[(from_edge, to_edge)]]) for from_edge, to_edge in movements], dtype=np.int64).reshape(-1, 4),
+            'connections': np.array([(from_edge, to_edge, tl_position[tl_id], link_index) for from_edge, to_edge, tl_id, link_index in self.connections], dtype=np.int64).reshape(-1, 4),
+            'tl_node_mask': self.tl_node_mask,
+        }
+        return self.tl_ids + connection_tls, arrays
+
+
+    @classmethod
+    def from_arrays(cls, tl_ids, arrays, num_programs):
+        """
+        Rebuild a compiled_signals from to_arrays() without expanding the programs again
+
+        Args:
+        - tl_ids (list): The IDs returned by to_arrays()
+        - arrays (dict): The arrays returned by to_arrays()
+        - num_programs (int): The number of IDs with a program, the first ones of tl_ids
+
+        Returns:
+        - A compiled_signals
+        """
+
+        signals = cls.__new__(cls)
+        signals.connections = [(from_edge, to_edge, tl_ids[tl], link_index) for from_edge, to_edge, tl, link_index in arrays['connections'].tolist()]
+        signals.tl_ids = tl_ids[:num_programs]
+        signals.tl_row = dict(zip(signals.tl_ids, arrays['tl_row'].tolist()))
+        signals.tl_num_links = dict(zip(signals.tl_ids, arrays['tl_num_links'].tolist()))
+        for name in ('link_ptr', 'link_cycle', 'link_offset', 'wait_table', 'tl_node_mask'):
+            setattr(signals, name, arrays[name])
+        signals.movement_link = {}
+        signals.movement_tl = {}
+        for from_edge, to_edge, row, tl in arrays['movements'].tolist():
+            signals.movement_link[(from_edge, to_edge)] = row
+            signals.movement_tl[(from_edge, to_edge)] = tl_ids[tl]
+        signals.build_lookups()
+        return signals
+
+
+    @staticmethod
+    def build_until_green(phases):
+        """
+        Expand a program to seconds and count, for each link and second, the seconds until a non-red state
+
+        Args:
+        - phases (list): (duration, state) of each phase
+
+        Returns:
+        - until_green (np.ndarray [num_links, cycle]): 0 when not red, -1 for a link that is never green
+        """
+
+        durations = [int(round(float(duration))) for duration, _ in phases]
+        if sum(durations) == 0:  # no program to follow, never red
+            return np.zeros((max((len(state) for _, state in phases), default=0), 1), dtype=np.int32)
+        states = np.array([list(state) for _, state in phases])  # [num_phases, num_links]
+        red = np.repeat(states == 'r', durations, axis=0).T  # [num_links, cycle]
+        num_links, cycle = red.shape
+
+        # the next non-red second of every second, over two cycles to wrap around, for all links at once
+        seconds = np.arange(2 * cycle)
+        next_green = np.where(np.concatenate((red, red), axis=1), 2 * cycle, seconds)
+        next_green = np.minimum.accumulate(next_green[:, ::-1], axis=1)[:, ::-1][:, :cycle]
+        until_green = (next_green - seconds[:cycle]).astype(np.int32)
+        until_green[next_green == 2 * cycle] = -1
+        return until_green
+
+
+    def get_wait(self, edge_index, next_edge_index, current_time):
+        """
+        Time to wait at the light controlling a movement
+
+        Args:
+        - edge_index, next_edge_index (int): The indices of the movement's edges
+        - current_time (float): The arrival time at the end of edge_index
+
+        Returns:
+        - idle_time (float): 0 if the movement is not signalised, not red, or never green. Otherwise the time
+            until the next non-red second starts, so that arriving later never means leaving earlier (FIFO)
+        """
+
+        row = self.movement_link.get((edge_index, next_edge_index))
+        if row is None:
+            return 0
+
+        position = (current_time - self._link_offset[row]) % self._link_cycle[row]
+        second = int(position)
+        until_green = self._wait_table[self._link_ptr[row] + second]
+        if until_green <= 0:
+            return 0
+        return until_green - (position - second)
+
+
+    def get_waits(self, edge_indices, next_edge_indices, current_times):
+        """
+        Vectorised get_wait() of many movements
+
+        Args:
+        - edge_indices, next_edge_indices (np.ndarray): The indices of the edges of each movement
+        - current_times (np.ndarray): The arrival time at the end of each edge_indices
+
+        Returns:
+        - idle_times (np.ndarray [len(edge_indices)]): As get_wait() of each movement
+        """
+
+        keys = (np.asarray(edge_indices, dtype=np.int64) << 32) | np.asarray(next_edge_indices, dtype=np.int64)
+        found = np.searchsorted(self.movement_keys, keys)
+        found = np.minimum(found, len(self.movement_keys) - 1)
+        signalised = np.flatnonzero(self.movement_keys[found] == keys) if len(self.movement_keys) else np.zeros(0, dtype=np.int64)
+
+        idle_times = np.zeros(len(keys), dtype=np.float64)
+        rows = self.movement_rows[found[signalised]]
+        position = (np.asarray(current_times, dtype=np.float64)[signalised] - self.link_offset[rows]) % self.link_cycle[rows]
+        second = position.astype(np.int64)
+        until_green = self.wait_table[self.link_ptr[rows] + second]
+        idle_times[signalised] = np.where(until_green > 0, until_green - (position - second), 0)
+        return idle_times
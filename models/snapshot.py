@@ -0,0 +1,240 @@
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+
+from models import network
+from models import signals
+
+
+MAGIC = b'ROUTE-OPTIM-SNAP'  # 16 bytes
+VERSION = 1
+ALIGN = 64  # every array starts on a 64-byte boundary of the file
+
+
+def file_digest(file_name):
+    """
+    Returns:
+    - The SHA-1 hex digest (str) of a file's content
+    """
+
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def tls_digest(tls):
+    """
+    Returns:
+    - The SHA-1 hex digest (str) of the programs read from a .tll.xml, so that editing the .tll.xml invalidates the snapshot
+    """
+
+    return hashlib.sha1(json.dumps(tls, sort_keys=True).encode()).hexdigest()
+
+
+def snapshot_file(network_file):
+    # The snapshot of a network lives next to it
+    return f'{network_file}.snapshot'
+
+
+def _pack_strings(strings):
+    # IDs never hold NUL, so they are joined by it into one uint8 array
+    return np.frombuffer('\0'.join(strings).encode(), dtype=np.uint8)
+
+
+def _unpack_strings(array, count):
+    return bytes(array).decode().split('\0') if count else []
+
+
+def write(file_name, header, arrays):
+    """
+    Write arrays to one binary file: MAGIC, the length of a JSON header, the header, then every array aligned to ALIGN bytes.
+    The file is written to a temporary name first and then moved over file_name.
+
+    Args:
+    - file_name (str): The file to write
+    - header (dict): JSON-serialisable metadata, 'arrays' is added with the dtype, shape and offset of each array
+    - arrays (dict): [name] = np.ndarray
+    """
+
+    header = dict(header, arrays={})
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = [np.lib.format.dtype_to_descr(array.dtype), list(array.shape), offset]
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+
+    encoded = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(encoded)) // ALIGN) * ALIGN
+    temp_name = f'{file_name}.{os.getpid()}.tmp'
+    with open(temp_name, 'wb') as file:
+        file.write(MAGIC + struct.pack('<Q', len(encoded)) + encoded)
+        for name, array in arrays.items():
+            file.seek(data_start + header['arrays'][name][2])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(data_start + offset)
+    os.replace(temp_name, file_name)
+
+
+def read(file_name):
+    """
+    Map a file written by write()
+
+    Returns:
+    - header (dict): The JSON header
+    - arrays (dict): [name] = read-only np.ndarray viewing the memory-mapped file
+    Or None if the file is missing or not a snapshot
+    """
+
+    try:
+        with open(file_name, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                return None
+            header_length = struct.unpack('<Q', file.read(8))[0]
+            header = json.loads(file.read(header_length))
+    except (OSError, ValueError, struct.error):
+        return None
+
+    data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGN) * ALIGN
+    buffer = np.memmap(file_name, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, (descr, shape, offset) in header['arrays'].items():
+        dtype = np.lib.format.descr_to_dtype(descr)
+        count = int(np.prod(shape, dtype=np.int64))
+        start = data_start + offset
+        arrays[name] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(shape)
+    return header, arrays
+
+
+def source_stamp(network_file):
+    # What the snapshot is keyed by: the content of the network file, with its size and mtime to skip hashing it when unchanged
+    stat = os.stat(network_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _unchanged(file_name, source):
+    # Whether a file still has the content of source {stamp, sha1}, hashing it only if its size or mtime changed
+    try:
+        return source_stamp(file_name) == source['stamp'] or file_digest(file_name) == source['sha1']
+    except OSError:
+        return False
+
+
+def load_tls(network_file, tls_file = None):
+    """
+    The programs stored in the snapshot, so that a start with a valid snapshot reads no XML at all
+
+    Args:
+    - network_file (str): The .net.xml the snapshot was made from
+    - tls_file (str or None): The file the programs are read from, None for the programs embedded in network_file
+
+    Returns:
+    - tls (dict): As tls_from_tllxml(), or None if the snapshot is missing, stale, or was not saved with tls_file
+    """
+
+    tls_file = tls_file or network_file
+    snapshot = read(snapshot_file(network_file))
+    if snapshot is None:
+        return None
+    header = snapshot[0]
+    if header.get('version') != VERSION or header.get('tls_file') != os.path.abspath(tls_file):
+        return None
+    if not _unchanged(network_file, header['source']) or not _unchanged(tls_file, header['tls_source']):
+        return None
+    return {tl_id: {'offset': program['offset'], 'phases': [tuple(phase) for phase in program['phases']]} for tl_id, program in header['tls'].items()}
+
+
+def load(network_file, tls, tls_file = None):
+    """
+    Load the compiled network and signals of a network file from its snapshot
+
+    The snapshot is valid while the network file has the same content (its hash is only recomputed
+    when its size or mtime changed) and the programs are the same as when it was written.
+
+    Args:
+    - network_file (str): The .net.xml the snapshot was made from
+    - tls (dict): The programs read by tls_from_tllxml()
+    - tls_file (str or None): The file tls was read from, stored so that load_tls() can skip reading it next time
+
+    Returns:
+    - graph (compiled_network), tls_space (list), signals (compiled_signals), or None if there is no valid snapshot
+    """
+
+    snapshot = read(snapshot_file(network_file))
+    if snapshot is None:
+        return None
+    header, arrays = snapshot
+    if header.get('version') != VERSION:
+        return None
+
+    # 1. Same network file, hashing it only if it was touched
+    touched = source_stamp(network_file) != header['source']['stamp']
+    if touched and file_digest(network_file) != header['source']['sha1']:
+        return None
+    if tls_file is not None and (header.get('tls_file') != os.path.abspath(tls_file) or source_stamp(tls_file) != header['tls_source']['stamp']):
+        touched = True  # stored again with the programs of tls_file
+
+    # 2. Rebuild, the arrays stay memory-mapped
+    node_ids = _unpack_strings(arrays['node_ids'], header['num_nodes'])
+    edge_ids = _unpack_strings(arrays['edge_ids'], header['num_edges'])
+    graph = network.compiled_network.from_arrays(node_ids, edge_ids, {name[6:]: array for name, array in arrays.items() if name.startswith('graph.')}, header['scalars'])
+    tls_space = _unpack_strings(arrays['tls_space'], header['num_tls'])
+    tl_ids = _unpack_strings(arrays['tl_ids'], header['num_tl_ids'])
+    signal_arrays = {name[8:]: array for name, array in arrays.items() if name.startswith('signals.')}
+
+    # 3. The programs changed, expand them again from the connections kept
+    if header['tls_sha1'] != tls_digest(tls):
+        connections = [(from_edge, to_edge, tl_ids[tl], link_index) for from_edge, to_edge, tl, link_index in signal_arrays['connections'].tolist()]
+        compiled = signals.compiled_signals(graph, connections, tls)
+        touched = True
+    else:
+        compiled = signals.compiled_signals.from_arrays(tl_ids, signal_arrays, header['num_programs'])
+
+    if touched:  # refresh the stamp and programs, so that the next start takes the fast path
+        try:
+            save(network_file, tls, graph, tls_space, compiled, header['source']['sha1'], tls_file)
+        except OSError:
+            pass
+    return graph, tls_space, compiled
+
+
+def save(network_file, tls, graph, tls_space, compiled, sha1 = None, tls_file = None):
+    """
+    Write the snapshot of a network file, see load()
+
+    Args:
+    - network_file (str): The .net.xml the network was read from
+    - tls (dict): The programs read by tls_from_tllxml()
+    - graph (compiled_network), tls_space (list), compiled (compiled_signals): What load() returns
+    - sha1 (str or None): The digest of network_file if already known
+    - tls_file (str or None): The file tls was read from, None if unknown: load_tls() then finds no programs
+    """
+
+    node_ids, edge_ids, graph_arrays, scalars = graph.to_arrays()
+    tl_ids, signal_arrays = compiled.to_arrays()
+
+    source = {'stamp': source_stamp(network_file), 'sha1': sha1 or file_digest(network_file)}
+    header = {
+        'version': VERSION,
+        'source': source,
+        'tls_sha1': tls_digest(tls),
+        'num_nodes': len(node_ids), 'num_edges': len(edge_ids), 'num_tls': len(tls_space),
+        'num_tl_ids': len(tl_ids), 'num_programs': len(compiled.tl_ids),
+        'scalars': scalars,
+    }
+    if tls_file is not None:  # the programs themselves, for load_tls()
+        same_file = os.path.abspath(tls_file) == os.path.abspath(network_file)
+        header['tls_file'] = os.path.abspath(tls_file)
+        header['tls_source'] = source if same_file else {'stamp': source_stamp(tls_file), 'sha1': file_digest(tls_file)}
+        header['tls'] = tls
+    arrays = {
+        'node_ids': _pack_strings(node_ids),
+        'edge_ids': _pack_strings(edge_ids),
+        'tls_space': _pack_strings(tls_space),
+        'tl_ids': _pack_strings(tl_ids),
+    }
+    arrays.update({f'graph.{name}': array for name, array in graph_arrays.items()})
+    arrays.update({f'signals.{name}': array for name, array in signal_arrays.items()})
+    write(snapshot_file(network_file), header, arrays)
@@ -0,0 +1,166 @@
+import io
+import os
+import sys
+import csv
+import json
+import time
+import itertools
+import contextlib
+import multiprocessing
+import numpy as np
+
+
+# The environment and agents loaded once by each worker of the pool
+_worker = {}
+
+
+def grid_search(param_grid):
+    """
+    Every combination of a grid of parameters
+
+    Args:
+    - param_grid (dict): [name] = list of values, e.g. {'learning_rate': [0.5, 0.9], 'seed': range(5)}
+
+    Returns:
+    - runs (list): One dict of parameters per run
+    """
+
+    names = list(param_grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(list(param_grid[name]) for name in names))]
+
+
+def random_search(param_space, num_runs, seed = None):
+    """
+    Random combinations of parameters
+
+    Args:
+    - param_space (dict): [name] = list of values to choose from, or (low, high) tuple of floats to draw uniformly
+    - num_runs (int): The number of runs
+    - seed (int or None): The seed of the draw, the run seeds themselves are part of param_space
+
+    Returns:
+    - runs (list): One dict of parameters per run
+    """
+
+    rng = np.random.default_rng(seed)
+    runs = []
+    for _ in range(num_runs):
+        params = {}
+        for name, space in param_space.items():
+            if isinstance(space, tuple):
+                params[name] = float(rng.uniform(*space))
+            else:
+                space = list(space)
+                params[name] = space[rng.integers(len(space))]
+        runs.append(params)
+    return runs
+
+
+def _load(env_args, start_node, end_node, algorithm):
+    # Pool initializer: one environment per worker, shared by all of its runs
+    import matplotlib
+    matplotlib.use('Agg')  # nothing to show in a worker, plot_performance() skips its plot
+
+    from models import environment
+    _bind(environment.worker_env(env_args), start_node, end_node, algorithm)
+
+
+def _bind(env, start_node, end_node, algorithm):
+    from models import agent
+    _worker['env'] = env
+    _worker['agent'] = {'q_learning': agent.Q_Learning, 'sarsa': agent.SARSA}[algorithm]
+    _worker['args'] = (start_node, end_node)
+
+
+def _run(task):
+    # Worker task: train one agent, the output of train() is discarded and a failure to converge is a result
+    run, params, num_episodes, threshold, batch_size = task
+    env = _worker['env']
+
+    start_time = time.perf_counter()
+    converged, episodes, cost = False, num_episodes, None
+    with contextlib.redirect_stdout(io.StringIO()):
+        rl = _worker['agent'](env, *_worker['args'], **params)
+        try:
+            if batch_size:
+                _, edge_path, episode, _ = rl.train_batch(num_episodes, threshold, batch_size)
+            else:
+                _, edge_path, episode, _ = rl.train(num_episodes, threshold)
+            converged, episodes = True, episode + 1
+            cost = float(env.get_route_cost(env.get_edge_indices(edge_path, 'run_sweep')))
+        except SystemExit:
+            pass
+    wall_time = time.perf_counter() - start_time
+
+    return {'run': run, **params, 'converged': converged, 'episodes': episodes, 'wall_time': round(wall_time, 4), 'cost': cost}
+
+
+def run_sweep(env, start_node, end_node, runs, output_file, algorithm = 'q_learning', num_episodes = 5000, threshold = 5, processes = None, batch_size = None):
+    """
+    Train one agent per run in a process pool and stream the results to a file as they finish
+
+    Every worker reloads the environment once from env.network_file, with env's tls, congested
+    edges, speed profiles and evaluation, so that all runs see the same network. Each agent draws from its own
+    numpy.random.Generator, seeded by the run's 'seed' parameter.
+    With processes=1 the runs share env itself, and a run that fails to converge shows its plot as train() does.
+
+    Args:
+    - env (traffic_env): The environment to train on
+    - start_node, end_node (str): The IDs of the route of every run
+    - runs (list): Dicts of constructor parameters (learning_rate, discount_factor, exploration_rate, reward_lst, seed),
+        e.g. from grid_search() or random_search()
+    - output_file (str): .csv or .jsonl, one line per run written when it finishes
+    - algorithm (str): "q_learning" or "sarsa"
+    - num_episodes, threshold (int): As for rl_agent.train()
+    - processes (int or None): The size of the process pool, None for os.cpu_count(), 1 to train in this process
+    - batch_size (int or None): Train with rl_agent.train_batch() of this size instead of train()
+
+    Returns:
+    - results (list): The rows written, in the order they finished
+    """
+
+    # 1. Check the inputs
+    if algorithm not in ('q_learning', 'sarsa'):
+        sys.exit('Error: Invalid algorithm, provide only "q_learning" or "sarsa"')
+    for node in (start_node, end_node):
+        if node not in env.node_index:
+            sys.exit(f'Error: Node {node} not in Nodes Space ...call by run_sweep')
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension not in ('.csv', '.jsonl'):
+        sys.exit('Error: Invalid output_file, provide only .csv or .jsonl')
+
+    columns = ['run'] + sorted({name for params in runs for name in params}) + ['converged', 'episodes', 'wall_time', 'cost']
+    initargs = (env.worker_args(), start_node, end_node, algorithm)
+    tasks = [(run, params, num_episodes, threshold, batch_size) for run, params in enumerate(runs)]
+    processes = min(processes or os.cpu_count() or 1, max(len(tasks), 1))
+
+    # 2. Train, writing each result as soon as it comes back
+    print('Sweep Start...')
+    start_time = time.perf_counter()
+    results = []
+    with open(output_file, 'w', newline='') as file:
+        if extension == '.csv':
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+
+        def write(row):
+            if extension == '.csv':
+                writer.writerow({key: json.dumps(value) if isinstance(value, (list, tuple)) else value for key, value in row.items()})
+            else:
+                file.write(json.dumps(row) + '\n')
+            file.flush()
+            results.append(row)
+            print(f"-- Run {row['run']}: converged={row['converged']}, episodes={row['episodes']}, cost={row['cost']}, {row['wall_time']} seconds")
+
+        if processes <= 1:
+            _bind(env, start_node, end_node, algorithm)
+            for task in tasks:
+                write(_run(task))
+            _worker.clear()
+        else:
+            with multiprocessing.Pool(processes, initializer=_load, initargs=initargs) as pool:
+                for row in pool.imap_unordered(_run, tasks):
+                    write(row)
+
+    print(f'-- Processing Time: {round(time.perf_counter() - start_time, 2)} seconds')
+    return results